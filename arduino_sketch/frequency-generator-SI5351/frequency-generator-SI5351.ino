@@ -28,6 +28,25 @@ unsigned long value;
 
 Si5351 si5351;
 
+// Pulse schedule that is executed with micros() timing (see pulse_sequence.py
+// for the format). Every record is flags (bit 0: output on), duration in us,
+// frequency in Hz (0 to keep) and the cap relays (bit n-1 for cap n, 0xFFFF
+// to keep).
+#define MAX_SEGMENTS 48
+#define KEEP_FREQUENCY 0
+#define KEEP_RELAYS 0xFFFF
+
+struct Segment {
+  uint8_t flags;
+  uint32_t duration;
+  uint32_t frequency;
+  uint16_t relays;
+} __attribute__((packed));
+
+Segment segments[MAX_SEGMENTS];
+unsigned long edge_times[MAX_SEGMENTS];
+int number_of_segments = 0;
+
 void setup()
 {
   bool i2c_found;
@@ -190,6 +209,16 @@ void loop()
         // Zero to disable, 1 to enable
         si5351.output_enable(SI5351_CLK0, value);
     }
+    // Upload of a pulse schedule (the binary records follow the command)
+    else if (command.equals("seq")) {
+      load_sequence(value);
+    }
+    // Execute the pulse schedule
+    else if (command.equals("run")) {
+      if (value == 1 && number_of_segments > 0) {
+        run_sequence();
+      }
+    }
     // If the input is not a valid number nor a command, return an error
     else
     {
@@ -253,3 +282,119 @@ String getValue(String data, char separator, int index)
   }
   return found > index ? data.substring(strIndex[0], strIndex[1]) : "";
 }
+
+// Function to receive the records of a pulse schedule and check them
+void load_sequence(unsigned long count) {
+  number_of_segments = 0;
+  size_t length = count * sizeof(Segment);
+  uint16_t checksum = 0;
+  uint16_t received_checksum = 0;
+  byte *data = (byte *) segments;
+
+  if (count < 1 || count > MAX_SEGMENTS) {
+    // Discard the records
+    byte discard;
+    while (Serial.readBytes(&discard, 1) == 1) {}
+    Serial.println("Sequence invalid");
+    return;
+  }
+
+  if (Serial.readBytes(data, length) != length ||
+      Serial.readBytes((byte *) &received_checksum, 2) != 2) {
+    Serial.println("Sequence invalid");
+    return;
+  }
+
+  for (size_t i = 0; i < length; i++) {
+    checksum += data[i];
+  }
+  if (checksum != received_checksum) {
+    Serial.println("Sequence invalid");
+    return;
+  }
+
+  number_of_segments = count;
+  Serial.print("Sequence loaded: ");
+  Serial.println(count);
+}
+
+// Function to switch frequency, caps and output at the start of a segment.
+// The relays must not switch while the drive is on: the output is disabled
+// before anything else changes and only enabled again at the very end.
+void apply_segment(Segment segment) {
+  boolean output_on = segment.flags & 1;
+  if (!output_on) {
+    si5351.output_enable(SI5351_CLK0, 0);
+  }
+  if (segment.frequency != KEEP_FREQUENCY) {
+    si5351.set_freq(segment.frequency * 100ULL, SI5351_CLK0);
+    frequency = segment.frequency;
+  }
+  if (segment.relays != KEEP_RELAYS) {
+    for (int i = 1; i <= 10; i++) {
+      digitalWrite(i + 1, (segment.relays >> (i - 1)) & 1);
+    }
+  }
+  if (output_on) {
+    si5351.output_enable(SI5351_CLK0, 1);
+  }
+}
+
+// Function to report the edges as long as it does not block (the reports
+// must not delay the next edge)
+int report_edges(int reported, int applied) {
+  while (reported < applied && Serial.availableForWrite() >= 24) {
+    Serial.print("edge_");
+    Serial.print(reported);
+    Serial.print("_");
+    Serial.println(edge_times[reported]);
+    reported++;
+  }
+  return reported;
+}
+
+// Function to check if the host aborts the schedule
+boolean abort_requested() {
+  if (Serial.available() > 0) {
+    return Serial.readStringUntil('\n').startsWith("run_0");
+  }
+  return false;
+}
+
+// Function to execute the pulse schedule. The edges are relative to the
+// start so that the timing does not drift over long schedules (the unsigned
+// difference also handles the overflow of micros()).
+void run_sequence() {
+  int reported = 0;
+  int applied = 0;
+  boolean aborted = false;
+
+  Serial.println("start");
+  unsigned long start = micros();
+  unsigned long edge = start;
+
+  for (int i = 0; i <= number_of_segments && !aborted; i++) {
+    while ((long) (micros() - edge) < 0) {
+      reported = report_edges(reported, applied);
+      if (abort_requested()) {
+        aborted = true;
+        break;
+      }
+    }
+    if (aborted || i == number_of_segments) {
+      break;
+    }
+
+    apply_segment(segments[i]);
+    edge_times[i] = micros() - start;
+    applied++;
+    edge += segments[i].duration;
+  }
+
+  si5351.output_enable(SI5351_CLK0, 0);
+  while (reported < applied) {
+    reported = report_edges(reported, applied);
+  }
+  Serial.print("done_");
+  Serial.println(frequency);
+}
@@ -762,6 +762,20 @@ class Ui_MainWindow(object):
             self.pulsew_constant_parameter_mode_HLayout, 4, 0, 1, 1
         )
 
+        # Let the arduino time the pulses
+        self.pulsew_hardware_timing_HLayout = QtWidgets.QHBoxLayout()
+        self.pulsew_hardware_timing_toggleSwitch = ToggleSwitch()
+        self.pulsew_hardware_timing_label = QtWidgets.QLabel("Hardware Timing")
+        self.pulsew_hardware_timing_HLayout.addWidget(
+            self.pulsew_hardware_timing_toggleSwitch
+        )
+        self.pulsew_hardware_timing_HLayout.addWidget(
+            self.pulsew_hardware_timing_label
+        )
+        self.pulsew_scrollArea_gridLayout.addLayout(
+            self.pulsew_hardware_timing_HLayout, 5, 0, 1, 1
+        )
+
         # Start measurement push button
         self.pulsew_start_measurement_pushButton = QtWidgets.QPushButton(
             self.pulsew_scrollAreaWidgetContents
@@ -770,7 +784,7 @@ class Ui_MainWindow(object):
             "pulsew_start_measurement_pushButton"
         )
         self.pulsew_scrollArea_gridLayout.addWidget(
-            self.pulsew_start_measurement_pushButton, 5, 0, 1, 1
+            self.pulsew_start_measurement_pushButton, 6, 0, 1, 1
         )
 
         self.tabWidget.addTab(self.pulsing_widget, "")
@@ -1325,6 +1339,16 @@ class Ui_MainWindow(object):
             self.bw_reverse_sweep_HLayout, 19, 0, 1, 1
         )
 
+        # Only search the optimum bias field instead of sweeping?
+        self.bw_search_optimum_HLayout = QtWidgets.QHBoxLayout()
+        self.bw_search_optimum_toggleSwitch = ToggleSwitch()
+        self.bw_search_optimum_label = QtWidgets.QLabel("Search Optimum")
+        self.bw_search_optimum_HLayout.addWidget(self.bw_search_optimum_toggleSwitch)
+        self.bw_search_optimum_HLayout.addWidget(self.bw_search_optimum_label)
+        self.bw_scrollArea_gridLayout.addLayout(
+            self.bw_search_optimum_HLayout, 20, 0, 1, 1
+        )
+
         # Save Power button
         self.bw_start_measurement_pushButton = QtWidgets.QPushButton(
             self.bw_scrollAreaWidgetContents
@@ -1333,7 +1357,7 @@ class Ui_MainWindow(object):
             "bw_start_measurement_pushButton"
         )
         self.bw_scrollArea_gridLayout.addWidget(
-            self.bw_start_measurement_pushButton, 20, 0, 1, 1
+            self.bw_start_measurement_pushButton, 21, 0, 1, 1
         )
 
         self.tabWidget.addTab(self.bias_field_widget, "")
@@ -1806,6 +1830,28 @@ class Ui_MainWindow(object):
             self.ltw_time_step_spinBox, 15, 0, 1, 1
         )
 
+        # Log-spaced time steps (the time step is the first step)
+        self.ltw_log_time_steps_HLayout = QtWidgets.QHBoxLayout()
+        self.ltw_log_time_steps_toggleSwitch = ToggleSwitch()
+        self.ltw_log_time_steps_label = QtWidgets.QLabel("Log-spaced Steps")
+        self.ltw_log_time_steps_HLayout.addWidget(self.ltw_log_time_steps_toggleSwitch)
+        self.ltw_log_time_steps_HLayout.addWidget(self.ltw_log_time_steps_label)
+        self.ltw_scrollArea_gridLayout.addLayout(
+            self.ltw_log_time_steps_HLayout, 16, 0, 1, 1
+        )
+
+        # Skip steps that were missed instead of catching up
+        self.ltw_skip_missed_steps_HLayout = QtWidgets.QHBoxLayout()
+        self.ltw_skip_missed_steps_toggleSwitch = ToggleSwitch()
+        self.ltw_skip_missed_steps_label = QtWidgets.QLabel("Skip Missed Steps")
+        self.ltw_skip_missed_steps_HLayout.addWidget(
+            self.ltw_skip_missed_steps_toggleSwitch
+        )
+        self.ltw_skip_missed_steps_HLayout.addWidget(self.ltw_skip_missed_steps_label)
+        self.ltw_scrollArea_gridLayout.addLayout(
+            self.ltw_skip_missed_steps_HLayout, 17, 0, 1, 1
+        )
+
         # Auto set capacitance?
         self.ltw_autoset_capacitance_HLayout = QtWidgets.QHBoxLayout()
         self.ltw_autoset_capacitance_toggleSwitch = ToggleSwitch()
@@ -2297,9 +2343,13 @@ class Ui_MainWindow(object):
 
         self.actionOpen_Log = QtGui.QAction(MainWindow)
         self.actionOpen_Log.setObjectName("actionOpen_Log")
+
+        self.actionIO_Trace = QtGui.QAction(MainWindow)
+        self.actionIO_Trace.setObjectName("actionIO_Trace")
         self.menuSettings.addAction(self.actionOptions)
         self.menuSettings.addAction(self.actionDocumentation)
         self.menuSettings.addAction(self.actionOpen_Log)
+        self.menuSettings.addAction(self.actionIO_Trace)
         self.menubar.addAction(self.menuSettings.menuAction())
 
         # -------------------------------------------------------------------- #
@@ -2754,6 +2804,7 @@ class Ui_MainWindow(object):
         self.actionDocumentation.setText(_translate("MainWindow", "Help"))
 
         self.actionOpen_Log.setText(_translate("MainWindow", "Open Log"))
+        self.actionIO_Trace.setText(_translate("MainWindow", "I/O Trace"))
 
     # ------------------------------------------------------------------------ #
     # ----------------- User Defined UI related Functions -------------------- #
@@ -284,6 +284,24 @@ class Ui_Settings(object):
         self.dc_field_conversion_lineEdit.setObjectName("dc_field_conversion_lineEdit")
         self.gridLayout.addWidget(self.dc_field_conversion_lineEdit, 25, 1, 1, 1)
 
+        # Toggle switch to select if the ME voltage is demodulated (lock-in)
+        self.lock_in_mode_label = QtWidgets.QLabel("Lock-in Demodulation")
+        self.lock_in_mode_label.setObjectName("lock_in_mode_label")
+        self.gridLayout.addWidget(self.lock_in_mode_label, 26, 0, 1, 1)
+        self.lock_in_mode_toggleSwitch = ToggleSwitch()
+        self.lock_in_mode_toggleSwitch.setObjectName("lock_in_mode_toggleSwitch")
+        self.gridLayout.addWidget(self.lock_in_mode_toggleSwitch, 26, 1, 1, 1)
+
+        # Toggle switch to select if the settling is detected from the signal
+        self.adaptive_settling_label = QtWidgets.QLabel("Adaptive Settling")
+        self.adaptive_settling_label.setObjectName("adaptive_settling_label")
+        self.gridLayout.addWidget(self.adaptive_settling_label, 27, 0, 1, 1)
+        self.adaptive_settling_toggleSwitch = ToggleSwitch()
+        self.adaptive_settling_toggleSwitch.setObjectName(
+            "adaptive_settling_toggleSwitch"
+        )
+        self.gridLayout.addWidget(self.adaptive_settling_toggleSwitch, 27, 1, 1, 1)
+
         # # Transimpedance Amplifier Resistance
 
         # # Transimpedance Amplifier Resistance
@@ -326,7 +344,7 @@ class Ui_Settings(object):
         self.save_settings_pushButton.setObjectName("save_settings_pushButton")
         self.buttons_HBoxLayout.addWidget(self.save_settings_pushButton)
 
-        self.gridLayout.addLayout(self.buttons_HBoxLayout, 26, 0, 1, 2)
+        self.gridLayout.addLayout(self.buttons_HBoxLayout, 28, 0, 1, 2)
 
         self.retranslateUi(Settings)
         QtCore.QMetaObject.connectSlotsByName(Settings)
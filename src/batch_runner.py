@@ -0,0 +1,482 @@
+"""
+Headless batch runner that executes a measurement recipe without the GUI.
+
+A recipe is a JSON or YAML file of the form
+
+    setup:
+        folder_path: C:/data/
+        batch_name: batch1
+        device_size: [11.5, 3.5]
+    devices:
+        - device_number: 1
+        - device_number: 2
+    scans:
+        - type: frequency
+          parameters:
+            minimum_frequency: 135
+            maximum_frequency: 310
+        - type: bias
+          parameters:
+            frequency: 145
+          priority: 1
+          depends_on: [frequency_0]
+
+Every scan in "scans" is executed for every device in "devices". Parameters
+that are not given in the recipe are taken from the standard parameters of the
+GUI (see DEFAULT_PARAMETERS). Scans can be given a name (default is type and
+index, e.g. frequency_0), a priority and the names of scans they depend on.
+The jobs are run by the scheduler which orders them to minimise device
+changes and instrument reconfiguration. Usage:
+
+    python batch_runner.py recipe.yaml [--interactive] [--simulate] [--debug-log]
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+
+import yaml
+
+import core_functions as cf
+from scan_engine import ScanObserver
+from scheduler import JobScheduler, MeasurementJob
+from instrument_worker import InstrumentProxy
+import instrument_worker
+
+from frequency_measurement import FrequencyScanEngine
+from bias_field_measurement import BiasScanEngine
+from hf_field_measurement import HFScanEngine
+from lifetime_measurement import LTScanEngine
+from capacitance_measurement import CapacitanceScanEngine
+from incremental_calibration import IncrementalCalibrationEngine
+from map_measurement import MapScanEngine
+from pulsing_sweep import PulsingSweepEngine, read_pulsing_file
+
+from hardware import (
+    KoradKD3305PSource,
+    RigolOscilloscope,
+    Arduino,
+)
+
+# Same standard parameters as set in the GUI
+DEFAULT_PARAMETERS = {
+    "frequency": {
+        "voltage": 5,
+        "current_compliance": 0.5,
+        "minimum_frequency": 135,
+        "maximum_frequency": 310,
+        "autoset_frequency_step": False,
+        "frequency_step": 1,
+        "frequency_settling_time": 1,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": True,
+        "dc_magnetic_field": 1.5,
+    },
+    "bias": {
+        "voltage": 5,
+        "current_compliance": 0.5,
+        "frequency": 145,
+        "minimum_dc_field": 0,
+        "maximum_dc_field": 8,
+        "dc_field_step": 0.1,
+        "bias_field_settling_time": 0.5,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": True,
+        "reverse_sweep": True,
+        "search_optimum": False,
+    },
+    "hf": {
+        "voltage_compliance": 5,
+        "dc_magnetic_field": 1.5,
+        "frequency": 145,
+        "minimum_hf_voltage": 2,
+        "maximum_hf_voltage": 10,
+        "hf_voltage_step": 0.5,
+        "hf_field_settling_time": 1,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": True,
+    },
+    "lifetime": {
+        "voltage_compliance": 12,
+        "dc_magnetic_field": 1.5,
+        "frequency": 150,
+        "hf_voltage": 10,
+        "total_time": 120,
+        "time_step": 60,
+        "log_time_steps": False,
+        "skip_missed_steps": False,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": True,
+    },
+    "capacitance": {
+        "voltage": 2,
+        "current_compliance": 1,
+        "minimum_frequency": 62,
+        "maximum_frequency": 350,
+        "frequency_step": 1,
+        "resonance_frequency_step": 1,
+        "frequency_margin": 15,
+        "frequency_settling_time": 0.5,
+    },
+    "calibration": {
+        "voltage": 2,
+        "current_compliance": 1,
+        "minimum_frequency": 62,
+        "maximum_frequency": 350,
+        "frequency_step": 1,
+        "frequency_margin": 15,
+        "frequency_settling_time": 0.5,
+        "probe_points": 5,
+        "drift_tolerance": 0.2,
+        "store_directory": "",
+    },
+    "pulsing": {
+        "pulsing_file": "",
+        "constant_mode": False,
+        "hardware_timing": False,
+    },
+    "map": {
+        "voltage": 5,
+        "current_compliance": 0.5,
+        "minimum_frequency": 135,
+        "maximum_frequency": 155,
+        "frequency_step": 2,
+        "minimum_dc_field": 0,
+        "maximum_dc_field": 4,
+        "dc_field_step": 0.5,
+        "frequency_settling_time": 0.2,
+        "bias_field_settling_time": 0.5,
+        "autoset_capacitance": True,
+        "refine_ridge": True,
+    },
+}
+
+SCAN_ENGINES = {
+    "frequency": FrequencyScanEngine,
+    "bias": BiasScanEngine,
+    "hf": HFScanEngine,
+    "lifetime": LTScanEngine,
+    "capacitance": CapacitanceScanEngine,
+    "pulsing": PulsingSweepEngine,
+    "map": MapScanEngine,
+    "calibration": IncrementalCalibrationEngine,
+}
+
+
+class HeadlessObserver(ScanObserver):
+    """
+    Observer that reports the progress of a scan to the log instead of the
+    GUI
+    """
+
+    def __init__(self, name, interactive=False):
+        self.name = name
+        self.interactive = interactive
+        self.last_progress = -1
+
+    def update_progress(self, progress):
+        """
+        Log the progress in steps of 10 %
+        """
+        if int(progress) // 10 > self.last_progress // 10:
+            self.last_progress = int(progress)
+            cf.log_message(self.name + " scan at " + str(int(progress)) + " %")
+
+    def pause_measurement(self, status):
+        """
+        Ask the user on the command line if running interactively, otherwise
+        just continue
+        """
+        if not self.interactive:
+            return "break"
+
+        if status == "on":
+            text = "You can now insert the OLED"
+        else:
+            text = "You can now take out the OLED"
+        answer = input(text + " (press enter to continue, a to abort) ")
+
+        return "return" if answer.strip().lower() == "a" else "break"
+
+    def scan_finished(self):
+        cf.log_message(self.name + " scan finished")
+
+
+def load_recipe(file_path):
+    """
+    Load a recipe from a JSON or YAML file
+    """
+    with open(file_path) as recipe_file:
+        if os.path.splitext(file_path)[1].lower() in [".yaml", ".yml"]:
+            recipe = yaml.safe_load(recipe_file)
+        else:
+            recipe = json.load(recipe_file)
+
+    # Check the recipe before any hardware is touched
+    check_recipe(recipe)
+
+    return recipe
+
+
+def check_recipe(recipe):
+    """
+    Raise a ValueError for malformed recipes, unknown scan types, duplicate
+    names and devices or dependencies on scans that are not listed before (so
+    that a recipe can be queued completely) and log unknown parameters
+    """
+    if not isinstance(recipe, dict):
+        raise ValueError("The recipe has to be an object with a list of scans")
+    if not isinstance(recipe.get("scans"), list):
+        raise ValueError("The recipe needs a list of scans")
+    devices = recipe.get("devices", [{"device_number": 1}])
+    if not isinstance(devices, list) or not all(
+        isinstance(device, dict) for device in devices
+    ):
+        raise ValueError("The devices have to be a list of objects")
+
+    device_numbers = [device.get("device_number", 1) for device in devices]
+    if len(set(device_numbers)) != len(device_numbers):
+        raise ValueError("Every device number may only be listed once")
+
+    names = []
+    for i, scan in enumerate(recipe["scans"]):
+        if not isinstance(scan, dict) or "type" not in scan:
+            raise ValueError("Scan " + str(i) + " has to be an object with a type")
+        if not isinstance(scan.get("parameters", {}), dict):
+            raise ValueError("The parameters of scan " + str(i) + " are no object")
+        if not isinstance(scan.get("depends_on", []), list):
+            raise ValueError("depends_on of scan " + str(i) + " has to be a list")
+        name = scan.get("name", str(scan["type"]) + "_" + str(i))
+        if name in names:
+            raise ValueError("The scan name " + name + " is used more than once")
+        for dependency in scan.get("depends_on", []):
+            if dependency not in names:
+                raise ValueError(
+                    "Scan "
+                    + name
+                    + " depends on "
+                    + str(dependency)
+                    + " which is not a scan listed before it"
+                )
+        names.append(name)
+
+        if scan["type"] not in SCAN_ENGINES:
+            raise ValueError(
+                "Unknown scan type "
+                + str(scan["type"])
+                + ". Valid types are "
+                + ", ".join(SCAN_ENGINES.keys())
+            )
+        unknown_parameters = set(scan.get("parameters", {}).keys()) - set(
+            DEFAULT_PARAMETERS[scan["type"]].keys()
+        )
+        if unknown_parameters:
+            cf.log_message(
+                "Parameters "
+                + ", ".join(unknown_parameters)
+                + " are not standard parameters of the "
+                + scan["type"]
+                + " scan"
+            )
+
+
+def init_hardware():
+    """
+    Initialise the hardware with the addresses from the global settings
+    """
+    settings = cf.read_global_settings()
+
+    oscilloscope = RigolOscilloscope(settings["rigol_oscilloscope_address"])
+    cf.log_message("Rigol Oscilloscope successfully initialised")
+    source = KoradKD3305PSource(
+        settings["source_address"], settings["dc_field_conversion_factor"]
+    )
+    cf.log_message("Voltage source successfully initialised")
+    arduino = Arduino(settings["arduino_address"])
+    cf.log_message("Arduino successfully initialised")
+
+    return arduino, source, oscilloscope
+
+
+def create_engine(
+    job,
+    arduino,
+    source,
+    oscilloscope,
+    observer,
+    reuse_hardware=False,
+):
+    """
+    Create the engine for a job of the scheduler
+    """
+    if job.scan_type == "capacitance":
+        return CapacitanceScanEngine(
+            arduino,
+            source,
+            job.measurement_parameters,
+            job.setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+    elif job.scan_type == "calibration":
+        return IncrementalCalibrationEngine(
+            arduino,
+            source,
+            job.measurement_parameters,
+            job.setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+    elif job.scan_type == "pulsing":
+        return PulsingSweepEngine(
+            arduino,
+            source,
+            oscilloscope,
+            read_pulsing_file(job.measurement_parameters["pulsing_file"]),
+            job.measurement_parameters,
+            observer,
+            reuse_hardware,
+        )
+
+    return SCAN_ENGINES[job.scan_type](
+        arduino,
+        source,
+        oscilloscope,
+        job.measurement_parameters,
+        job.setup_parameters,
+        observer,
+        reuse_hardware,
+    )
+
+
+def queue_recipe(scheduler, recipe, prefix=""):
+    """
+    Add all scans of a recipe for all devices as jobs to the scheduler and
+    return them. Scans can have a name, a priority and a list of names of
+    scans of the same device they depend on. The prefix is added to all job
+    names (to queue the same recipe more than once).
+    """
+    jobs = []
+    setup = recipe.get("setup", {})
+    devices = recipe.get("devices", [{"device_number": 1}])
+
+    for device in devices:
+        setup_parameters = {
+            "folder_path": setup.get("folder_path", ""),
+            "batch_name": setup.get("batch_name", ""),
+            "device_number": device.get("device_number", 1),
+            "device_size": device.get(
+                "device_size", setup.get("device_size", [11.5, 3.5])
+            ),
+        }
+
+        # The engines just concatenate folder path and file name
+        if not setup_parameters["folder_path"].endswith("/"):
+            setup_parameters["folder_path"] += "/"
+
+        suffix = "_d" + str(setup_parameters["device_number"])
+
+        for i, scan in enumerate(recipe["scans"]):
+            measurement_parameters = copy.deepcopy(DEFAULT_PARAMETERS[scan["type"]])
+            measurement_parameters.update(scan.get("parameters", {}))
+
+            job = MeasurementJob(
+                scan["type"],
+                measurement_parameters,
+                setup_parameters,
+                priority=scan.get("priority", 0),
+                depends_on=[
+                    prefix + name + suffix for name in scan.get("depends_on", [])
+                ],
+                name=prefix + scan.get("name", scan["type"] + "_" + str(i)) + suffix,
+            )
+            jobs.append(scheduler.add_job(job))
+
+    return jobs
+
+
+def run_recipe(recipe, arduino, source, oscilloscope, interactive=False):
+    """
+    Execute all scans of a recipe for all devices
+    """
+
+    def change_device(setup_parameters):
+        if interactive:
+            input(
+                "Connect device "
+                + str(setup_parameters["device_number"])
+                + " and press enter to continue "
+            )
+        else:
+            cf.log_message(
+                "Measuring device " + str(setup_parameters["device_number"])
+            )
+
+    scheduler = JobScheduler(
+        arduino,
+        source,
+        oscilloscope,
+        create_engine,
+        lambda job: HeadlessObserver(job.name, interactive),
+        change_device,
+    )
+    queue_recipe(scheduler, recipe)
+    scheduler.run()
+
+    for job in scheduler.summary():
+        cf.log_message(job["name"] + ": " + job["state"])
+
+    return scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a measurement recipe without the GUI"
+    )
+    parser.add_argument("recipe", help="JSON or YAML file with the recipe")
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="run on the simulated hardware instead of the lab setup",
+    )
+    parser.add_argument(
+        "--interactive",
+        action="store_true",
+        help="ask on the command line before device changes and pauses",
+    )
+    parser.add_argument(
+        "--debug-log",
+        action="store_true",
+        help="write the high volume debug messages to " + cf.DEBUG_LOG_FILENAME,
+    )
+    args = parser.parse_args(argv)
+
+    recipe = load_recipe(args.recipe)
+    if args.simulate:
+        # Only import the simulator if needed
+        from simulated_hardware import simulated_hardware
+
+        arduino, source, oscilloscope = simulated_hardware()
+    else:
+        arduino, source, oscilloscope = init_hardware()
+
+    # Every instrument is run by its own I/O thread
+    arduino = InstrumentProxy(arduino, "arduino")
+    source = InstrumentProxy(source, "source")
+    oscilloscope = InstrumentProxy(oscilloscope, "oscilloscope")
+
+    try:
+        run_recipe(recipe, arduino, source, oscilloscope, args.interactive)
+    finally:
+        oscilloscope.close()
+        arduino.close()
+        source.close()
+        instrument_worker.stop_all()
+
+
+if __name__ == "__main__":
+    cf.setup_entry_point_logging()
+
+    sys.exit(main())
@@ -0,0 +1,474 @@
+"""
+Benchmark that runs the scans against the simulated hardware and reports how
+much time is spent in which phase of a measurement step (frequency set,
+capacitor switch, settling, source read, scope read, PID adjust, plot emit,
+save and the fixed sleeps of the engines). Since the source and scope are read
+at the same time and the pipeline threads plot and save while the next step
+is measured, phases overlap: the time spent in parallel is reported as
+overlap and only the wall-clock time not covered by any phase as other. The
+latency statistics of the instrument commands are included as well. The
+results are written as JSON so that they can be compared across commits:
+
+    python benchmark.py --output before.json
+    (change something)
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import datetime as dt
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import core_functions as cf
+from io_trace import IOTracer, trace_instruments
+from scan_engine import ScanObserver
+from simulated_hardware import SimulatedSetup, simulated_hardware
+
+from frequency_measurement import FrequencyScanEngine
+from bias_field_measurement import BiasScanEngine
+from hf_field_measurement import HFScanEngine
+from lifetime_measurement import LTScanEngine
+from capacitance_measurement import CapacitanceScanEngine
+
+# Methods that are timed and the phase they belong to
+INSTRUMENTED_METHODS = {
+    "arduino": {
+        "init_serial_connection": "initialisation",
+        "set_frequency": "frequency set",
+        "trigger_frequency_generation": "frequency set",
+        "set_capacitance": "capacitor switch",
+    },
+    "source": {
+        "set_voltage": "source set",
+        "set_current": "source set",
+        "set_magnetic_field": "source set",
+        "output": "source set",
+        "read_values": "source read",
+        "adjust_magnetic_field": "pid adjust",
+    },
+    "oscilloscope": {
+        "measure": "scope read",
+        "measure_vmax": "scope read",
+        "measure_set": "scope read",
+        "auto_scale": "scope read",
+        "get_data": "scope read",
+    },
+    "engine": {
+        "settle": "settling",
+        "save_data": "save",
+        "save_data_init": "save",
+        "save_data_osci": "save",
+        "save_resonance_data": "save",
+    },
+    "observer": {
+        "update_plot": "plot emit",
+        "update_progress": "plot emit",
+    },
+}
+
+# Phases that are timed on their own even if they are called within another
+# phase (everything else is attributed to the calling phase, e.g. the scope
+# reads of the PID adjustment)
+NESTED_PHASES = ["capacitor switch"]
+
+# Phase of the sleeps of the scan thread outside of any other phase (the fixed
+# waits of the engines, the settling time is timed as settling)
+SLEEP_PHASE = "sleep"
+
+# Small sweeps that run within reasonable time on the simulated hardware
+BENCHMARK_PARAMETERS = {
+    "frequency": {
+        "voltage": 5,
+        "current_compliance": 0.5,
+        "minimum_frequency": 140,
+        "maximum_frequency": 150,
+        "autoset_frequency_step": False,
+        "frequency_step": 2,
+        "frequency_settling_time": 0.2,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": False,
+        "dc_magnetic_field": 1.5,
+    },
+    "bias": {
+        "voltage": 5,
+        "current_compliance": 0.5,
+        "frequency": 145,
+        "minimum_dc_field": 0,
+        "maximum_dc_field": 3,
+        "dc_field_step": 0.5,
+        "bias_field_settling_time": 0.1,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": False,
+        "reverse_sweep": False,
+    },
+    "hf": {
+        "voltage_compliance": 5,
+        "dc_magnetic_field": 1.5,
+        "frequency": 145,
+        "minimum_hf_voltage": 2,
+        "maximum_hf_voltage": 5,
+        "hf_voltage_step": 1,
+        "hf_field_settling_time": 0.2,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": False,
+    },
+    "lifetime": {
+        "voltage_compliance": 12,
+        "dc_magnetic_field": 1.5,
+        "frequency": 145,
+        "hf_voltage": 5,
+        "total_time": 4,
+        "time_step": 1,
+        "autoset_capacitance": True,
+        "constant_magnetic_field_mode": False,
+    },
+    "capacitance": {
+        "voltage": 2,
+        "current_compliance": 1,
+        "minimum_frequency": 140,
+        "maximum_frequency": 150,
+        "frequency_step": 2,
+        "resonance_frequency_step": 1,
+        "frequency_margin": 3,
+        "frequency_settling_time": 0.1,
+    },
+}
+
+
+class PhaseTimer:
+    """
+    Measures the time spent in the phases of a scan by wrapping the methods
+    of the hardware, engine and observer objects
+    """
+
+    def __init__(self):
+        self.durations = {}
+        # Wall-clock intervals (start, end) of all timed calls
+        self.intervals = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def instrument(self, obj, methods):
+        """
+        Wrap the methods of an object (given as dict of method name and
+        phase). Since the wrappers are instance attributes, calls from within
+        the object (e.g. set_frequency calling set_capacitance) are timed as
+        well.
+        """
+        for method_name, phase in methods.items():
+            method = getattr(obj, method_name, None)
+            if method is None:
+                continue
+            setattr(obj, method_name, self.timed(method, phase))
+
+    def timed_sleep(self):
+        """
+        Patch of time.sleep that times the sleeps of the calling thread as
+        SLEEP_PHASE (sleeps of other threads and within other phases are not
+        timed separately)
+        """
+        sleep = time.sleep
+        timed_sleep = self.timed(sleep, SLEEP_PHASE)
+        thread = threading.get_ident()
+
+        def wrapper(seconds):
+            if threading.get_ident() != thread:
+                return sleep(seconds)
+            return timed_sleep(seconds)
+
+        return mock.patch("time.sleep", wrapper)
+
+    def timed(self, method, phase):
+        """
+        Return a wrapper that times a method
+        """
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stack = getattr(self.local, "stack", None)
+            if stack is None:
+                stack = self.local.stack = []
+
+            # Within another phase, only nested phases are timed separately
+            if stack and phase not in NESTED_PHASES:
+                return method(*args, **kwargs)
+
+            # Frame of phase, start time and time spent in nested phases
+            frame = [phase, time.perf_counter(), 0.0]
+            stack.append(frame)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stack.pop()
+                end = time.perf_counter()
+                duration = end - frame[1]
+                if stack:
+                    stack[-1][2] += duration
+                self.record(phase, duration - frame[2], frame[1], end)
+
+        return wrapper
+
+    def record(self, phase, duration, start, end):
+        with self.lock:
+            self.durations.setdefault(phase, []).append(duration)
+            self.intervals.append((start, end))
+
+    def covered_time(self):
+        """
+        Wall-clock time during which at least one phase was running (the
+        union of the intervals)
+        """
+        covered = 0.0
+        covered_until = None
+        for start, end in sorted(self.intervals):
+            if covered_until is None or start > covered_until:
+                covered += end - start
+                covered_until = end
+            elif end > covered_until:
+                covered += end - covered_until
+                covered_until = end
+        return covered
+
+    def summary(self, total_time, steps):
+        """
+        Total, count and mean per phase, the time during which phases ran in
+        parallel (overlap, counted more than once in the phases) and the
+        wall-clock time that was not attributed to any phase (other)
+        """
+        phases = {}
+        for phase, durations in sorted(self.durations.items()):
+            phases[phase] = {
+                "total": sum(durations),
+                "count": len(durations),
+                "mean": sum(durations) / len(durations),
+                "per_step": sum(durations) / steps if steps else None,
+            }
+
+        attributed_time = sum(phase["total"] for phase in phases.values())
+        covered_time = self.covered_time()
+        for phase, duration in [
+            ("overlap", attributed_time - covered_time),
+            ("other", total_time - covered_time),
+        ]:
+            phases[phase] = {
+                "total": duration,
+                "count": 1,
+                "mean": duration,
+                "per_step": duration / steps if steps else None,
+            }
+
+        return phases
+
+
+class BenchmarkObserver(ScanObserver):
+    """
+    Observer that converts the data like the Qt signals of the GUI do and
+    counts the measurement steps
+    """
+
+    def __init__(self):
+        self.steps = 0
+
+    def update_plot(self, *data):
+        self.steps += 1
+        return [list(x) if hasattr(x, "__iter__") else x for x in data]
+
+
+def create_engine(scan_type, arduino, source, oscilloscope, parameters, folder_path):
+    """
+    Create the engine of a scan that saves to the given folder
+    """
+    setup_parameters = {
+        "folder_path": folder_path,
+        "batch_name": "benchmark",
+        "device_number": 1,
+        "device_size": [11.5, 3.5],
+    }
+
+    if scan_type == "capacitance":
+        return CapacitanceScanEngine(arduino, source, parameters, setup_parameters)
+
+    engines = {
+        "frequency": FrequencyScanEngine,
+        "bias": BiasScanEngine,
+        "hf": HFScanEngine,
+        "lifetime": LTScanEngine,
+    }
+    return engines[scan_type](
+        arduino, source, oscilloscope, parameters, setup_parameters
+    )
+
+
+def benchmark_scan(scan_type, parameters=None, time_scale=1.0, seed=0):
+    """
+    Run one scan on freshly initialised simulated hardware and return the
+    time per phase
+    """
+    if parameters is None:
+        parameters = BENCHMARK_PARAMETERS[scan_type]
+
+    arduino, source, oscilloscope = simulated_hardware(
+        SimulatedSetup(seed=seed), time_scale=time_scale
+    )
+
+    timer = PhaseTimer()
+    timer.instrument(arduino, INSTRUMENTED_METHODS["arduino"])
+    timer.instrument(source, INSTRUMENTED_METHODS["source"])
+    timer.instrument(oscilloscope, INSTRUMENTED_METHODS["oscilloscope"])
+
+    io_tracer = IOTracer()
+    trace_instruments(arduino, source, oscilloscope, io_tracer)
+
+    observer = BenchmarkObserver()
+    timer.instrument(observer, INSTRUMENTED_METHODS["observer"])
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        start_time = time.perf_counter()
+        engine = create_engine(
+            scan_type,
+            arduino,
+            source,
+            oscilloscope,
+            dict(parameters),
+            folder_path + "/",
+        )
+        engine.observer = observer
+        timer.instrument(engine, INSTRUMENTED_METHODS["engine"])
+        with timer.timed_sleep():
+            engine.run()
+        total_time = time.perf_counter() - start_time
+    io_tracer.flush()
+
+    return {
+        "parameters": parameters,
+        "steps": observer.steps,
+        "total_time": total_time,
+        "time_per_step": total_time / observer.steps if observer.steps else None,
+        "phases": timer.summary(total_time, observer.steps),
+        "io": io_tracer.statistics(),
+    }
+
+
+def git_commit():
+    """
+    Return the commit the benchmark runs on (if available)
+    """
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(scan_types, time_scale=1.0):
+    """
+    Benchmark a list of scans
+    """
+    results = {
+        "commit": git_commit(),
+        "date": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "time_scale": time_scale,
+        "scans": {},
+    }
+
+    for scan_type in scan_types:
+        cf.log_message("Benchmarking " + scan_type + " scan")
+        results["scans"][scan_type] = benchmark_scan(scan_type, time_scale=time_scale)
+
+    return results
+
+
+def format_results(results, reference=None):
+    """
+    Format the results as table (with the change relative to a reference)
+    """
+    lines = []
+    for scan_type, scan in results["scans"].items():
+        reference_scan = None
+        if reference is not None:
+            reference_scan = reference["scans"].get(scan_type)
+
+        lines.append(
+            scan_type
+            + " scan: "
+            + str(scan["steps"])
+            + " steps in "
+            + "{0:.2f}".format(scan["total_time"])
+            + " s"
+        )
+
+        rows = list(scan["phases"].items()) + [
+            ("total", {"total": scan["total_time"]})
+        ]
+        for phase, values in rows:
+            line = "    {0:<18}{1:>9.3f} s".format(phase, values["total"])
+            if reference_scan is not None:
+                if phase == "total":
+                    reference_total = reference_scan["total_time"]
+                else:
+                    reference_total = (
+                        reference_scan["phases"].get(phase, {}).get("total")
+                    )
+                if reference_total:
+                    line += "{0:>+9.3f} s ({1:+.1f} %)".format(
+                        values["total"] - reference_total,
+                        (values["total"] - reference_total) / reference_total * 100,
+                    )
+            lines.append(line)
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scans on the simulated hardware"
+    )
+    parser.add_argument(
+        "--scans",
+        nargs="+",
+        default=["frequency", "bias", "hf"],
+        choices=list(BENCHMARK_PARAMETERS.keys()),
+        help="scans to benchmark",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file of an earlier benchmark")
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=1.0,
+        help="factor for the simulated command latencies",
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.scans, args.time_scale)
+
+    reference = None
+    if args.compare is not None:
+        with open(args.compare) as json_file:
+            reference = json.load(json_file)
+
+    print(format_results(results, reference))
+
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
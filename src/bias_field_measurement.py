@@ -12,11 +12,14 @@ import math
 
 import core_functions as cf
 import physics_functions as pf
+from scan_engine import ScanEngine, ScanObserver
+from sweep_pipeline import SweepPipeline
+from optimisation import OptimumSearch
 
 from simple_pid import PID
 
 
-class BiasScan(QtCore.QThread):
+class BiasScan(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -37,36 +40,104 @@ class BiasScan(QtCore.QThread):
         parent=None,
     ):
         super(BiasScan, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.measurement_parameters = measurement_parameters
-        self.setup_parameters = setup_parameters
-
-        self.global_parameters = cf.read_global_settings()
-
         # Connect signal to the updater from the parent class
         self.update_bias_plot_signal.connect(parent.update_bias_plot)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
 
+        # The scan itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = BiasScanEngine(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer=self,
+        )
+
+    def run(self):
+        """
+        Run the bias scan engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, current, bias_field, me_voltage, hf_magnetic_field):
+        """
+        Forward the measured data to the main window
+        """
+        self.update_bias_plot_signal.emit(
+            current, bias_field, me_voltage, hf_magnetic_field
+        )
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def scan_finished(self):
+        """
+        Release the start button once the scan is done
+        """
+        self.parent.bw_start_measurement_pushButton.setChecked(False)
+
+
+class BiasScanEngine(ScanEngine):
+    """
+    Engine that does a dc bias field sweep independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(BiasScanEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+
         # Define dataframe to store data in
         self.df_data = pd.DataFrame(
             columns=["current", "bias_field", "me_voltage", "hf_magnetic_field"]
         )
 
-        self.is_killed = False
+        # In the search mode, only the fields needed to find the optimum bias
+        # field are measured (to the resolution of the dc field step)
+        if measurement_parameters.get("search_optimum", False):
+            self.search = OptimumSearch(
+                measurement_parameters["minimum_dc_field"],
+                measurement_parameters["maximum_dc_field"],
+                measurement_parameters["dc_field_step"],
+            )
+        else:
+            self.search = None
 
         # If
         if measurement_parameters["constant_magnetic_field_mode"]:
-            pid_parameters = np.array(
-                self.global_parameters["pid_parameters"].split(","), dtype=float
-            )
+            pid_parameters = np.array(self.global_parameters.pid_parameters)
             self.source.start_constant_magnetic_field_mode(
                 pid_parameters,
                 self.measurement_parameters["current_compliance"],
@@ -102,10 +173,6 @@ class BiasScan(QtCore.QThread):
         # self.measurement_parameters["maximum_frequency"],
         # self.measurement_parameters["frequency_step"],
         # )
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Measure time elapsed
         start_time = time.time()
 
@@ -122,7 +189,7 @@ class BiasScan(QtCore.QThread):
             )
 
         # Set frequency
-        self.arduino.set_frequency(
+        self.set_frequency(
             self.measurement_parameters["frequency"],
             self.measurement_parameters["autoset_capacitance"],
         )
@@ -163,90 +230,153 @@ class BiasScan(QtCore.QThread):
         )
 
         # In the future set this as an external variable
-        if self.measurement_parameters["reverse_sweep"]:
+        if self.measurement_parameters["reverse_sweep"] and self.search is None:
             dc_field_list = np.append(dc_field_list, np.flip(dc_field_list))
 
         self.source.output(True, channel=1)
 
         time.sleep(1)
 
-        for dc_field in dc_field_list:
-            # for frequency in self.df_data["frequency"]:
-            # cf.log_message("Frequency set to " + str(frequency) + " kHz")
-
-            # Set DC Field
-            self.source.set_magnetic_field(dc_field, channel=1)
-
-            # Measure the voltage and current (and possibly parameters on the osci)
-            me_voltage = float(self.oscilloscope.measure_vmax(channel=2))
+        with SweepPipeline(self.process_step, self.record_step) as pipeline:
+            if self.search is not None:
+                # Only measure the fields needed to find the optimum
+                self.number_of_steps = self.search.expected_points()
+                while not self.search.finished:
+                    dc_field = self.search.next_point()
+                    me_voltage = self.measure_step(i, dc_field, pipeline)
+                    if self.is_killed:
+                        self.stop()
+                        return
+                    self.search.add(dc_field, me_voltage)
+                    i += 1
+                cf.log_message(self.search.summary())
+            else:
+                self.number_of_steps = len(dc_field_list)
+                for dc_field in dc_field_list:
+                    self.measure_step(i, dc_field, pipeline)
+                    if self.is_killed:
+                        self.stop()
+                        return
+
+                    # Increase iterator
+                    i += 1
+
+                    if not self.adaptive_settling:
+                        self.settle(
+                            self.measurement_parameters["bias_field_settling_time"]
+                        )
+
+            self.source.output(False, channel=1)
+            self.source.output(False, channel=2)
+        self.log_settling()
+        self.save_data()
+        self.reset_frequency()
+        self.arduino.trigger_frequency_generation(False)
 
-            # Calculate the magnetic field using a pickup coil
-            magnetic_field = (
-                pf.calculate_magnetic_field_from_Vind(
-                    self.global_parameters["pickup_coil_windings"],
-                    self.global_parameters["pickup_coil_radius"] * 1e-3,
-                    float(self.oscilloscope.measure_vmax(1)),
-                    self.measurement_parameters["frequency"] * 1e3,
-                )
-                * 1e3
-            )
+        # self.parent.oscilloscope_thread.pause = False
 
-            # Set the variables in the dataframe
-            (
-                source_voltage,
-                self.df_data.loc[i, "current"],
-                dc_magnetic_field,
-            ) = self.source.read_values(channel=1)
-            self.df_data.loc[i, "bias_field"] = dc_magnetic_field
-            self.df_data.loc[i, "me_voltage"] = me_voltage
-            # Directly in mW/mm^2
-            # in mT
-            self.df_data.loc[i, "hf_magnetic_field"] = magnetic_field
-
-            # Update progress bar
-            self.update_progress_bar.emit(
-                "value", int((i + 1) / len(dc_field_list) * 100)
-            )
+        self.observer.scan_finished()
 
-            self.update_bias_plot_signal.emit(
-                self.df_data["current"],
-                self.df_data["bias_field"],
-                self.df_data["me_voltage"],
-                self.df_data["hf_magnetic_field"],
+    def measure_step(self, i, dc_field, pipeline):
+        """
+        Set a dc field and measure the ME voltage and the hf magnetic field
+        """
+        # for frequency in self.df_data["frequency"]:
+        # cf.log_message("Frequency set to " + str(frequency) + " kHz")
+
+        # Set DC Field
+        self.source.set_magnetic_field(dc_field, channel=1)
+
+        # The adaptive settling follows the current through the bias coil. In
+        # the search mode the field jumps between the points, so it has to
+        # settle before every reading.
+        settle_first = self.adaptive_settling or self.search is not None
+        if settle_first:
+            self.settle(
+                self.measurement_parameters["bias_field_settling_time"],
+                probe=lambda: self.read_source(1)[1],
             )
 
-            time.sleep(self.measurement_parameters["bias_field_settling_time"])
+        # Measure the voltages on the osci and the voltage and current of
+        # the source at the same time
+        (me_voltage, pickup_voltage), source_values = self.read_step(
+            oscilloscope=lambda: self.read_oscilloscope(
+                self.measurement_parameters["frequency"]
+            ),
+            source=lambda: self.read_source(1),
+        )
 
-            if self.is_killed:
-                # Close the connection to the spectrometer
-                self.source.output(False, channel=2)
-                self.source.set_voltage(1, channel=2)
-                self.source.output(False, channel=1)
-                self.arduino.set_frequency(1000, True)
-                self.arduino.trigger_frequency_generation(False)
-                # self.parent.oscilloscope_thread.pause = False
-                self.quit()
-                return
+        # The magnetic field is calculated and the data is stored and
+        # plotted by the pipeline while the next field settles
+        pipeline.put(i, (me_voltage, pickup_voltage, source_values))
 
-            # Increase iterator
-            i += 1
+        if not settle_first:
+            self.settle(self.measurement_parameters["bias_field_settling_time"])
 
-            time.sleep(self.measurement_parameters["bias_field_settling_time"])
+        return me_voltage
 
-        self.source.output(False, channel=1)
+    def stop(self):
+        """
+        Switch everything off if the scan was killed
+        """
+        # Close the connection to the spectrometer
         self.source.output(False, channel=2)
-        self.save_data()
-        self.parent.bw_start_measurement_pushButton.setChecked(False)
+        self.source.set_voltage(1, channel=2)
+        self.source.output(False, channel=1)
         self.arduino.set_frequency(1000, True)
         self.arduino.trigger_frequency_generation(False)
-
         # self.parent.oscilloscope_thread.pause = False
 
-    def kill(self):
+    def process_step(self, i, raw):
         """
-        Kill thread while running
+        Calculate the magnetic field of a step using the pickup coil
+        """
+        me_voltage, pickup_voltage, source_values = raw
+        magnetic_field = (
+            pf.calculate_magnetic_field_from_Vind(
+                self.global_parameters["pickup_coil_windings"],
+                self.global_parameters["pickup_coil_radius"] * 1e-3,
+                pickup_voltage,
+                self.measurement_parameters["frequency"] * 1e3,
+            )
+            * 1e3
+        )
+
+        return me_voltage, magnetic_field, source_values
+
+    def record_step(self, i, values):
+        """
+        Store a step in the dataframe and plot it
         """
-        self.is_killed = True
+        me_voltage, magnetic_field, source_values = values
+
+        # Set the variables in the dataframe
+        (
+            source_voltage,
+            self.df_data.loc[i, "current"],
+            dc_magnetic_field,
+        ) = source_values
+        self.df_data.loc[i, "bias_field"] = dc_magnetic_field
+        self.df_data.loc[i, "me_voltage"] = me_voltage
+        # Directly in mW/mm^2
+        # in mT
+        self.df_data.loc[i, "hf_magnetic_field"] = magnetic_field
+
+        # Update progress bar
+        self.observer.update_progress(
+            min(int((i + 1) / self.number_of_steps * 100), 100)
+        )
+
+        # The fields of a search are not measured in order
+        df_data = self.df_data
+        if self.search is not None:
+            df_data = df_data.sort_values("bias_field")
+        self.observer.update_plot(
+            df_data["current"],
+            df_data["bias_field"],
+            df_data["me_voltage"],
+            df_data["hf_magnetic_field"],
+        )
 
     def save_data(self):
         """
@@ -266,6 +396,14 @@ class BiasScan(QtCore.QThread):
             int(len(optimum_bias_list) / 2)
         ]
 
+        if self.search is not None:
+            # Interpolated optimum and the current of the closest measured field
+            self.df_data = self.df_data.sort_values("bias_field", ignore_index=True)
+            optimum_bias_field = round(self.search.optimum, 3)
+            optimum_bias_current = self.df_data["current"].iloc[
+                np.argmin(np.abs(self.df_data["bias_field"] - optimum_bias_field))
+            ]
+
         # Define Header
         line01 = (
             "Optimum Bias Field:   "
@@ -315,6 +453,10 @@ class BiasScan(QtCore.QThread):
             + str(self.measurement_parameters["dc_field_step"])
             + " kHz \t"
         )
+        if self.search is not None:
+            line04 += (
+                "Optimum Search:   " + str(len(self.search)) + " measurements \t"
+            )
         line05 = "### Measurement data ###"
         line06 = "DC Current\t DC Field\t ME Voltage\t HF Magnetic Field"
         line07 = "A\t mT\t V\t mT\n"
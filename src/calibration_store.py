@@ -0,0 +1,134 @@
+"""
+Versioned store of the capacitor calibration. Every version is a complete
+resonance table in the format of the _resonances.csv files (so it can be
+selected as calibration file in the settings) and is never changed once
+written. An index keeps the date, the parent version, a note and the
+capacitances that were measured for every version:
+
+    store = CalibrationStore("C:/data/calibration_store")
+    calibration = store.load()
+    version = store.commit(merge(calibration, measured), note="Daily check")
+"""
+
+import datetime as dt
+import json
+import os
+
+import pandas as pd
+
+import core_functions as cf
+
+# Column order of the resonance files (see save_resonance_data)
+COLUMNS = ["capacitance", "resonance_frequency", "maximum_current", "quality_factor"]
+
+
+def read_resonance_file(file_path):
+    """
+    Read a resonance table saved by the capacitance scan
+    """
+    return pd.read_csv(file_path, sep="\t", skiprows=5, names=COLUMNS)
+
+
+def merge(calibration, measured):
+    """
+    Replace the capacitances of the calibration that were measured again and
+    add the new ones (failed fits with a resonance frequency of 0 are ignored)
+    """
+    measured = measured.loc[measured["resonance_frequency"].astype(float) > 0]
+    merged = pd.concat(
+        [
+            calibration.loc[~calibration["capacitance"].isin(measured["capacitance"])],
+            measured[COLUMNS],
+        ],
+        ignore_index=True,
+    )
+    return merged.sort_values("capacitance", ascending=False, ignore_index=True)
+
+
+class CalibrationStore:
+    """
+    Directory with the numbered versions of the calibration and their index
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+
+    def versions(self):
+        """
+        Entries of the index, oldest first
+        """
+        if not os.path.isfile(self.index_path):
+            return []
+
+        with open(self.index_path) as json_file:
+            return json.load(json_file)["versions"]
+
+    def path(self, version=None):
+        """
+        File of a version (the latest by default)
+        """
+        versions = self.versions()
+        if len(versions) == 0:
+            return None
+        if version is None:
+            return os.path.join(self.directory, versions[-1]["file"])
+
+        for entry in versions:
+            if entry["version"] == version:
+                return os.path.join(self.directory, entry["file"])
+        raise KeyError("Calibration version " + str(version) + " does not exist")
+
+    def load(self, version=None):
+        """
+        Calibration table of a version (the latest by default, None if the
+        store is empty)
+        """
+        file_path = self.path(version)
+        if file_path is None:
+            return None
+        return read_resonance_file(file_path)
+
+    def commit(self, calibration, note="", measured=None):
+        """
+        Save a calibration table as new version and return its number
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        versions = self.versions()
+        version = versions[-1]["version"] + 1 if len(versions) > 0 else 1
+        file_name = "calibration_v" + f"{version:03d}" + ".csv"
+
+        header_lines = [
+            "Calibration Version:   " + str(version),
+            "Date:   " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "### Measurement data ###",
+            "Capacitance\t Resonance Frequency\t Maximum Current\t Quality Factor",
+            "pF\t kHz\t A\t\n",
+        ]
+        # save_file does not overwrite an existing file but adds a number, so
+        # the index has to name the file that was actually written
+        file_path = cf.save_file(
+            calibration[COLUMNS],
+            os.path.join(self.directory, file_name),
+            header_lines,
+            return_file_path=True,
+        )
+        file_name = os.path.basename(file_path)
+
+        versions.append(
+            {
+                "version": version,
+                "file": file_name,
+                "date": dt.datetime.now().isoformat(timespec="seconds"),
+                "parent": versions[-1]["version"] if len(versions) > 0 else None,
+                "note": note,
+                "measured": [] if measured is None else [float(c) for c in measured],
+            }
+        )
+        with open(self.index_path, "w") as json_file:
+            json.dump({"versions": versions}, json_file, indent=4)
+
+        cf.log_message(
+            "Calibration version " + str(version) + " saved to " + self.directory
+        )
+        return version
@@ -7,11 +7,14 @@ import pandas as pd
 
 import core_functions as cf
 from physics_functions import ResonanceFit, calculate_resonance_frequency
+from scan_engine import ScanEngine, ScanObserver
+from sweep_pipeline import SweepPipeline
+import relay_ordering
 
 import matplotlib as mpl
 
 
-class CapacitanceScan(QtCore.QThread):
+class CapacitanceScan(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -32,24 +35,93 @@ class CapacitanceScan(QtCore.QThread):
         parent=None,
     ):
         super(CapacitanceScan, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        # self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.measurement_parameters = measurement_parameters
-        self.setup_parameters = setup_parameters
-
         # Connect signal to the updater from the parent class
         self.update_spectrum_signal.connect(parent.update_capacitance_spectrum)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
 
+        # The scan itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = CapacitanceScanEngine(
+            arduino,
+            source,
+            measurement_parameters,
+            setup_parameters,
+            observer=self,
+        )
+
+    def run(self):
+        """
+        Run the capacitance scan engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        # Clear axis before the measurement
+        self.parent.capw_ax.cla()
+        self.parent.capw_ax.set_ylabel("Current (A)")
+        self.parent.capw_ax.set_xlabel("Frequency (kHz)")
+        self.parent.capw_ax.grid(True)
+        self.parent.capw_ax.axhline(linewidth=1, color="black")
+        self.parent.capw_ax.axvline(linewidth=1, color="black")
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, frequency, current, limits, label, first_bool, color, fit):
+        """
+        Forward the measured data to the main window
+        """
+        self.update_spectrum_signal.emit(
+            frequency, current, limits, label, first_bool, color, fit
+        )
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def scan_finished(self):
+        """
+        Release the start button once the scan is done
+        """
+        self.parent.capw_start_measurement_pushButton.setChecked(False)
+
+
+class CapacitanceScanEngine(ScanEngine):
+    """
+    Engine that does the capacitance calibration independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(CapacitanceScanEngine, self).__init__(
+            arduino,
+            source,
+            None,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+
         # Read global paramters
-        self.global_settings = cf.read_global_settings()
+        self.global_settings = self.global_parameters
 
         self.df_data = pd.DataFrame(columns=["frequency", "voltage", "current"])
         self.df_resonance_fit = pd.DataFrame(
@@ -60,31 +132,35 @@ class CapacitanceScan(QtCore.QThread):
                 "quality_factor",
             ]
         )
-        self.is_killed = False
 
     def run(self):
         """
         Class that does a frequency sweep
         """
-
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Set voltage and current (they shall remain constant over the entire sweep)
         self.source.set_voltage(self.measurement_parameters["voltage"], channel=2)
         self.source.set_current(
             self.measurement_parameters["current_compliance"], channel=2
         )
 
-        # Clear axis before the measurement
-        self.parent.capw_ax.cla()
-        self.parent.capw_ax.set_ylabel("Current (A)")
-        self.parent.capw_ax.set_xlabel("Frequency (kHz)")
-        self.parent.capw_ax.grid(True)
-        self.parent.capw_ax.axhline(linewidth=1, color="black")
-        self.parent.capw_ax.axvline(linewidth=1, color="black")
+        if not self.scan_capacitances(self.select_capacitances()):
+            return
+
+        self.arduino.trigger_frequency_generation(False)
+        self.source.output(False, channel=2)
+        self.log_settling()
+        self.save_resonance_data()
+        self.arduino.set_capacitance(self.arduino.base_capacitance)
+        # self.parent.setup_thread.pause = False
+        # self.parent.oscilloscope_thread.pause = False
 
+        self.observer.scan_finished()
+
+    def select_capacitances(self):
+        """
+        Capacitor combinations (rows of all_capacitances_df) with the closest
+        resonance frequencies to the steps of the frequency range
+        """
         # Make sure to choose closest resonance frequencies to a given step size
         available_caps = pd.DataFrame(
             columns=["constituents", "arduino_pins", "sum", "resonance_frequency"]
@@ -107,13 +183,36 @@ class CapacitanceScan(QtCore.QThread):
                 [available_caps, pd.DataFrame([temp_series])], ignore_index=True
             )
 
+        return available_caps
+
+    def predict_resonance(self, capacitance):
+        """
+        Resonance frequency (kHz) around which a capacitance is measured. It is
+        calculated from inductance and set capacitance. It is recommended to
+        provide an effective inductance from experimental parameters in the
+        settings to obtain good results
+        """
+        return np.round(
+            calculate_resonance_frequency(
+                capacitance * 1e-12, self.global_settings["coil_inductance"] * 1e-3
+            )
+            / 1e3,
+            1,
+        )
+
+    def scan_capacitances(self, available_caps):
+        """
+        Measure the resonances of the capacitor combinations. The fits are
+        stored in df_resonance_fit (in the order of available_caps). Returns
+        False if the scan was killed.
+        """
         # First check the given minimum and maximum value for the capacitance
         selected_available_cap = available_caps["sum"].to_numpy()
 
         # Sort out that only the closest to a step size are taken
 
         # Set a new color for the plot
-        cmap = mpl.cm.get_cmap("viridis", np.size(selected_available_cap))
+        cmap = mpl.colormaps["viridis"].resampled(np.size(selected_available_cap))
         device_color = np.array(
             [mpl.colors.rgb2hex(cmap(i)) for i in range(cmap.N)], dtype=object
         )
@@ -125,8 +224,28 @@ class CapacitanceScan(QtCore.QThread):
         # Helper variable for correct plotting
         first_bool = True
 
+        # Set the combinations in the order that switches the fewest relays
+        # (the colors and the saved resonances keep the frequency order)
+        start = 0
+        if getattr(self.arduino, "cap_states", None) is not None:
+            start = relay_ordering.state_mask(
+                self.arduino.arduino_pins, self.arduino.cap_states
+            )
+        masks = [
+            relay_ordering.pin_mask(pins) for pins in available_caps["arduino_pins"]
+        ]
+        scan_order = relay_ordering.order_combinations(masks, start)
+        cf.log_message(
+            "Capacitor combinations ordered to switch "
+            + str(relay_ordering.switching_count(masks, scan_order, start))
+            + " relays instead of "
+            + str(relay_ordering.switching_count(masks, range(len(masks)), start))
+        )
+
         # Sweep over all selected capacitances
-        for capacitance in selected_available_cap:
+        for index in scan_order:
+            capacitance = selected_available_cap[index]
+
             # Now set the capacitance
             self.arduino.set_capacitance(capacitance)
             self.source.output(True, channel=2)
@@ -139,17 +258,8 @@ class CapacitanceScan(QtCore.QThread):
             i = 0
 
             # Sweep over all frequencies within a range around the predicted
-            # resonance frequency. It is calculated from inductance and set
-            # capacitance. It is recommended to provide an effective inductance
-            # from experimental parameters in the settings to obtain good
-            # results
-            predicted_resonance_frequency = np.round(
-                calculate_resonance_frequency(
-                    capacitance * 1e-12, self.global_settings["coil_inductance"] * 1e-3
-                )
-                / 1e3,
-                1,
-            )
+            # resonance frequency
+            predicted_resonance_frequency = self.predict_resonance(capacitance)
 
             min_frequency = (
                 predicted_resonance_frequency
@@ -167,90 +277,74 @@ class CapacitanceScan(QtCore.QThread):
             )
             self.arduino.trigger_frequency_generation(True)
 
-            # frequency = self.measurement_parameters["minimum_frequency"]
-            for frequency in frequencies:
-                # while frequency <= self.measurement_parameters["maximum_frequency"]:
-                # for frequency in self.df_data["frequency"]:
-                # cf.log_message("Frequency set to " + str(frequency) + " kHz")
-
-                # Set frequency
-                self.arduino.set_frequency(frequency)
-
-                # Wait a bit
-                time.sleep(self.measurement_parameters["frequency_settling_time"])
-
-                # Measure the voltage and current (and posssibly paramters on the osci)
-                voltage, current = self.source.read_values(channel=2)
-
-                # Now measure Vpp from channel one on the oscilloscope
-                # vpp = float(self.oscilloscope.measure_vpp())
-
-                # Set the variables in the dataframe
-                self.df_data.loc[i, "voltage"] = voltage
-                self.df_data.loc[i, "current"] = current
-                self.df_data.loc[i, "frequency"] = frequency
-                # self.df_data.loc[i, "vpp"] = vpp
-
-                # Update progress bar
-                self.update_progress_bar.emit(
-                    "value",
-                    int(
-                        (color_counter + (i + 1) / len(frequencies))
-                        / len(selected_available_cap)
-                        * 100
-                    ),
-                )
-
-                # print(color_counter)
-                # print(i)
-                # print(len(self.df_data["frequency"]))
-                # print(len(selected_available_cap))
-
-                self.update_spectrum_signal.emit(
-                    self.df_data["frequency"],
-                    self.df_data["current"],
-                    [
-                        self.measurement_parameters["minimum_frequency"]
-                        - self.measurement_parameters["frequency_margin"],
-                        self.measurement_parameters["maximum_frequency"]
-                        + self.measurement_parameters["frequency_margin"],
-                    ],
-                    str(capacitance) + " pF",
-                    first_bool,
-                    device_color[color_counter],
-                    False
-                    # self.df_data["vpp"],
-                )
-
-                # Now compute the slope to adjust the step hight on the fly
-                # if i > 0:
-                #     slope = abs(
-                #         (
-                #             self.df_data.loc[i, "current"]
-                #             - self.df_data.loc[i - 1, "current"]
-                #         )
-                #         / (
-                #             self.df_data.loc[i, "frequency"]
-                #             - self.df_data.loc[i - 1, "frequency"]
-                #         )
-                #     )
-
-                # frequency = frequency + self.measurement_parameters["frequency_step"]
-
-                i += 1
-                first_bool = False
-
-                if self.is_killed:
-                    # Close the connection to the spectrometer
-                    self.source.output(False, channel=2)
-                    self.source.set_voltage(5, channel=2)
-                    self.arduino.trigger_frequency_generation(False)
-                    # Save all resonance data you have
-                    self.save_resonance_data()
-                    self.quit()
-                    return
-
-            self.arduino.trigger_frequency_generation(True)
+            # The storing and plotting of the steps (no processing needed)
+            with SweepPipeline(lambda i, raw: raw, self.record_step) as pipeline:
+                # frequency = self.measurement_parameters["minimum_frequency"]
+                for frequency in frequencies:
+                    # while frequency <= self.measurement_parameters["maximum_frequency"]:
+                    # for frequency in self.df_data["frequency"]:
+                    # cf.log_message("Frequency set to " + str(frequency) + " kHz")
+
+                    # Set frequency
+                    self.arduino.set_frequency(frequency)
+
+                    # Wait a bit (or until the current is stable in the adaptive
+                    # settling mode)
+                    self.settle(
+                        self.measurement_parameters["frequency_settling_time"],
+                        probe=lambda: self.read_source(2)[1],
+                    )
+
+                    # Measure the voltage and current (and posssibly paramters on the osci)
+                    voltage, current = self.read_source(2)
+
+                    # The data is stored and plotted by the pipeline while the next
+                    # frequency settles
+                    pipeline.put(
+                        i,
+                        (
+                            frequency,
+                            voltage,
+                            current,
+                            (
+                                capacitance,
+                                color_counter,
+                                len(frequencies),
+                                len(selected_available_cap),
+                                first_bool,
+                                device_color[index],
+                            ),
+                        ),
+                    )
+
+                    # Now compute the slope to adjust the step hight on the fly
+                    # if i > 0:
+                    #     slope = abs(
+                    #         (
+                    #             self.df_data.loc[i, "current"]
+                    #             - self.df_data.loc[i - 1, "current"]
+                    #         )
+                    #         / (
+                    #             self.df_data.loc[i, "frequency"]
+                    #             - self.df_data.loc[i - 1, "frequency"]
+                    #         )
+                    #     )
+
+                    # frequency = frequency + self.measurement_parameters["frequency_step"]
+
+                    i += 1
+                    first_bool = False
+
+                    if self.is_killed:
+                        # Close the connection to the spectrometer
+                        self.source.output(False, channel=2)
+                        self.source.set_voltage(5, channel=2)
+                        self.arduino.trigger_frequency_generation(False)
+                        # Save all resonance data you have
+                        self.save_resonance_data()
+                        return False
+
+                self.arduino.trigger_frequency_generation(True)
             # self.hf_source.output(False)
             self.save_data(str(capacitance) + "pF")
 
@@ -270,14 +364,12 @@ class CapacitanceScan(QtCore.QThread):
                     self.df_data["current"].to_numpy(),
                 )
 
-                self.df_resonance_fit.loc[color_counter, "capacitance"] = capacitance
-                self.df_resonance_fit.loc[color_counter, "resonance_frequency"] = popt[
-                    0
-                ]
-                self.df_resonance_fit.loc[
-                    color_counter, "maximum_current"
-                ] = self.df_data["current"].max()
-                self.df_resonance_fit.loc[color_counter, "quality_factor"] = popt[1]
+                self.df_resonance_fit.loc[index, "capacitance"] = capacitance
+                self.df_resonance_fit.loc[index, "resonance_frequency"] = popt[0]
+                self.df_resonance_fit.loc[index, "maximum_current"] = self.df_data[
+                    "current"
+                ].max()
+                self.df_resonance_fit.loc[index, "quality_factor"] = popt[1]
 
                 # Extend the plotted range
                 x_fit = np.linspace(
@@ -287,7 +379,7 @@ class CapacitanceScan(QtCore.QThread):
                 )
 
                 # Plot Fit
-                self.update_spectrum_signal.emit(
+                self.observer.update_plot(
                     x_fit,
                     fit_class.func(x_fit, *popt),
                     [
@@ -298,33 +390,66 @@ class CapacitanceScan(QtCore.QThread):
                     ],
                     str(capacitance) + "pF fit",
                     first_bool,
-                    device_color[color_counter],
+                    device_color[index],
                     True
                     # self.df_data["vpp"],
                 )
             except:
-                self.df_resonance_fit.loc[color_counter, "capacitance"] = capacitance
-                self.df_resonance_fit.loc[color_counter, "resonance_frequency"] = 0
-                self.df_resonance_fit.loc[
-                    color_counter, "maximum_current"
-                ] = self.df_data["current"].max()
-                self.df_resonance_fit.loc[color_counter, "quality_factor"] = 0
+                self.df_resonance_fit.loc[index, "capacitance"] = capacitance
+                self.df_resonance_fit.loc[index, "resonance_frequency"] = 0
+                self.df_resonance_fit.loc[index, "maximum_current"] = self.df_data[
+                    "current"
+                ].max()
+                self.df_resonance_fit.loc[index, "quality_factor"] = 0
 
             color_counter += 1
 
-        self.arduino.trigger_frequency_generation(False)
-        self.source.output(False, channel=2)
-        self.save_resonance_data()
-        self.parent.capw_start_measurement_pushButton.setChecked(False)
-        self.arduino.set_capacitance(self.arduino.base_capacitance)
-        # self.parent.setup_thread.pause = False
-        # self.parent.oscilloscope_thread.pause = False
+        return True
 
-    def kill(self):
+    def record_step(self, i, raw):
         """
-        Kill thread while running
+        Store a step in the dataframe and plot it
         """
-        self.is_killed = True
+        frequency, voltage, current, plot_parameters = raw
+        (
+            capacitance,
+            color_counter,
+            number_of_frequencies,
+            number_of_capacitances,
+            first_bool,
+            color,
+        ) = plot_parameters
+
+        # Set the variables in the dataframe
+        self.df_data.loc[i, "voltage"] = voltage
+        self.df_data.loc[i, "current"] = current
+        self.df_data.loc[i, "frequency"] = frequency
+        # self.df_data.loc[i, "vpp"] = vpp
+
+        # Update progress bar
+        self.observer.update_progress(
+            int(
+                (color_counter + (i + 1) / number_of_frequencies)
+                / number_of_capacitances
+                * 100
+            ),
+        )
+
+        self.observer.update_plot(
+            self.df_data["frequency"],
+            self.df_data["current"],
+            [
+                self.measurement_parameters["minimum_frequency"]
+                - self.measurement_parameters["frequency_margin"],
+                self.measurement_parameters["maximum_frequency"]
+                + self.measurement_parameters["frequency_margin"],
+            ],
+            str(capacitance) + " pF",
+            first_bool,
+            color,
+            False
+            # self.df_data["vpp"],
+        )
 
     def save_data(self, suffix):
         """
@@ -431,6 +556,7 @@ class CapacitanceScan(QtCore.QThread):
             + "_resonances"
             + ".csv"
         )
+        self.df_resonance_fit = self.df_resonance_fit.sort_index()
         cf.save_file(self.df_resonance_fit, file_path, header_lines)
         print(self.df_resonance_fit)
         cf.log_message("Resonance frequencies saved")
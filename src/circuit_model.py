@@ -0,0 +1,187 @@
+"""
+Model of the resonance circuit to predict the resonance frequency and quality
+factor of any capacitor combination from a few calibrated ones. The coil has
+an effective inductance L, the circuit a parasitic capacitance C0 and every
+relay channel i adds a parasitic capacitance Ci when it is closed, so that
+
+    1 / (2 pi f0)^2 = L * (C + C0 + sum_i s_i Ci)
+
+with the nominal capacitance C and the relay states s_i. This is linear in L,
+L*C0 and L*Ci and is fitted by vectorised linear least squares. The relay
+parasitics are regularised towards zero, so that a handful of calibrated
+points (fewer than relay channels) is sufficient. With the series resistance
+R, the quality factor is
+
+    Q = sqrt(L / (C + C0 + sum_i s_i Ci)) / R
+
+    model = CircuitModel.fit(capacitances, resonance_frequencies, relays)
+    model.resonance_frequency(all_capacitances, all_relays)
+"""
+
+import numpy as np
+
+# Weight of the regularisation of the relay parasitics (squared fraction of
+# the capacitance that a parasitic may add per squared relative error)
+REGULARISATION = 1e-2
+
+
+def relay_states(pin_lists, arduino_pins):
+    """
+    Boolean matrix with a row per combination (list of closed pins) and a
+    column per relay channel (in the order of arduino_pins)
+    """
+    arduino_pins = np.asarray(arduino_pins, dtype=int)
+    return np.array(
+        [np.isin(arduino_pins, np.asarray(pins, dtype=int)) for pins in pin_lists],
+        dtype=bool,
+    ).reshape(len(pin_lists), len(arduino_pins))
+
+
+class CircuitModel:
+    """
+    Effective inductance (mH), parasitic capacitances (pF) and series
+    resistance (Ohm) of the circuit
+    """
+
+    def __init__(
+        self,
+        inductance,
+        parasitic_capacitance=0.0,
+        relay_capacitances=None,
+        resistance=None,
+    ):
+        self.inductance = inductance
+        self.parasitic_capacitance = parasitic_capacitance
+        self.relay_capacitances = (
+            None if relay_capacitances is None else np.asarray(relay_capacitances)
+        )
+        self.resistance = resistance
+
+    @classmethod
+    def fit(
+        cls,
+        capacitances,
+        resonance_frequencies,
+        relays=None,
+        quality_factors=None,
+        regularisation=REGULARISATION,
+    ):
+        """
+        Fit the model to capacitances (pF) and their resonance frequencies
+        (kHz). The relay parasitics are only fitted if the relay states (see
+        relay_states) and the resistance only if quality factors are given.
+        """
+        capacitances = np.asarray(capacitances, dtype=float) * 1e-12
+        resonance_frequencies = np.asarray(resonance_frequencies, dtype=float) * 1e3
+        if len(capacitances) < 2:
+            raise ValueError("At least two calibrated capacitances are needed")
+
+        # Columns of the linear system: L, L * C0 and L * Ci. Every row is
+        # divided by its value, so that the relative errors are minimised.
+        y = 1 / (2 * np.pi * resonance_frequencies) ** 2
+        design = np.column_stack([capacitances, np.ones(len(capacitances))])
+        if relays is not None:
+            relays = np.asarray(relays, dtype=float)
+            design = np.column_stack([design, relays])
+        design = design / y[:, np.newaxis]
+        target = np.ones(len(y))
+
+        # The relay parasitics are pulled towards zero by additional rows
+        # (relative to the mean value, like the other rows)
+        if relays is not None:
+            penalty = np.zeros((relays.shape[1], design.shape[1]))
+            penalty[:, 2:] = np.sqrt(regularisation) / np.mean(y) * np.eye(
+                relays.shape[1]
+            )
+            design = np.vstack([design, penalty])
+            target = np.concatenate([target, np.zeros(relays.shape[1])])
+
+        # Scale the columns for a well conditioned system
+        scale = np.linalg.norm(design, axis=0)
+        solution, *_ = np.linalg.lstsq(design / scale, target, rcond=None)
+        solution = solution / scale
+
+        inductance = solution[0]
+        model = cls(
+            inductance * 1e3,
+            solution[1] / inductance * 1e12,
+            None if relays is None else solution[2:] / inductance * 1e12,
+        )
+
+        if quality_factors is not None:
+            # 1 / Q = R * sqrt(C / L) is linear in R
+            quality_factors = np.asarray(quality_factors, dtype=float)
+            valid = quality_factors > 0
+            x = np.sqrt(
+                model.total_capacitance(
+                    capacitances[valid] * 1e12,
+                    None if relays is None else relays[valid],
+                )
+                * 1e-12
+                / inductance
+            )
+            if np.any(valid):
+                model.resistance = np.sum(x / quality_factors[valid]) / np.sum(x**2)
+
+        return model
+
+    def total_capacitance(self, capacitances, relays=None):
+        """
+        Capacitance (pF) including the parasitics
+        """
+        capacitances = np.asarray(capacitances, dtype=float)
+        total = capacitances + self.parasitic_capacitance
+        if relays is not None and self.relay_capacitances is not None:
+            total = total + np.asarray(relays, dtype=float) @ self.relay_capacitances
+        return total
+
+    def resonance_frequency(self, capacitances, relays=None):
+        """
+        Predicted resonance frequency (kHz) of capacitances (pF)
+        """
+        return (
+            1
+            / (
+                2
+                * np.pi
+                * np.sqrt(
+                    self.inductance
+                    * 1e-3
+                    * self.total_capacitance(capacitances, relays)
+                    * 1e-12
+                )
+            )
+            / 1e3
+        )
+
+    def quality_factor(self, capacitances, relays=None):
+        """
+        Predicted quality factor (nan if the resistance was not fitted)
+        """
+        if self.resistance is None:
+            return np.full(np.shape(capacitances), np.nan)
+
+        return (
+            np.sqrt(
+                self.inductance
+                * 1e-3
+                / (self.total_capacitance(capacitances, relays) * 1e-12)
+            )
+            / self.resistance
+        )
+
+    def __repr__(self):
+        description = (
+            "CircuitModel(inductance="
+            + str(round(self.inductance, 5))
+            + " mH, parasitic_capacitance="
+            + str(round(self.parasitic_capacitance, 1))
+            + " pF"
+        )
+        if self.relay_capacitances is not None:
+            description += ", relay_capacitances=" + str(
+                np.round(self.relay_capacitances, 1).tolist()
+            )
+        if self.resistance is not None:
+            description += ", resistance=" + str(round(self.resistance, 2)) + " Ohm"
+        return description + ")"
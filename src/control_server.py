@@ -0,0 +1,557 @@
+"""
+Control server to run the setup from other machines without the GUI. Jobs are
+queued in the format of the batch runner recipes and run one after another by
+the job scheduler, while the results of every job can be streamed live. The
+server only listens on localhost unless another host is given (use a token
+then). Usage:
+
+    python control_server.py [--simulate] [--host 127.0.0.1] [--port 8765]
+                             [--token secret] [--debug-log]
+
+Endpoints (JSON, the token is sent as "Authorization: Bearer <token>"):
+
+    GET  /status               running job and state of the instruments
+    GET  /scans                scan types and their standard parameters
+    GET  /jobs                 state of all jobs
+    POST /jobs                 queue a recipe, returns the names of the jobs
+    GET  /jobs/<name>          state of a job
+    GET  /jobs/<name>/stream   results of a job as newline delimited JSON
+    POST /kill                 kill the running job and cancel the queued ones
+
+For example
+
+    curl -X POST localhost:8765/jobs -d '{"scans": [{"type": "frequency"}]}'
+    curl -N localhost:8765/jobs/r1_frequency_0_d1/stream
+
+Every line of a stream is a frame with the new rows of the data of the job
+("rows", with their index, "reset" means the data starts anew), its progress
+("progress") or its final state ("end"). A stream starts with a reset frame of
+the rows that were measured before it was opened. The scans never wait for a
+client: if a client falls behind, its queued frames are replaced by a reset
+frame with all rows (and the number of dropped frames), so no row is lost.
+"""
+
+import argparse
+import collections
+import hmac
+import http.server
+import itertools
+import json
+import sys
+import threading
+
+import numpy as np
+
+import core_functions as cf
+import instrument_worker
+import telemetry
+from batch_runner import (
+    DEFAULT_PARAMETERS,
+    SCAN_ENGINES,
+    HeadlessObserver,
+    check_recipe,
+    create_engine,
+    init_hardware,
+    queue_recipe,
+)
+from instrument_worker import InstrumentProxy
+from scheduler import JobScheduler
+
+# States of jobs that will not change anymore
+FINAL_STATES = ["done", "failed", "killed", "skipped"]
+
+# Frames that are replaced by a snapshot if a client falls behind
+DATA_FRAMES = ["rows", "progress", "plot"]
+
+
+class ResultStream:
+    """
+    Queue of the frames of a job for one client. Putting never blocks: if the
+    client falls behind by the maximum number of frames, the queued data is
+    dropped and replaced by a snapshot of all rows (a reset frame) that is
+    taken when the client reads again. A new stream starts with a snapshot.
+    """
+
+    def __init__(self, snapshot, lock, maximum_frames=1000):
+        # Function that returns the reset frame and the lock under which the
+        # frames are published (the snapshot is consistent with the frames)
+        self.snapshot = snapshot
+        self.lock = lock
+        self.maximum_frames = maximum_frames
+
+        self.frames = collections.deque()
+        self.dropped = 0
+        self.needs_reset = True
+        self.condition = threading.Condition()
+
+    def put(self, frame):
+        with self.condition:
+            if frame["type"] in DATA_FRAMES:
+                if self.needs_reset:
+                    # Covered by the snapshot
+                    return
+                if len(self.frames) >= self.maximum_frames:
+                    kept = [
+                        queued for queued in self.frames if queued["type"] == "end"
+                    ]
+                    self.dropped += len(self.frames) - len(kept) + 1
+                    self.frames = collections.deque(kept)
+                    self.needs_reset = True
+                    self.condition.notify()
+                    return
+            self.frames.append(frame)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """
+        Next frame (None if there was none within the timeout)
+        """
+        with self.condition:
+            if not self.needs_reset and not self.frames:
+                self.condition.wait(timeout)
+            if not self.needs_reset:
+                return self.frames.popleft() if self.frames else None
+
+        # No frame can be published while the snapshot is taken
+        with self.lock:
+            frame = self.snapshot()
+            with self.condition:
+                self.needs_reset = False
+                frame["dropped"] = self.dropped
+                self.dropped = 0
+        return frame
+
+
+class StreamingObserver(HeadlessObserver):
+    """
+    Observer that logs like the batch runner and publishes the new data of
+    the job to the streams of the server
+    """
+
+    def __init__(self, job, control):
+        super(StreamingObserver, self).__init__(job.name)
+        self.job = job
+        self.control = control
+
+        # Data frame of the engine and its rows that were already sent
+        self.data = None
+        self.sent_rows = set()
+
+    def update_plot(self, *data):
+        df_data = getattr(self.job.engine, "df_data", None)
+        if df_data is None:
+            # Engines without data frame: send what they plot
+            self.control.publish(
+                self.job.name, {"type": "plot", "data": to_json_values(data)}
+            )
+            return
+
+        # The rows that were sent and the frames have to be consistent for
+        # the snapshots of the streams
+        with self.control.streams_lock:
+            # Engines that start a new data frame (e.g. for every capacitance)
+            reset = df_data is not self.data
+            if reset:
+                self.data = df_data
+                self.sent_rows = set()
+
+            new_rows = df_data.loc[
+                ~df_data.index.isin(list(self.sent_rows))
+                & df_data.notna().any(axis=1).to_numpy()
+            ]
+            if len(new_rows) == 0 and not reset:
+                return
+            self.sent_rows.update(new_rows.index)
+            self.control.publish(self.job.name, rows_frame(new_rows, reset))
+
+    def sent_data(self):
+        """
+        Rows that were sent so far
+        """
+        if self.data is None:
+            return None
+        return self.data.loc[self.data.index.isin(list(self.sent_rows))]
+
+    def update_progress(self, progress):
+        super(StreamingObserver, self).update_progress(progress)
+        self.control.progress[self.job.name] = progress
+        self.control.publish(self.job.name, {"type": "progress", "progress": progress})
+
+
+def rows_frame(rows, reset):
+    """
+    Frame with rows of a data frame (None for no rows)
+    """
+    if rows is None:
+        return {"type": "rows", "reset": reset, "index": [], "rows": []}
+    return {
+        "type": "rows",
+        "reset": reset,
+        "index": rows.index.tolist(),
+        "rows": json.loads(rows.to_json(orient="records")),
+    }
+
+
+def to_json_values(data):
+    """
+    Plot data as lists (arrays) or numbers
+    """
+    values = []
+    for element in data:
+        try:
+            values.append(json.loads(json.dumps(np.asarray(element).tolist())))
+        except (TypeError, ValueError):
+            values.append(str(element))
+    return values
+
+
+class ControlServer:
+    """
+    Job queue of the server with a thread that runs the queued jobs on the
+    hardware and the result streams of the clients
+    """
+
+    def __init__(self, arduino, source, oscilloscope):
+        self.arduino = arduino
+        self.source = source
+        self.oscilloscope = oscilloscope
+
+        self.scheduler = JobScheduler(
+            arduino,
+            source,
+            oscilloscope,
+            create_engine,
+            self.create_observer,
+            lambda setup_parameters: cf.log_message(
+                "Measuring device " + str(setup_parameters["device_number"])
+            ),
+        )
+
+        # Notified whenever jobs are queued or the server stops
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.recipe_numbers = itertools.count(1)
+
+        # Job name: list of result streams, observer and progress in percent
+        self.streams = collections.defaultdict(list)
+        self.streams_lock = threading.RLock()
+        self.observers = {}
+        self.progress = {}
+
+        self.worker = threading.Thread(target=self.run_jobs, daemon=True)
+        self.worker.start()
+
+    def create_observer(self, job):
+        self.observers[job.name] = StreamingObserver(job, self)
+        return self.observers[job.name]
+
+    def run_jobs(self):
+        """
+        Run the queued jobs whenever there are some (until stopped)
+        """
+        while True:
+            with self.condition:
+                while not self.stopped and self.scheduler.next_job() is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+            try:
+                self.scheduler.run()
+            except Exception as e:
+                cf.log_message("Running the queued jobs failed")
+                cf.log_message(e)
+            self.end_streams()
+
+    def queue(self, recipe):
+        """
+        Queue all jobs of a recipe and return their names
+        """
+        check_recipe(recipe)
+        with self.condition:
+            jobs = queue_recipe(
+                self.scheduler, recipe, "r" + str(next(self.recipe_numbers)) + "_"
+            )
+            self.condition.notify()
+
+        cf.log_message("Queued jobs " + ", ".join(job.name for job in jobs))
+        return [job.name for job in jobs]
+
+    def kill(self):
+        """
+        Cancel the queued jobs and kill the running one
+        """
+        with self.condition:
+            for job in self.scheduler.jobs:
+                if job.state == "queued":
+                    job.state = "killed"
+            self.scheduler.kill()
+        self.end_streams()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.kill()
+
+    def job_state(self, job):
+        return {
+            "name": job.name,
+            "scan_type": job.scan_type,
+            "device_number": job.setup_parameters["device_number"],
+            "priority": job.priority,
+            "depends_on": job.depends_on,
+            "state": job.state,
+            "progress": self.progress.get(job.name, 0),
+            "start_time": job.start_time,
+            "end_time": job.end_time,
+        }
+
+    def status(self):
+        """
+        Running job and the state of the instruments (the source readings are
+        cached by its telemetry broker)
+        """
+        current_job = self.scheduler.current_job
+        try:
+            readings = telemetry.broker(self.source).poll()
+        except Exception as e:
+            cf.log_message(e)
+            readings = {}
+
+        return {
+            "current_job": None if current_job is None else current_job.name,
+            "queued_jobs": sum(job.state == "queued" for job in self.scheduler.jobs),
+            "arduino": {
+                "frequency": self.arduino.frequency,
+                "frequency_on": self.arduino.frequency_on,
+                "capacitance": getattr(self.arduino, "real_capacitance", None),
+            },
+            "source": {
+                "channel_" + str(channel): (
+                    None if values is None else to_json_values(values)
+                )
+                for channel, values in readings.items()
+            },
+        }
+
+    def subscribe(self, job):
+        """
+        New result stream of a job that starts with the data sent so far
+        """
+        with self.streams_lock:
+            stream = ResultStream(lambda: self.snapshot(job), self.streams_lock)
+            self.streams[job.name].append(stream)
+        return stream
+
+    def snapshot(self, job):
+        """
+        Reset frame with all rows of a job that were sent so far
+        """
+        with self.streams_lock:
+            observer = self.observers.get(job.name)
+            return rows_frame(
+                None if observer is None else observer.sent_data(), True
+            )
+
+    def unsubscribe(self, name, stream):
+        with self.streams_lock:
+            if stream in self.streams[name]:
+                self.streams[name].remove(stream)
+
+    def publish(self, name, frame):
+        with self.streams_lock:
+            streams = list(self.streams.get(name, []))
+        for stream in streams:
+            stream.put(frame)
+
+    def end_streams(self):
+        """
+        Send the final state to the streams of jobs that ended
+        """
+        for job in self.scheduler.jobs:
+            if job.state in FINAL_STATES:
+                with self.streams_lock:
+                    streams = self.streams.pop(job.name, [])
+                for stream in streams:
+                    stream.put({"type": "end", "state": job.state})
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler of the requests to the control server (server.control)
+    """
+
+    def log_message(self, format, *args):
+        cf.log_debug(self.address_string() + " " + format % args)
+
+    def authorised(self):
+        token = self.server.token
+        if token is None:
+            return True
+        return hmac.compare_digest(
+            self.headers.get("Authorization", ""), "Bearer " + token
+        )
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if not self.authorised():
+            return self.send_json({"error": "Unauthorised"}, 401)
+
+        control = self.server.control
+        path = self.path.split("?")[0].rstrip("/").split("/")[1:]
+        if path == ["status"]:
+            self.send_json(control.status())
+        elif path == ["scans"]:
+            self.send_json(
+                {scan_type: DEFAULT_PARAMETERS[scan_type] for scan_type in SCAN_ENGINES}
+            )
+        elif path == ["jobs"]:
+            self.send_json([control.job_state(job) for job in control.scheduler.jobs])
+        elif len(path) in [2, 3] and path[0] == "jobs":
+            try:
+                job = control.scheduler.get_job(path[1])
+            except StopIteration:
+                return self.send_json({"error": "Unknown job " + path[1]}, 404)
+            if len(path) == 2:
+                self.send_json(control.job_state(job))
+            elif path[2] == "stream":
+                self.stream(job)
+            else:
+                self.send_json({"error": "Unknown path"}, 404)
+        else:
+            self.send_json({"error": "Unknown path"}, 404)
+
+    def do_POST(self):
+        if not self.authorised():
+            return self.send_json({"error": "Unauthorised"}, 401)
+
+        control = self.server.control
+        path = self.path.split("?")[0].rstrip("/").split("/")[1:]
+        if path == ["jobs"]:
+            try:
+                self.send_json({"jobs": control.queue(self.read_json())}, 201)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json({"error": str(e)}, 400)
+        elif path == ["kill"]:
+            control.kill()
+            self.send_json({"killed": True})
+        else:
+            self.send_json({"error": "Unknown path"}, 404)
+
+    def stream(self, job):
+        """
+        Send the frames of a job until it ended or the client disconnected
+        """
+        control = self.server.control
+        stream = control.subscribe(job)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        try:
+            while True:
+                frame = stream.get(timeout=1)
+                if frame is None:
+                    # Jobs that already ended do not send an end frame anymore
+                    if job.state in FINAL_STATES:
+                        frame = {"type": "end", "state": job.state}
+                    else:
+                        continue
+                self.wfile.write(json.dumps(dict(frame, job=job.name)).encode() + b"\n")
+                self.wfile.flush()
+                if frame["type"] == "end":
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            cf.log_message("Client of the stream of " + job.name + " disconnected")
+        finally:
+            control.unsubscribe(job.name, stream)
+
+
+def serve(arduino, source, oscilloscope, host="127.0.0.1", port=8765, token=None):
+    """
+    Run the control server until interrupted (blocking)
+    """
+    if host not in ["127.0.0.1", "localhost", "::1"] and token is None:
+        cf.log_message(
+            "The control server listens on " + host + " without token, everyone "
+            "in the network can control the setup"
+        )
+
+    control = ControlServer(arduino, source, oscilloscope)
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.control = control
+    server.token = token
+
+    cf.log_message("Control server listening on " + host + ":" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        cf.log_message("Control server stopped")
+    finally:
+        server.server_close()
+        control.stop()
+        control.worker.join(timeout=60)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Control the setup over the network without the GUI"
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="run on the simulated hardware instead of the lab setup",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on (0.0.0.0 for all interfaces)",
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", help="token the clients have to send")
+    parser.add_argument(
+        "--debug-log",
+        action="store_true",
+        help="write the high volume debug messages to " + cf.DEBUG_LOG_FILENAME,
+    )
+    args = parser.parse_args(argv)
+
+    if args.simulate:
+        # Only import the simulator if needed
+        from simulated_hardware import simulated_hardware
+
+        arduino, source, oscilloscope = simulated_hardware()
+    else:
+        arduino, source, oscilloscope = init_hardware()
+
+    # Every instrument is run by its own I/O thread
+    arduino = InstrumentProxy(arduino, "arduino")
+    source = InstrumentProxy(source, "source")
+    oscilloscope = InstrumentProxy(oscilloscope, "oscilloscope")
+
+    try:
+        serve(arduino, source, oscilloscope, args.host, args.port, args.token)
+    finally:
+        oscilloscope.close()
+        arduino.close()
+        source.close()
+        instrument_worker.stop_all()
+
+
+if __name__ == "__main__":
+    cf.setup_entry_point_logging()
+
+    sys.exit(main())
@@ -1,52 +1,200 @@
+import atexit
 import logging
+import logging.handlers
 import json
 import os.path
+import queue
+import sys
+import threading
 from pathlib import Path
 
 import numpy as np
 
+import settings_service
 
-def log_message(message):
+
+# Format of the log file
+LOG_FORMAT = (
+    "%(asctime)s - [%(levelname)s] -"
+    " (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
+)
+LOG_DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+# Identical messages within this time (s) are only logged once
+LOG_REPEAT_INTERVAL = 1.0
+
+# High volume messages (e.g. every serial reply) that are only written to their
+# own file if enabled in setup_logging
+debug_logger = logging.getLogger("debug")
+debug_logger.propagate = False
+debug_logger.disabled = True
+
+# Queue listeners that write the log records (one per channel)
+log_listeners = []
+
+# Log files of the entry points (main window, batch runner and control server)
+LOG_FILENAME = "./usr/log.out"
+DEBUG_LOG_FILENAME = "./usr/debug.out"
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formatter that appends the structured fields of a record (see
+    log_message) as key=value pairs
+    """
+
+    def format(self, record):
+        message = super(StructuredFormatter, self).format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " | " + ", ".join(
+                str(key) + "=" + str(value) for key, value in fields.items()
+            )
+        return message
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Drop messages that repeat an identical message within the interval (s).
+    The next message that is logged again reports how often it was dropped.
+    """
+
+    def __init__(self, interval=LOG_REPEAT_INTERVAL, maximum_entries=1000):
+        super(RepeatFilter, self).__init__()
+        self.interval = interval
+        self.maximum_entries = maximum_entries
+        self.last_logged = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.levelno, str(record.msg))
+        with self.lock:
+            last_time, suppressed = self.last_logged.get(key, (None, 0))
+            if last_time is not None and record.created - last_time < self.interval:
+                self.last_logged[key] = (last_time, suppressed + 1)
+                return False
+
+            if len(self.last_logged) >= self.maximum_entries:
+                self.last_logged.clear()
+            self.last_logged[key] = (record.created, 0)
+
+        if suppressed > 0:
+            record.msg = (
+                str(record.msg) + " (repeated " + str(suppressed) + " times before)"
+            )
+        return True
+
+
+def start_log_listener(logger, handlers):
+    """
+    Let the logger only put its records into a queue that is emptied by a
+    listener thread, so that logging never blocks on console or disk writes
+    """
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RepeatFilter())
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    log_listeners.append(listener)
+
+
+def setup_logging(log_file=None, debug_file=None, max_bytes=1000000):
+    """
+    Route the log messages through a queue to the console and, if given, a
+    rotating log file. The debug channel is only written (to debug_file) if a
+    file is given. Can be called again to change the files.
+    """
+    stop_logging()
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(StructuredFormatter("%(message)s"))
+    handlers = [console_handler]
+    if log_file is not None:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=3
+        )
+        file_handler.setFormatter(StructuredFormatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        handlers.append(file_handler)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    start_log_listener(root_logger, handlers)
+
+    if debug_file is not None:
+        debug_handler = logging.handlers.RotatingFileHandler(
+            debug_file, maxBytes=max_bytes, backupCount=3
+        )
+        debug_handler.setFormatter(StructuredFormatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        debug_logger.setLevel(logging.DEBUG)
+        debug_logger.disabled = False
+        start_log_listener(debug_logger, [debug_handler])
+
+
+def setup_entry_point_logging(
+    debug=None, log_file=LOG_FILENAME, debug_file=DEBUG_LOG_FILENAME
+):
+    """
+    Logging of a program entry point: the log file is rotated after it reached
+    1 MB and the debug channel is only written if debug is set (by default if
+    the program was started with --debug-log)
+    """
+    if debug is None:
+        debug = "--debug-log" in sys.argv
+    setup_logging(log_file, debug_file if debug else None)
+
+
+def stop_logging():
+    """
+    Write all queued records and remove the queue handlers
+    """
+    while log_listeners:
+        log_listeners.pop().stop()
+
+    for logger in [logging.getLogger(), debug_logger]:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+    debug_logger.disabled = True
+
+
+# Write the records that are still queued when the program ends
+atexit.register(stop_logging)
+
+
+def log_message(message, **fields):
     """
     Function that manages the logging, in the sense that everything is
     directly logged into statusbar and the log file at once as well as
     printed to the console instead of having to call multiple functions.
+    Keyword arguments are logged as structured fields (key=value).
     """
     # self.statusbar.showMessage(message, 10000000)
-    logging.info(message)
-    print(message)
+    if not log_listeners:
+        # Only log to the console if logging was not set up
+        setup_logging()
+    logging.info(message, extra={"fields": fields}, stacklevel=2)
+
+
+def log_debug(message, **fields):
+    """
+    Log to the debug channel (does nothing unless it was enabled in
+    setup_logging, so it can be used in hot loops)
+    """
+    if not debug_logger.disabled:
+        debug_logger.debug(message, extra={"fields": fields}, stacklevel=2)
 
 
 def read_global_settings():
     """
     Read in global settings from file. The file can be changed using the
-    settings window.
-    """
-    # Load from file to fill the lines
-    with open(
-        os.path.join(Path(__file__).parent.parent, "usr", "global_settings.json")
-    ) as json_file:
-        data = json.load(json_file)
-    try:
-        settings = data["overwrite"]
-
-        # Update statusbar
-        log_message("Global Settings Read from File")
-    except:
-        settings = data["default"]
-
-        # Update statusbar
-        log_message("Default device parameters taken")
-
-    for key in settings[0].keys():
-        try:
-            settings[0][key] = float(settings[0][key])
-        except:
-            # This here does not have to be typecast explicitly but the except
-            # statement needs something
-            settings[0][key] = str(settings[0][key])
-
-    return settings[0]
+    settings window. The file is only parsed again if it changed (see
+    settings_service), the returned dict is a copy that can be changed.
+    """
+    return settings_service.service.settings().copy()
 
 
 # def read_global_settings():
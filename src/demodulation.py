@@ -0,0 +1,102 @@
+"""
+Software lock-in for the waveforms of the oscilloscope. Instead of taking the
+maximum of a smoothed trace, the trace is projected onto the drive frequency
+(a single bin DFT, as in the Goertzel algorithm). Only the component at the
+drive frequency contributes, so the broadband noise that the maximum picks up
+is averaged out over all samples of the trace:
+
+    time_data, me_trace = oscilloscope.get_data("CHAN2")
+    _, pickup_trace = oscilloscope.get_data("CHAN1")
+    result = demodulate(
+        time_data, me_trace, arduino.frequency * 1e3, reference=pickup_trace
+    )
+    result.amplitude, result.phase, result.noise
+
+The phase is given relative to the pickup coil signal (the magnetic field),
+so that results of different traces can be compared and subtracted.
+"""
+
+import collections
+
+import numpy as np
+
+LockInResult = collections.namedtuple(
+    "LockInResult", ["amplitude", "phase", "noise", "phasor"]
+)
+LockInResult.__doc__ = """
+Amplitude (peak, same unit as the trace), phase (rad, relative to the
+reference), noise (standard deviation of the amplitude) and the complex
+phasor of the demodulated component
+"""
+
+
+def whole_periods(time_data, frequency):
+    """
+    Number of samples that span the largest whole number of periods of the
+    frequency (all samples if the trace is shorter than one period)
+    """
+    time_data = np.asarray(time_data, dtype=float)
+    sampling_interval = (time_data[-1] - time_data[0]) / (len(time_data) - 1)
+    number_of_periods = np.floor(len(time_data) * sampling_interval * frequency)
+    if number_of_periods < 1:
+        return len(time_data)
+
+    return int(np.round(number_of_periods / frequency / sampling_interval))
+
+
+def project(time_data, traces, frequency):
+    """
+    Complex amplitude of the component of the traces (last axis) at the
+    frequency and the residual noise once mean and component are removed
+    """
+    traces = np.asarray(traces, dtype=float)
+    time_data = np.asarray(time_data, dtype=float)
+
+    # Cut the traces to whole periods, so that the offset and the harmonics do
+    # not leak into the bin of the drive frequency
+    n = whole_periods(time_data, frequency)
+    time_data = time_data[:n]
+    traces = traces[..., :n]
+
+    oscillator = np.exp(-2j * np.pi * frequency * (time_data - time_data[0]))
+    offsets = np.mean(traces, axis=-1, keepdims=True)
+    phasors = 2 / n * ((traces - offsets) @ oscillator)
+
+    residuals = (
+        traces
+        - offsets
+        - np.real(phasors[..., np.newaxis] * np.conj(oscillator))
+    )
+    noise = np.std(residuals, axis=-1) * np.sqrt(2 / n)
+
+    return phasors, noise
+
+
+def demodulate(time_data, traces, frequency, reference=None, harmonic=1):
+    """
+    Demodulate one trace or an array of traces (one per row) at the drive
+    frequency (Hz) or one of its harmonics. If the pickup coil trace is given
+    as reference, the phase is relative to the magnetic field.
+    """
+    frequency = harmonic * float(frequency)
+    phasors, noise = project(time_data, traces, frequency)
+
+    if reference is not None:
+        reference_phasors, _ = project(time_data, reference, frequency / harmonic)
+        phasors = phasors * np.exp(-1j * harmonic * np.angle(reference_phasors))
+
+    return LockInResult(np.abs(phasors), np.angle(phasors), noise, phasors)
+
+
+def subtract(result, background):
+    """
+    Subtract the demodulated background (e.g. the calibration without a
+    device) from a result. Both must be demodulated with the same reference.
+    """
+    phasors = result.phasor - background.phasor
+    return LockInResult(
+        np.abs(phasors),
+        np.angle(phasors),
+        np.sqrt(result.noise**2 + background.noise**2),
+        phasors,
+    )
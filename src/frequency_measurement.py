@@ -7,8 +7,11 @@ import pandas as pd
 
 import core_functions as cf
 import physics_functions as pf
+from scan_engine import ScanEngine, ScanObserver
+from sweep_pipeline import SweepPipeline
 
-class FrequencyScan(QtCore.QThread):
+
+class FrequencyScan(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -29,36 +32,91 @@ class FrequencyScan(QtCore.QThread):
         parent=None,
     ):
         super(FrequencyScan, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.measurement_parameters = measurement_parameters
-        self.setup_parameters = setup_parameters
-
-        self.global_parameters = cf.read_global_settings()
-
         # Connect signal to the updater from the parent class
         self.update_spectrum_signal.connect(parent.update_spectrum)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
 
+        # The scan itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = FrequencyScanEngine(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer=self,
+        )
+
+    def run(self):
+        """
+        Run the frequency scan engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, frequency, current, magnetic_field, vmax):
+        """
+        Forward the measured data to the main window
+        """
+        self.update_spectrum_signal.emit(frequency, current, magnetic_field, vmax)
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def scan_finished(self):
+        """
+        Release the start button once the scan is done
+        """
+        self.parent.specw_start_measurement_pushButton.setChecked(False)
+
+
+class FrequencyScanEngine(ScanEngine):
+    """
+    Engine that does a frequency sweep independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(FrequencyScanEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+
         # Define dataframe to store data in
         self.df_data = pd.DataFrame(
             columns=["frequency", "voltage", "current", "magnetic_field", "vmax"]
         )
 
-        self.is_killed = False
-
         # If
         if measurement_parameters["constant_magnetic_field_mode"]:
-            pid_parameters = np.array(
-                self.global_parameters["pid_parameters"].split(","), dtype=float
-            )
+            pid_parameters = np.array(self.global_parameters.pid_parameters)
             self.source.start_constant_magnetic_field_mode(
                 pid_parameters,
                 self.measurement_parameters["current_compliance"],
@@ -94,10 +152,6 @@ class FrequencyScan(QtCore.QThread):
         # self.measurement_parameters["maximum_frequency"],
         # self.measurement_parameters["frequency_step"],
         # )
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Measure time elapsed
         start_time = time.time()
 
@@ -122,148 +176,119 @@ class FrequencyScan(QtCore.QThread):
         i = 0
         minimal_step = False
         baseline = 0
-        frequency = self.measurement_parameters["minimum_frequency"]
-        while frequency <= self.measurement_parameters["maximum_frequency"]:
-            # for frequency in frequencies:
-            # for frequency in self.df_data["frequency"]:
-            # cf.log_message("Frequency set to " + str(frequency) + " kHz")
-
-            # Activate output only when frequency was set
-            if i == 0:
-                self.source.output(True, channel=2)
+        # Frequency and vmax of all steps to adjust the frequency step
+        measured_vmax = []
+        with SweepPipeline(self.process_step, self.record_step) as pipeline:
+            frequency = self.measurement_parameters["minimum_frequency"]
+            while frequency <= self.measurement_parameters["maximum_frequency"]:
+                # for frequency in frequencies:
+                # for frequency in self.df_data["frequency"]:
+                # cf.log_message("Frequency set to " + str(frequency) + " kHz")
+
+                # Activate output only when frequency was set
+                if i == 0:
+                    self.source.output(True, channel=2)
+                    time.sleep(0.5)
+
+                # Set frequency
+                self.arduino.set_frequency(
+                    frequency, self.measurement_parameters["autoset_capacitance"]
+                )
                 time.sleep(0.5)
 
-            # Set frequency
-            self.arduino.set_frequency(
-                frequency, self.measurement_parameters["autoset_capacitance"]
-            )
-            time.sleep(0.5)
+                self.arduino.trigger_frequency_generation(True)
+                time.sleep(0.5)
 
-            self.arduino.trigger_frequency_generation(True)
-            time.sleep(0.5)
+                # In constant magnetic field mode, regulate the voltage until a
+                # magnetic field is reached
+                if not self.measurement_parameters["constant_magnetic_field_mode"]:
+                    self.source.set_voltage(
+                        self.measurement_parameters["voltage"], channel=2
+                    )
 
-            # In constant magnetic field mode, regulate the voltage until a
-            # magnetic field is reached
-            if not self.measurement_parameters["constant_magnetic_field_mode"]:
-                self.source.set_voltage(
-                    self.measurement_parameters["voltage"], channel=2
-                )
+                else:
+                    # Adjust the magnetic field
+                    pid_voltage, elapsed_time = self.source.adjust_magnetic_field(
+                        self.global_parameters["pickup_coil_windings"],
+                        self.global_parameters["pickup_coil_radius"],
+                        frequency,
+                        self.oscilloscope,
+                        break_if_too_long=True,
+                        channel=2,
+                    )
 
-            else:
-                # Adjust the magnetic field
-                pid_voltage, elapsed_time = self.source.adjust_magnetic_field(
-                    self.global_parameters["pickup_coil_windings"],
-                    self.global_parameters["pickup_coil_radius"],
-                    frequency,
-                    self.oscilloscope,
-                    break_if_too_long=True,
-                    channel=2,
-                )
+                    # Return total adjustment time to let user know how long it took
+                    total_adjustment_time += elapsed_time
 
-                # Return total adjustment time to let user know how long it took
-                total_adjustment_time += elapsed_time
+                # Sleep for the settling time (or until the pickup coil voltage is
+                # stable in the adaptive settling mode)
+                self.settle(
+                    self.measurement_parameters["frequency_settling_time"],
+                    probe=lambda: self.oscilloscope.measure_vmax(1, frequency),
+                )
 
-            # Sleep for the settling time
-            time.sleep(self.measurement_parameters["frequency_settling_time"])
+                # Measure the voltage and current and the voltages on the osci
+                # (source and osci are read at the same time)
+                (voltage, current), (vmax, pickup_voltage) = self.read_step(
+                    source=lambda: self.read_source(2),
+                    oscilloscope=lambda: self.read_oscilloscope(frequency),
+                )
 
-            # Measure the voltage and current (and possibly parameters on the osci)
-            voltage, current = self.source.read_values(channel=2)
+                self.arduino.trigger_frequency_generation(False)
 
-            vmax = float(self.oscilloscope.measure_vmax(2))
+                # The magnetic field is calculated and the data is stored and
+                # plotted by the pipeline while the next frequency settles
+                pipeline.put(i, (frequency, voltage, current, vmax, pickup_voltage))
+                measured_vmax.append((frequency, vmax))
 
-            # Calculate the magnetic field using a pickup coil
-            magnetic_field = (
-                pf.calculate_magnetic_field_from_Vind(
-                    self.global_parameters["pickup_coil_windings"],
-                    self.global_parameters["pickup_coil_radius"] * 1e-3,
-                    float(self.oscilloscope.measure_vmax(1)),
-                    frequency * 1e3,
-                )
-                * 1e3
-            )
+                if self.measurement_parameters["autoset_frequency_step"]:
+                    # Adjust frequency step automatically depending on the change
+                    # Calculate the slope of the last increase
+                    if i <= 1:
+                        frequency += self.measurement_parameters["frequency_step"]
+                        # baseline = self.df_data["vmax"].mean()
+                    else:
+                        slope = (measured_vmax[i][1] - measured_vmax[i - 2][1]) / (
+                            measured_vmax[i][0] - measured_vmax[i - 2][0]
+                        )
+
+                        # If slope is high enough use the minimal step size, if it isn't and the value fell below 2 * baseline, set it to false
+                        # print(slope)
+                        if abs(slope) > 0.1:
+                            if not minimal_step:
+                                baseline = measured_vmax[i][1]
+                                minimal_step = True
+                        elif measured_vmax[i][1] <= baseline:
+                            minimal_step = False
+
+                        # Depending on if the minimum step was selected either choose a minimum step or a step according to a logistic function
+                        if minimal_step:
+                            frequency += 0.5
+                        else:
+                            # Logistic growth function to determine variable step
+                            # size (10/2=5 is the maximum step size (at zero
+                            # slope), 40 is the slope of the logistic function and
+                            # 0.1 is the minimum step size (at infinite slope))
+                            frequency += 10 / (1 + np.exp(50 * abs(slope))) + 0.5
+                else:
+                    frequency += self.measurement_parameters["frequency_step"]
 
-            self.arduino.trigger_frequency_generation(False)
-
-            # Set the variables in the dataframe
-            self.df_data.loc[i, "voltage"] = voltage
-            self.df_data.loc[i, "current"] = current
-            self.df_data.loc[i, "frequency"] = frequency
-            self.df_data.loc[i, "magnetic_field"] = magnetic_field
-            self.df_data.loc[i, "vmax"] = vmax
-
-            # Update progress bar
-            self.update_progress_bar.emit(
-                "value",
-                int(
-                    (i + 1)
-                    / (
-                        self.measurement_parameters["maximum_frequency"]
-                        - self.measurement_parameters["minimum_frequency"]
-                    )
-                    / self.measurement_parameters["frequency_step"]
-                    * 100
-                ),
-            )
+                self.source.set_voltage(voltage, channel=2)
 
-            self.update_spectrum_signal.emit(
-                self.df_data["frequency"],
-                self.df_data["current"],
-                self.df_data["magnetic_field"],
-                self.df_data["vmax"],
-            )
+                i += 1
 
-            if self.measurement_parameters["autoset_frequency_step"]:
-                # Adjust frequency step automatically depending on the change
-                # Calculate the slope of the last increase
-                if i <= 1:
-                    frequency += self.measurement_parameters["frequency_step"]
-                    # baseline = self.df_data["vmax"].mean()
-                else:
-                    slope = (
-                        self.df_data.loc[i, "vmax"] - self.df_data.loc[i - 2, "vmax"]
-                    ) / (
-                        self.df_data.loc[i, "frequency"]
-                        - self.df_data.loc[i - 2, "frequency"]
-                    )
+                if self.is_killed:
+                    # Close the connection to the spectrometer
+                    self.source.output(False, channel=2)
+                    self.source.set_voltage(5, channel=2)
+                    self.arduino.set_frequency(1000, True)
+                    # self.parent.oscilloscope_thread.pause = False
+                    return
 
-                    # If slope is high enough use the minimal step size, if it isn't and the value fell below 2 * baseline, set it to false
-                    # print(slope)
-                    if abs(slope) > 0.1:
-                        if not minimal_step:
-                            baseline = self.df_data.loc[i, "vmax"]
-                            minimal_step = True
-                    elif self.df_data.loc[i, "vmax"] <= baseline:
-                        minimal_step = False
-
-                    # Depending on if the minimum step was selected either choose a minimum step or a step according to a logistic function
-                    if minimal_step:
-                        frequency += 0.5
-                    else:
-                        # Logistic growth function to determine variable step size
-                        # (10/2=5 is the maximum step size (at zero slope), 40 is the
-                        # slope of the logistic function and 0.1 is the minimum step
-                        # size (at infinite slope))
-                        frequency += 10 / (1 + np.exp(50 * abs(slope))) + 0.5
-            else:
-                frequency += self.measurement_parameters["frequency_step"]
-
-            self.source.set_voltage(voltage, channel=2)
-
-            i += 1
-
-            if self.is_killed:
-                # Close the connection to the spectrometer
-                self.source.output(False, channel=2)
-                self.source.set_voltage(5, channel=2)
-                self.arduino.set_frequency(1000, True)
-                # self.parent.oscilloscope_thread.pause = False
-                self.quit()
-                return
-
-        self.source.output(False, channel=2)
+            self.source.output(False, channel=2)
+        self.log_settling()
         self.save_data()
-        self.parent.specw_start_measurement_pushButton.setChecked(False)
-        self.arduino.set_frequency(1000, True)
+        self.reset_frequency()
 
         # self.parent.oscilloscope_thread.pause = False
 
@@ -277,11 +302,57 @@ class FrequencyScan(QtCore.QThread):
         # self.parent.setup_thread.pause = False
         # self.parent.oscilloscope_thread.pause = False
 
-    def kill(self):
+        self.observer.scan_finished()
+
+    def process_step(self, i, raw):
         """
-        Kill thread while running
+        Calculate the magnetic field of a step using the pickup coil
         """
-        self.is_killed = True
+        frequency, voltage, current, vmax, pickup_voltage = raw
+        magnetic_field = (
+            pf.calculate_magnetic_field_from_Vind(
+                self.global_parameters["pickup_coil_windings"],
+                self.global_parameters["pickup_coil_radius"] * 1e-3,
+                pickup_voltage,
+                frequency * 1e3,
+            )
+            * 1e3
+        )
+
+        return frequency, voltage, current, magnetic_field, vmax
+
+    def record_step(self, i, values):
+        """
+        Store a step in the dataframe and plot it
+        """
+        frequency, voltage, current, magnetic_field, vmax = values
+
+        # Set the variables in the dataframe
+        self.df_data.loc[i, "voltage"] = voltage
+        self.df_data.loc[i, "current"] = current
+        self.df_data.loc[i, "frequency"] = frequency
+        self.df_data.loc[i, "magnetic_field"] = magnetic_field
+        self.df_data.loc[i, "vmax"] = vmax
+
+        # Update progress bar
+        self.observer.update_progress(
+            int(
+                (i + 1)
+                / (
+                    self.measurement_parameters["maximum_frequency"]
+                    - self.measurement_parameters["minimum_frequency"]
+                )
+                / self.measurement_parameters["frequency_step"]
+                * 100
+            ),
+        )
+
+        self.observer.update_plot(
+            self.df_data["frequency"],
+            self.df_data["current"],
+            self.df_data["magnetic_field"],
+            self.df_data["vmax"],
+        )
 
     def save_data(self):
         """
@@ -6,6 +6,9 @@ from serial.serialutil import SerialTimeoutException
 
 import core_functions as cf
 import physics_functions as pf
+import circuit_model
+import pulse_sequence
+import settings_service
 from physics_functions import calculate_resonance_frequency
 
 import time
@@ -16,13 +19,151 @@ from simple_pid import PID
 
 import math
 import copy
+import collections
 import numpy as np
 import pandas as pd
 from itertools import chain, combinations
 
 import debugpy
 
-debugpy.debug_this_thread()
+# Only hook into the debugger if the program was started from one (this is
+# not the case for headless batch runs)
+if debugpy.is_client_connected():
+    debugpy.debug_this_thread()
+
+
+# Settings the capacitor combinations of the arduino are built from and the
+# settings their resonance frequencies are calculated from
+CAPACITOR_SETTINGS = ["base_capacitance", "capacitances", "arduino_pins"]
+CALIBRATION_SETTINGS = ["coil_inductance", "calibration_file_path"]
+
+# Quantities that can be measured by the oscilloscope (:MEASure:<item>?) and
+# their units
+MEASUREMENT_ITEMS = {
+    "vpp": ("VPP", "V"),
+    "vmax": ("VMAX", "V"),
+    "vmin": ("VMIN", "V"),
+    "vamplitude": ("VAMP", "V"),
+    "vtop": ("VTOP", "V"),
+    "vbase": ("VBAS", "V"),
+    "vaverage": ("VAV", "V"),
+    "vrms": ("VRMS", "V"),
+    "overshoot": ("OVER", "%"),
+    "preshoot": ("PRES", "%"),
+    "frequency": ("FREQ", "Hz"),
+    "rise_time": ("RIS", "s"),
+    "fall_time": ("FALL", "s"),
+    "period": ("PER", "s"),
+    "positive_width": ("PWID", "s"),
+    "negative_width": ("NWID", "s"),
+    "positive_duty_cycle": ("PDUT", "%"),
+    "negative_duty_cycle": ("NDUT", "%"),
+    "positive_delay": ("PDEL", "s"),
+    "negative_delay": ("NDEL", "s"),
+}
+
+# Result of a measurement: float for measured quantities, nan if the
+# oscilloscope could not determine it (e.g. clipped signal) and None if it was
+# not requested
+OscilloscopeMeasurement = collections.namedtuple(
+    "OscilloscopeMeasurement",
+    list(MEASUREMENT_ITEMS.keys()),
+    defaults=[None] * len(MEASUREMENT_ITEMS),
+)
+
+
+def parse_measurement_value(value):
+    """
+    Convert a reply of the oscilloscope to float (9.9E37 means invalid)
+    """
+    try:
+        value = float(value)
+    except ValueError:
+        return math.nan
+    return math.nan if value > 1e37 else value
+
+
+def measure_waveform(time_data, voltage, items=None):
+    """
+    Compute the measurement items of a waveform on the host (delays between
+    channels are not available)
+    """
+    if items is None:
+        items = list(MEASUREMENT_ITEMS.keys())
+
+    time_data = np.asarray(time_data, dtype=float)
+    voltage = np.asarray(voltage, dtype=float)
+    results = {}
+
+    vmax = np.max(voltage)
+    vmin = np.min(voltage)
+    # Top and base are the most common levels near the extremes (approximated
+    # by percentiles since the waveform is quantised)
+    vtop = np.percentile(voltage, 95)
+    vbase = np.percentile(voltage, 5)
+    amplitude = vtop - vbase
+
+    results["vpp"] = vmax - vmin
+    results["vmax"] = vmax
+    results["vmin"] = vmin
+    results["vamplitude"] = amplitude
+    results["vtop"] = vtop
+    results["vbase"] = vbase
+    results["vaverage"] = np.mean(voltage)
+    results["vrms"] = np.sqrt(np.mean(voltage**2))
+    results["overshoot"] = (vmax - vtop) / amplitude * 100 if amplitude else math.nan
+    results["preshoot"] = (vbase - vmin) / amplitude * 100 if amplitude else math.nan
+
+    # Period from the rising crossings of the middle level
+    middle = (vtop + vbase) / 2
+    above = voltage > middle
+    rising = np.where(~above[:-1] & above[1:])[0]
+    falling = np.where(above[:-1] & ~above[1:])[0]
+    period = math.nan
+    if np.size(rising) >= 2:
+        period = (time_data[rising[-1]] - time_data[rising[0]]) / (
+            np.size(rising) - 1
+        )
+    results["period"] = period
+    results["frequency"] = 1 / period if period > 0 else math.nan
+
+    # Widths from the first complete positive and negative half period
+    positive_width = math.nan
+    negative_width = math.nan
+    if np.size(rising) and np.size(falling):
+        later_falling = falling[falling > rising[0]]
+        later_rising = rising[rising > falling[0]]
+        if np.size(later_falling):
+            positive_width = time_data[later_falling[0]] - time_data[rising[0]]
+        if np.size(later_rising):
+            negative_width = time_data[later_rising[0]] - time_data[falling[0]]
+    results["positive_width"] = positive_width
+    results["negative_width"] = negative_width
+    results["positive_duty_cycle"] = positive_width / period * 100
+    results["negative_duty_cycle"] = negative_width / period * 100
+
+    # Rise and fall time between 10 % and 90 % of the amplitude
+    low = vbase + 0.1 * amplitude
+    high = vbase + 0.9 * amplitude
+    rise_time = math.nan
+    fall_time = math.nan
+    if np.size(rising):
+        start = np.where(voltage[: rising[0] + 1] <= low)[0]
+        end = np.where(voltage[rising[0] :] >= high)[0]
+        if np.size(start) and np.size(end):
+            rise_time = time_data[rising[0] + end[0]] - time_data[start[-1]]
+    if np.size(falling):
+        start = np.where(voltage[: falling[0] + 1] >= high)[0]
+        end = np.where(voltage[falling[0] :] <= low)[0]
+        if np.size(start) and np.size(end):
+            fall_time = time_data[falling[0] + end[0]] - time_data[start[-1]]
+    results["rise_time"] = rise_time
+    results["fall_time"] = fall_time
+
+    results["positive_delay"] = math.nan
+    results["negative_delay"] = math.nan
+
+    return OscilloscopeMeasurement(**{item: float(results[item]) for item in items})
 
 
 class RigolOscilloscope:
@@ -33,12 +174,15 @@ class RigolOscilloscope:
     information and then read it out afterwards.
     """
 
-    def __init__(self, rigol_source_address):
+    def __init__(self, rigol_source_address, combine_queries=False):
         """
-        Init the oscilloscope
+        Init the oscilloscope. Combining several queries in one request (see
+        query_set) is off by default, because it was not verified which
+        firmware of the DS1000Z accepts how many queries per line.
         """
         # Define a mutex
         self.mutex = QtCore.QRecursiveMutex()
+        self.combine_queries = combine_queries
 
         # Keithley Finding Device
         rm = pyvisa.ResourceManager()
@@ -60,6 +204,8 @@ class RigolOscilloscope:
         )
 
         self.scales = np.repeat(2.0, 2)
+        # Last good scale of a channel and frequency
+        self.scale_cache = {}
         # self.change_scale(1, 2)
         # self.change_scale(2, 2)
 
@@ -95,7 +241,6 @@ class RigolOscilloscope:
         """
         Function that allows the easy change of scale of a channel on the oscilloscope
         """
-        self.mutex.lock()
         if int(channel) not in [1, 2]:
             cf.log_message("Channel does not exist on this oscilloscope.")
             return
@@ -106,6 +251,8 @@ class RigolOscilloscope:
             cf.log_message("Scale can not be set below 1 mV")
             return
 
+        self.mutex.lock()
+
         # Choose closest available scale
         available_scales_smaller = self.available_scales[self.available_scales <= scale]
         scale_to_set = available_scales_smaller[
@@ -137,25 +284,21 @@ class RigolOscilloscope:
         # Stop osci so that the data is not altered on the fly
         # self.stop()
 
-        # Get the timescale and offset
-        self.osci.write(":TIM:SCAL?")
-        timescale = float(self.osci.read())
-        self.osci.write(":TIM:OFFS?")
-        timeoffset = float(self.osci.read())
-
-        # Measure Vmax
-        self.osci.write(":MEAS:VMAX? " + channel)
-        vmax = float(self.osci.read())
-
-        # # # Measure Vmin
-        self.osci.write(":MEAS:VMIN? " + channel)
-        vmin = float(self.osci.read())
-
-        # And the voltage scale and offset
-        self.osci.write(":" + channel + ":SCAL?")
-        voltscale = float(self.osci.read())
-        self.osci.write(":" + channel + ":OFFS?")
-        voltoffset = float(self.osci.read())
+        # Get the timescale and offset, vmax and vmin and the voltage scale
+        # and offset in one request
+        timescale, timeoffset, vmax, vmin, voltscale, voltoffset = [
+            float(reply)
+            for reply in self.query_set(
+                [
+                    ":TIM:SCAL?",
+                    ":TIM:OFFS?",
+                    ":MEAS:VMAX? " + channel,
+                    ":MEAS:VMIN? " + channel,
+                    ":" + channel + ":SCAL?",
+                    ":" + channel + ":OFFS?",
+                ]
+            )
+        ]
 
         # Set channel source
         self.osci.write("WAV:SOUR " + channel)
@@ -220,43 +363,64 @@ class RigolOscilloscope:
 
         return time_data, data_mapped
 
-    def auto_scale(self, channel):
+    def auto_scale(self, channel, frequency=None):
         """
-        I am not yet sure how to do it but this would be an important and
-        nice feature. The idea is to mimic the auto scale feature of the
-        oscilloscope
+        Mimics the auto scale feature of the oscilloscope. The scale is
+        computed directly from a single vmax reading instead of stepping
+        through the available scales. The last good scale of every channel
+        and frequency (in kHz) is cached so that usually a single reading is
+        sufficient. The scale is only changed if the signal is clipped or
+        would fit on a smaller scale.
         """
         self.mutex.lock()
-        vmax = 0
-        # Check if the oscillscope has to be rescaled
-        while True:
-            # Measure Vmax
+
+        # Start from the cached scale of this frequency
+        key = (int(channel), frequency)
+        if (
+            frequency is not None
+            and key in self.scale_cache
+            and self.scale_cache[key] != self.scales[int(channel) - 1]
+        ):
+            self.change_scale(channel, self.scale_cache[key])
+
+        # Measure Vmax
+        self.osci.write(":MEAS:VMAX? CHAN" + str(channel))
+        vmax = self.osci.read()
+
+        # If the signal is clipped its amplitude is unknown, so measure it on
+        # the largest scale first
+        if float(vmax) > 10000:
+            self.change_scale(channel, np.max(self.available_scales))
+            time.sleep(0.5)
             self.osci.write(":MEAS:VMAX? CHAN" + str(channel))
             vmax = self.osci.read()
 
-            index_scale = np.where(
-                self.available_scales == self.scales[int(channel) - 1]
-            )[0][0]
-
-            # Now check if the next scale is already the smallest or largest available
-            if index_scale + 1 == np.size(self.available_scales):
-                next_smaller_scale = np.min(self.available_scales)
-                next_larger_scale = self.available_scales[index_scale - 1]
-            elif index_scale == 0:
-                next_larger_scale = np.max(self.available_scales)
-                next_smaller_scale = self.available_scales[index_scale + 1]
-            else:
-                next_smaller_scale = self.available_scales[index_scale + 1]
-                next_larger_scale = self.available_scales[index_scale - 1]
-
-            if float(vmax) > 10000:
-                self.change_scale(channel, next_larger_scale)
-                time.sleep(0.5)
-            elif float(vmax) < 4 * next_smaller_scale and float(vmax) >= 0.01:
-                self.change_scale(channel, next_smaller_scale)
-            else:
+        # The signal fits on a scale if it stays within the 4 divisions above
+        # the centre (the offset is zero). Take the smallest such scale, but
+        # keep the current one if the signal is too small to be measured
+        # reliably. Since a reading on a coarse scale is less precise, the
+        # target is checked again on the new scale (usually once).
+        for i in range(3):
+            current_scale = self.scales[int(channel) - 1]
+            target_scale = np.min(
+                np.append(
+                    self.available_scales[self.available_scales * 4 > float(vmax)],
+                    np.max(self.available_scales),
+                )
+            )
+            if target_scale == current_scale or (
+                target_scale < current_scale and float(vmax) < 0.01
+            ):
                 break
-            # print(self.scales)
+
+            self.change_scale(channel, target_scale)
+
+            # Measure again with the resolution of the new scale
+            self.osci.write(":MEAS:VMAX? CHAN" + str(channel))
+            vmax = self.osci.read()
+
+        if frequency is not None:
+            self.scale_cache[key] = self.scales[int(channel) - 1]
 
         self.mutex.unlock()
         return vmax
@@ -290,38 +454,92 @@ class RigolOscilloscope:
         :MEASure:TOTal
         :MEASure:SOURce
         """
+        measurement = self.measure_set(
+            ["vpp", "vmax", "vmin", "frequency"], channel=channel
+        )
+
+        return [
+            measurement.vpp,
+            measurement.vmax,
+            measurement.vmin,
+            measurement.frequency,
+        ]  # , vmax, vmin, frequency, rise_time]
+
+    def query_set(self, commands):
+        """
+        Return the replies of several queries. With combine_queries they are
+        sent as one semicolon-concatenated request (one round trip instead of
+        one per query). If that reply can not be split into the expected
+        number of values, the input buffer is cleared and the queries are sent
+        one by one.
+        """
         self.mutex.lock()
+        try:
+            if self.combine_queries:
+                self.osci.write(";".join(commands))
+                try:
+                    replies = self.osci.read().strip().split(";")
+                except pyvisa.errors.VisaIOError:
+                    replies = []
+                if len(replies) == len(commands):
+                    return replies
 
-        # # Measure Vmax
-        # self.osci.write(":MEAS:VMAX? CHAN" + str(channel))
-        # vmax = self.osci.read()
-        vmax = self.auto_scale(channel)
+                cf.log_message(
+                    "Combined query was not answered as expected, querying one by"
+                    " one"
+                )
+                # Discard the rest of a partial or multi-line reply, otherwise
+                # every later read returns the reply of the previous query
+                self.osci.clear()
 
-        # Measre VPP
-        self.osci.write(":MEAS:VPP? CHAN" + str(channel))
-        vpp = self.osci.read()
+            replies = []
+            for command in commands:
+                self.osci.write(command)
+                replies.append(self.osci.read().strip())
+            return replies
+        finally:
+            self.mutex.unlock()
 
-        # # # Measure Vmin
-        self.osci.write(":MEAS:VMIN? CHAN" + str(channel))
-        vmin = self.osci.read()
+    def measure_set(self, items=None, channel=1, auto_scale=True):
+        """
+        Measure any subset of the measurement items (see MEASUREMENT_ITEMS,
+        default all) of a channel with a single request and return them as
+        OscilloscopeMeasurement. By default the channel is auto scaled first
+        (vmax is then taken from the auto scaling).
+        """
+        if items is None:
+            items = list(MEASUREMENT_ITEMS.keys())
 
-        # # # Measure frequency
-        self.osci.write(":MEAS:FREQ? CHAN" + str(channel))
-        frequency = self.osci.read()
+        self.mutex.lock()
+        try:
+            results = {}
+            if auto_scale:
+                results["vmax"] = parse_measurement_value(self.auto_scale(channel))
 
-        # # # Measure rise time
-        # self.osci.write(":MEAS:RIS? CHAN1")
-        # rise_time = float(self.osci.read())
+            queried_items = [item for item in items if item not in results]
+            if queried_items:
+                replies = self.query_set(
+                    [
+                        ":MEAS:" + MEASUREMENT_ITEMS[item][0] + "? CHAN" + str(channel)
+                        for item in queried_items
+                    ]
+                )
+                for item, reply in zip(queried_items, replies):
+                    results[item] = parse_measurement_value(reply)
+        finally:
+            self.mutex.unlock()
 
-        # cf.log_message("VPP: " + str(vpp) + " V")
-        self.mutex.unlock()
+        return OscilloscopeMeasurement(
+            **{item: value for item, value in results.items() if item in items}
+        )
 
-        return [
-            vpp,
-            vmax,
-            vmin,
-            frequency,
-        ]  # , vmax, vmin, frequency, rise_time]
+    def measure_set_from_waveform(self, items=None, channel=1):
+        """
+        Compute the measurement items on the host from a single waveform
+        fetch (see measure_waveform)
+        """
+        time_data, voltage = self.get_data("CHAN" + str(channel))
+        return measure_waveform(time_data, voltage, items)
 
     def measure_vpp(self, channel="CHAN1"):
         """
@@ -336,13 +554,13 @@ class RigolOscilloscope:
         self.mutex.unlock()
         return vpp
 
-    def measure_vmax(self, channel=1):
+    def measure_vmax(self, channel=1, frequency=None):
         """
-        Measure Vavg only
+        Measure Vmax only (the frequency in kHz is used to recall the scale)
         """
         self.mutex.lock()
 
-        vmax = self.auto_scale(channel)
+        vmax = self.auto_scale(channel, frequency)
         # # Measre vavg
         # self.osci.write(":MEAS:VMAX? " + channel)
 
@@ -547,7 +765,7 @@ class VoltcraftSource:
                 pf.calculate_magnetic_field_from_Vind(
                     pickup_coil_windings,
                     pickup_coil_radius * 1e-3,
-                    float(osci.measure_vmax(1)),
+                    float(osci.measure_vmax(1, frequency)),
                     frequency * 1e3,
                 )
                 * 1e3
@@ -636,9 +854,10 @@ class Arduino:
         """
         Init arduino
         """
-        import pydevd
+        if debugpy.is_client_connected():
+            import pydevd
 
-        pydevd.settrace(suspend=False)
+            pydevd.settrace(suspend=False)
 
         # Define a mutex
         self.mutex = QtCore.QRecursiveMutex()
@@ -668,7 +887,11 @@ class Arduino:
 
         self.resistor_on = False
 
+        # Unread part of the edges streamed by a pulse schedule
+        self.pulse_stream = b""
+
         self.init_caps()
+        settings_service.service.subscribe(self.settings_changed)
 
         # Try to open the serial connection
         try:
@@ -686,6 +909,24 @@ class Arduino:
 
         # cf.log_message("Arduino successfully initiated")
 
+    def settings_changed(self, changed_keys, settings):
+        """
+        Rebuild the capacitor combinations if the capacitors changed or only
+        assign their resonance frequencies again if the calibration changed
+        (called by the settings service on the thread that noticed the
+        change, so the mutex keeps the arduino from being used meanwhile)
+        """
+        if any(key in CAPACITOR_SETTINGS for key in changed_keys):
+            self.mutex.lock()
+            self.init_caps()
+            self.mutex.unlock()
+            cf.log_message("Capacitor settings changed, capacitor table rebuilt")
+        elif any(key in CALIBRATION_SETTINGS for key in changed_keys):
+            self.mutex.lock()
+            self.apply_calibration()
+            self.mutex.unlock()
+            cf.log_message("Calibration changed, resonance frequencies updated")
+
     def init_caps(self):
         """
         Function to initialise caps
@@ -696,14 +937,10 @@ class Arduino:
         # Capacitances in pF
         self.base_capacitance = float(global_settings["base_capacitance"])
         # self.base_capacitance = 3300
-        self.capacitances = np.array(
-            global_settings["capacitances"].split(","), dtype=float
-        )
+        self.capacitances = np.array(global_settings.capacitances)
         # capacitances = [150, 330, 680, 1000, 2200, 3300]
         # self.arduino_pins = np.array([7, 6, 5, 4, 3, 2])
-        self.arduino_pins = np.array(
-            global_settings["arduino_pins"].split(","), dtype=int
-        )
+        self.arduino_pins = np.array(global_settings.arduino_pins)
         self.cap_states = np.repeat(False, np.size(self.arduino_pins))
 
         def powerset(iterable):
@@ -732,6 +969,17 @@ class Arduino:
             .sort_values("sum", ignore_index=True)
             .drop_duplicates(subset=["sum"], keep="first", ignore_index=True)
         )
+        self.capacitor_table = temp_combinations_df
+
+        self.apply_calibration()
+
+    def apply_calibration(self):
+        """
+        Assign the resonance frequencies of the capacitor combinations from
+        the calibration file and the circuit model fitted to it
+        """
+        global_settings = cf.read_global_settings()
+        temp_combinations_df = copy.copy(self.capacitor_table)
 
         # Add additional column with resonance frequency
 
@@ -749,8 +997,8 @@ class Arduino:
                 names=[
                     "capacitance",
                     "resonance_frequency",
-                    "quality_factor",
                     "maximum_current",
+                    "quality_factor",
                 ],
             )
         except:
@@ -758,8 +1006,8 @@ class Arduino:
                 columns=[
                     "capacitance",
                     "resonance_frequency",
-                    "quality_factor",
                     "maximum_current",
+                    "quality_factor",
                 ],
             )
 
@@ -796,48 +1044,74 @@ class Arduino:
             "resonance_frequency", ignore_index=True
         )
 
+        # Fit a circuit model (with the parasitic capacitance of every relay)
+        # to the calibrated combinations to predict the resonance frequencies
+        # of all others instead of relying on the ideal formula
+        calibration = calibration.loc[
+            calibration["resonance_frequency"].astype(float) > 0
+        ].drop_duplicates("capacitance")
+        calibrated = temp_combinations_df["sum"].isin(calibration["capacitance"])
+        calibration = calibration.set_index("capacitance")
+        self.circuit_model = None
+
+        if np.sum(calibrated) >= 2:
+            calibrated_caps = temp_combinations_df.loc[calibrated, "sum"].to_numpy(
+                dtype=float
+            )
+            self.circuit_model = circuit_model.CircuitModel.fit(
+                calibrated_caps,
+                calibration.loc[calibrated_caps, "resonance_frequency"],
+                circuit_model.relay_states(
+                    temp_combinations_df.loc[calibrated, "arduino_pins"],
+                    self.arduino_pins,
+                ),
+                calibration.loc[calibrated_caps, "quality_factor"],
+            )
+            temp_combinations_df[
+                "resonance_frequency"
+            ] = self.circuit_model.resonance_frequency(
+                temp_combinations_df["sum"].to_numpy(dtype=float),
+                circuit_model.relay_states(
+                    temp_combinations_df["arduino_pins"], self.arduino_pins
+                ),
+            )
+            cf.log_message(
+                "Resonance frequencies of "
+                + str(len(temp_combinations_df) - np.sum(calibrated))
+                + " uncalibrated capacitances predicted by "
+                + repr(self.circuit_model)
+            )
+
         self.all_capacitances_df = copy.copy(temp_combinations_df)
 
         # Now replace those values that do exist in the calibration file with these resonance frequencies
-        for index, capacitance in temp_combinations_df["sum"].items():
-            # Check if there is an entry in the calibration list
-            if (
-                len(
-                    calibration.loc[
-                        calibration["capacitance"] == capacitance, "capacitance"
-                    ].to_numpy()
-                )
-                == 1
-            ):
-                # print(self.combinations_df.loc[index, "resonance_frequency"])
-                temp_combinations_df.loc[
-                    index, "resonance_frequency"
-                ] = calibration.loc[
-                    calibration["capacitance"] == capacitance, "resonance_frequency"
-                ].to_list()[
-                    0
-                ]
-            else:
-                cf.log_message(
-                    "Capacitance "
-                    + str(capacitance)
-                    + " pF not found in calibration file"
-                )
+        temp_combinations_df.loc[calibrated, "resonance_frequency"] = calibration.loc[
+            temp_combinations_df.loc[calibrated, "sum"].to_numpy(dtype=float),
+            "resonance_frequency",
+        ].to_numpy(dtype=float)
+
+        if self.circuit_model is not None:
+            # All combinations can be used with the predicted resonances
+            self.combinations_df = temp_combinations_df
+        else:
+            cf.log_message(
+                str(len(temp_combinations_df) - np.sum(calibrated))
+                + " capacitances not found in calibration file"
+            )
 
-        # Now cut out all entries that are not present in the calibration file
-        # but are within its frequency range
-        self.combinations_df = temp_combinations_df.drop(
-            temp_combinations_df.loc[
-                np.logical_and(
+            # Now cut out all entries that are not present in the calibration
+            # file but are within its frequency range
+            self.combinations_df = temp_combinations_df.drop(
+                temp_combinations_df.loc[
                     np.logical_and(
-                        temp_combinations_df["sum"] >= calibration["capacitance"].min(),
-                        temp_combinations_df["sum"] <= calibration["capacitance"].max(),
-                    ),
-                    ~temp_combinations_df["sum"].isin(calibration["capacitance"]),
-                )
-            ].index
-        ).reset_index(drop=True)
-
+                        np.logical_and(
+                            temp_combinations_df["sum"] >= calibration.index.min(),
+                            temp_combinations_df["sum"] <= calibration.index.max(),
+                        ),
+                        ~calibrated,
+                    )
+                ].index
+            ).reset_index(drop=True)
         # self.combinations_df = pd.DataFrame(
         # columns=["constituents", "arduino_pins", "sum", "resonance_frequency"]
         # )
@@ -904,8 +1178,9 @@ class Arduino:
         com.write(freq)
         time.sleep(0.1)
 
-        # Read answer from Arduino
-        cf.log_message(com.readall())
+        # Read answer from Arduino (every step of a scan, so only to the debug
+        # channel)
+        cf.log_debug(com.readall(), frequency=frequency)
 
         if set_capacitance:
             closest_resonance_frequency, idx = cf.find_nearest(
@@ -1030,7 +1305,10 @@ class Arduino:
             # print("Turned on pin " + str(arduino_port))
             # time.sleep(0.1)
 
-        cf.log_message("Capacitance set to " + str(capacitance) + " pF")
+        cf.log_debug(
+            "Capacitance set to " + str(capacitance) + " pF",
+            pins=list(self.combinations_df["arduino_pins"].iloc[idx]),
+        )
         self.mutex.unlock()
 
     def set_resistance(self, resistance):
@@ -1050,7 +1328,7 @@ class Arduino:
         com.write(freq)
 
         # Read answer from Arduino
-        cf.log_message(com.readall())
+        cf.log_debug(com.readall(), resistance=resistance)
         # cf.log_message("Resistance set to " + str(resistance) + " pF")
 
         self.mutex.unlock()
@@ -1135,6 +1413,77 @@ class Arduino:
 
         self.mutex.unlock()
 
+    def upload_pulse_schedule(self, schedule, timeout=5):
+        """
+        Upload a binary pulse schedule (see pulse_sequence) that the sketch
+        executes on its own. Returns True if the sketch accepted it.
+        """
+        self.mutex.lock()
+        com = self.arduino
+        # Check if serial connection was already established
+        if self.serial_connection_open == False:
+            self.init_serial_connection()
+
+        number_of_segments = (len(schedule) - 2) // pulse_sequence.RECORD_SIZE
+        com.write(str.encode("seq_" + str(number_of_segments) + "\n") + schedule)
+
+        # The sketch answers once it received all records (at 9600 baud this
+        # takes about 1 ms per byte)
+        reply = b""
+        start_time = time.time()
+        while b"\n" not in reply and time.time() - start_time < timeout:
+            reply += com.readall()
+
+        self.mutex.unlock()
+
+        cf.log_message(reply)
+        return b"Sequence loaded" in reply
+
+    def start_pulse_schedule(self):
+        """
+        Start the uploaded pulse schedule. The sketch reports the time of the
+        edges which can be read with read_pulse_edges.
+        """
+        self.mutex.lock()
+        self.pulse_stream = b""
+        self.arduino.write(str.encode("run_1\n"))
+        self.mutex.unlock()
+
+    def stop_pulse_schedule(self):
+        """
+        Abort a running pulse schedule (the frequency generation is turned off)
+        """
+        self.mutex.lock()
+        self.arduino.write(str.encode("run_0\n"))
+        self.mutex.unlock()
+
+    def read_pulse_edges(self):
+        """
+        Edges reported by the running pulse schedule since the last call as
+        a list of (segment index, time in s since the start) and whether the
+        schedule is finished
+        """
+        self.mutex.lock()
+        self.pulse_stream += self.arduino.readall()
+        lines = self.pulse_stream.split(b"\n")
+        self.pulse_stream = lines.pop()
+
+        edges = []
+        finished = False
+        for line in lines:
+            name, _, value = line.strip().decode(errors="ignore").partition("_")
+            if name == "edge":
+                index, micros = value.split("_")
+                edges.append((int(index), int(micros) / 1e6))
+            elif name == "done":
+                # The sketch turns off the frequency generation at the end
+                self.frequency = float(value) / 1000
+                self.frequency_on = False
+                finished = True
+
+        self.mutex.unlock()
+        return edges, finished
+
     # The capacitances can now be matched to resonance frequencies using a fit of capacitance over resonance frequency
     # def capacitance_to_resonance_frequency(self, capacitance):
     # """
@@ -1174,9 +1523,10 @@ class KoradSource:
         """
         Initialise KORAD source
         """
-        import pydevd
+        if debugpy.is_client_connected():
+            import pydevd
 
-        pydevd.settrace(suspend=False)
+            pydevd.settrace(suspend=False)
         self.mutex = QtCore.QRecursiveMutex()
 
         rm = pyvisa.ResourceManager()
@@ -1353,7 +1703,7 @@ class KoradSource:
                 pf.calculate_magnetic_field_from_Vind(
                     pickup_coil_windings,
                     pickup_coil_radius * 1e-3,
-                    float(osci.measure_vmax(1)),
+                    float(osci.measure_vmax(1, frequency)),
                     frequency * 1e3,
                 )
                 * 1e3
@@ -1463,6 +1813,9 @@ class KoradKD3305PSource:
         """
         Initialise KORAD source
         """
+        # The source is read by the display and the scans from different
+        # threads, so every transaction on the port is locked
+        self.mutex = QtCore.QRecursiveMutex()
 
         rm = pyvisa.ResourceManager()
         # The actual addresses for the devices can be accessed via rm.list_resources()
@@ -1500,6 +1853,7 @@ class KoradKD3305PSource:
         """
         # The source will return something liek 119700020 which translates to:
         # U = 11.97 V, I = 0.00 A and it is in C.V. mode (constant voltage)
+        self.mutex.lock()
         self.source.write(str.encode("VOUT{0}?\n".format(channel)))
         raw_voltage = self.source.readline(7).decode()
         try:
@@ -1511,6 +1865,7 @@ class KoradKD3305PSource:
         time.sleep(0.2)
         self.source.write(str.encode("IOUT{0}?\n".format(channel)))
         raw_current = self.source.read(7).decode()
+        self.mutex.unlock()
         try:
             current = float(raw_current)
         except:
@@ -1545,6 +1900,7 @@ class KoradKD3305PSource:
             )
             voltage = 0
 
+        self.mutex.lock()
         try:
             self.source.write(str.encode("VSET{0}:{1}\n".format(channel, voltage)))
         except SerialTimeoutException as err:
@@ -1553,6 +1909,7 @@ class KoradKD3305PSource:
             self.source.write(str.encode("VSET{0}:{1}\n".format(channel, voltage)))
 
         time.sleep(0.2)
+        self.mutex.unlock()
 
     def set_current(self, current, channel):
         """
@@ -1575,8 +1932,10 @@ class KoradKD3305PSource:
             )
             current = 0
 
+        self.mutex.lock()
         self.source.write(str.encode("ISET{0}:{1}\n".format(channel, current)))
         time.sleep(0.2)
+        self.mutex.unlock()
 
     def set_magnetic_field(self, magnetic_field, channel):
         """
@@ -1629,7 +1988,7 @@ class KoradKD3305PSource:
                 pf.calculate_magnetic_field_from_Vind(
                     pickup_coil_windings,
                     pickup_coil_radius * 1e-3,
-                    float(osci.measure_vmax(1)),
+                    float(osci.measure_vmax(1, frequency)),
                     frequency * 1e3,
                 )
                 * 1e3
@@ -1678,6 +2037,7 @@ class KoradKD3305PSource:
         """
         # The logic of the voltcraft source is just the other way around than
         # my logic (true means off)
+        self.mutex.lock()
         if slow:
             voltage, current = self.read_values()
             self.set_voltage(round(voltage / 4, 2))
@@ -1710,14 +2070,16 @@ class KoradKD3305PSource:
             self.dc_output_state = state
         elif channel == 2:
             self.hf_output_state = state
+        self.mutex.unlock()
 
     def close(self):
         """
         Savely close the source
         """
 
-        # Deactivate output
-        self.output(False)
+        # Deactivate both outputs
+        self.output(False, channel=1)
+        self.output(False, channel=2)
 
         # Close serial connection
         self.source.close()
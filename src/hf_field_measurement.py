@@ -6,12 +6,15 @@ import numpy as np
 import pandas as pd
 
 import core_functions as cf
+import demodulation
 import physics_functions as pf
+from scan_engine import ScanEngine, ScanObserver
+from sweep_pipeline import SweepPipeline
 
 from scipy.ndimage.filters import uniform_filter1d
 
 
-class HFScan(QtCore.QThread):
+class HFScan(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -33,37 +36,112 @@ class HFScan(QtCore.QThread):
         parent=None,
     ):
         super(HFScan, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.measurement_parameters = measurement_parameters
-        self.setup_parameters = setup_parameters
-
-        self.global_parameters = cf.read_global_settings()
-
         # Connect signal to the updater from the parent class
         self.update_hf_scan_plot.connect(parent.update_hf_plot)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
         self.pause_thread_hf_field.connect(parent.pause_hf_measurement)
 
-        # Define dataframe to store data in
-        self.df_data = pd.DataFrame(
-            columns=["current", "hf_field", "hf_field_pickup", "me_voltage"]
+        # The scan itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = HFScanEngine(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer=self,
+        )
+
+    @property
+    def pause(self):
+        """
+        The pause state is set by the main window but owned by the engine
+        """
+        return self.engine.pause
+
+    @pause.setter
+    def pause(self, status):
+        self.engine.pause = status
+
+    def run(self):
+        """
+        Run the hf scan engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, hf_field, me_voltage):
+        """
+        Forward the measured data to the main window
+        """
+        self.update_hf_scan_plot.emit(hf_field, me_voltage)
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def pause_measurement(self, status):
+        """
+        Ask the user (asynchronously) to insert the OLED
+        """
+        self.pause_thread_hf_field.emit(status)
+        return None
+
+    def scan_finished(self):
+        """
+        Release the start button once the scan is done
+        """
+        self.parent.hfw_start_measurement_pushButton.setChecked(False)
+
+
+class HFScanEngine(ScanEngine):
+    """
+    Engine that does an hf field sweep independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(HFScanEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
         )
 
-        self.is_killed = False
+        # Define dataframe to store data in
+        columns = ["current", "hf_field", "hf_field_pickup", "me_voltage"]
+        if self.lock_in_mode:
+            # Phase (relative to the pickup coil) and noise of the ME voltage
+            columns += ["me_phase", "me_noise"]
+        self.df_data = pd.DataFrame(columns=columns)
 
         self.source.set_current(2, channel=2)
         if measurement_parameters["constant_magnetic_field_mode"]:
-            pid_parameters = np.array(
-                self.global_parameters["pid_parameters"].split(","), dtype=float
-            )
+            pid_parameters = np.array(self.global_parameters.pid_parameters)
             self.source.start_constant_magnetic_field_mode(
                 pid_parameters,
                 self.measurement_parameters["current_compliance"],
@@ -99,10 +177,6 @@ class HFScan(QtCore.QThread):
         # self.measurement_parameters["maximum_frequency"],
         # self.measurement_parameters["frequency_step"],
         # )
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Measure time elapsed
         start_time = time.time()
 
@@ -122,7 +196,7 @@ class HFScan(QtCore.QThread):
         #     )
 
         # Set frequency
-        self.arduino.set_frequency(
+        self.set_frequency(
             self.measurement_parameters["frequency"],
             self.measurement_parameters["autoset_capacitance"],
         )
@@ -195,9 +269,13 @@ class HFScan(QtCore.QThread):
 
             # Now do the actual calibration scan where the iteration over the hf
             # field is done
+            self.calibration = {}
             for hf_field in hf_field_list:
                 self.source.set_voltage(hf_field, channel=2)
-                time.sleep(self.measurement_parameters["hf_field_settling_time"])
+                self.settle(
+                    self.measurement_parameters["hf_field_settling_time"],
+                    probe=lambda: self.read_source(2)[1],
+                )
                 # self.oscilloscope.auto_scale(1)
                 (
                     self.osci_data[str(hf_field) + "_cal_time"],
@@ -212,123 +290,186 @@ class HFScan(QtCore.QThread):
                 self.osci_data[str(hf_field) + "_cal"] = uniform_filter1d(
                     osci_data_raw, 20
                 )
+                if self.lock_in_mode:
+                    self.calibration[hf_field] = self.demodulate(
+                        self.osci_data[str(hf_field) + "_cal_time"],
+                        osci_data_raw,
+                        self.osci_data[str(hf_field) + "_cal_field"],
+                    )
 
             self.source.output(False, channel=2)
 
             # After calibration, tell user to insert OLED
-            self.pause = "True"
-            self.pause_thread_hf_field.emit("on")
-
-            while self.pause == "True":
-                time.sleep(0.1)
-                if self.pause == "break":
-                    # Take the time at the beginning to measure the length of the entire
-                    # measurement
-                    absolute_starting_time = time.time()
-                    break
-                elif self.pause == "return":
-                    return
+            if not self.wait_for_user("on"):
+                return
+
+            # Take the time at the beginning to measure the length of the entire
+            # measurement
+            absolute_starting_time = time.time()
 
             self.source.output(True, channel=2)
 
         # Now this is the real measurement
-        for hf_field in hf_field_list:
-            # for frequency in self.df_data["frequency"]:
-            # cf.log_message("Frequency set to " + str(frequency) + " kHz")
-
-            # Set DC Field
-            self.source.set_voltage(hf_field, channel=2)
-            time.sleep(self.measurement_parameters["hf_field_settling_time"])
-
-            # Measure the voltage and current (and possibly parameters on the osci)
-            # me_voltage = float(self.oscilloscope.measure_vmax(channel=1))
-            # self.oscilloscope.auto_scale(1)
+        self.number_of_steps = len(hf_field_list)
+        with SweepPipeline(self.process_step, self.record_step) as pipeline:
+            for hf_field in hf_field_list:
+                # for frequency in self.df_data["frequency"]:
+                # cf.log_message("Frequency set to " + str(frequency) + " kHz")
 
-            # If luminance mode was selected, get the full osci data and not
-            # only the max
-            if self.global_parameters["luminance_mode"]:
-                (
-                    self.osci_data[str(hf_field) + "_time"],
-                    osci_data_raw,
-                ) = self.oscilloscope.get_data("CHAN2")
-                (
-                    time_data,
-                    self.osci_data[str(hf_field) + "_field"],
-                ) = self.oscilloscope.get_data("CHAN1")
+                # Set DC Field (the adaptive settling follows the current through
+                # the hf coil)
+                self.source.set_voltage(hf_field, channel=2)
+                self.settle(
+                    self.measurement_parameters["hf_field_settling_time"],
+                    probe=lambda: self.read_source(2)[1],
+                )
 
-                self.osci_data[str(hf_field)] = uniform_filter1d(osci_data_raw, 20)
+                # Measure the voltage and current (and possibly parameters on the osci)
+                # me_voltage = float(self.oscilloscope.measure_vmax(channel=1))
+                # self.oscilloscope.auto_scale(1)
 
-                me_voltage = np.max(
-                    self.osci_data[str(hf_field)]
-                    - self.osci_data[str(hf_field) + "_cal"]
-                )
-            else:
-                me_voltage = float(self.oscilloscope.measure_vmax(2))
-
-                # Magnetic field is only relevant if the pickup coil holder is used
-                # Calculate the magnetic field using a pickup coil
-                # A magnetic field mode should be implemented where the scan is
-                # done over hf fields instead of voltages
-
-                magnetic_field = (
-                    pf.calculate_magnetic_field_from_Vind(
-                        self.global_parameters["pickup_coil_windings"],
-                        self.global_parameters["pickup_coil_radius"] * 1e-3,
-                        float(self.oscilloscope.measure_vmax(1)),
-                        self.measurement_parameters["frequency"] * 1e3,
+                # If luminance mode was selected, get the full osci data and not
+                # only the max. The source is read at the same time.
+                if self.global_parameters["luminance_mode"]:
+                    oscilloscope_task = lambda: (
+                        self.oscilloscope.get_data("CHAN2"),
+                        self.oscilloscope.get_data("CHAN1"),
+                    )
+                elif self.lock_in_mode:
+                    oscilloscope_task = lambda: self.read_lock_in(
+                        self.measurement_parameters["frequency"]
                     )
-                    * 1e3
+                else:
+                    oscilloscope_task = lambda: (
+                        float(
+                            self.oscilloscope.measure_vmax(
+                                2, self.measurement_parameters["frequency"]
+                            )
+                        ),
+                        float(
+                            self.oscilloscope.measure_vmax(
+                                1, self.measurement_parameters["frequency"]
+                            )
+                        ),
+                    )
+                oscilloscope_values, source_values = self.read_step(
+                    oscilloscope=oscilloscope_task, source=lambda: self.read_source(2)
                 )
 
-                self.df_data.loc[i, "hf_field_pickup"] = magnetic_field
+                # Smoothing, calibration subtraction and the magnetic field are
+                # calculated and the data is stored and plotted by the pipeline
+                # while the next field settles
+                pipeline.put(i, (hf_field, oscilloscope_values, source_values))
+
+                if self.is_killed:
+                    # Close the connection to the spectrometer
+                    self.source.output(False, channel=2)
+                    self.source.set_voltage(1, channel=2)
+                    self.source.output(False, channel=1)
+                    self.arduino.set_frequency(1000, True)
+                    self.arduino.trigger_frequency_generation(False)
+                    # self.parent.oscilloscope_thread.pause = False
+                    return
 
-            # Set the variables in the dataframe
-            (
-                self.df_data.loc[i, "hf_field"],
-                self.df_data.loc[i, "current"],
-            ) = self.source.read_values(channel=2)
-            self.df_data.loc[i, "me_voltage"] = me_voltage
-
-            # Update progress bar
-            self.update_progress_bar.emit(
-                "value", int((i + 1) / len(hf_field_list) * 100)
-            )
+                # Increase iterator
+                i += 1
 
-            self.update_hf_scan_plot.emit(
-                self.df_data["hf_field"],
-                self.df_data["me_voltage"],
-            )
+                if not self.adaptive_settling:
+                    self.settle(self.measurement_parameters["hf_field_settling_time"])
 
-            if self.is_killed:
-                # Close the connection to the spectrometer
-                self.source.output(False, channel=2)
-                self.source.set_voltage(1, channel=2)
-                self.source.output(False, channel=1)
-                self.arduino.set_frequency(1000, True)
-                self.arduino.trigger_frequency_generation(False)
-                # self.parent.oscilloscope_thread.pause = False
-                self.quit()
-                return
+            self.source.output(False, channel=2)
+            self.source.output(False, channel=1)
+            self.arduino.trigger_frequency_generation(False)
+        self.log_settling()
+        self.save_data()
+        self.reset_frequency()
 
-            # Increase iterator
-            i += 1
+        # self.parent.oscilloscope_thread.pause = False
 
-            time.sleep(self.measurement_parameters["hf_field_settling_time"])
+        self.observer.scan_finished()
 
-        self.source.output(False, channel=2)
-        self.source.output(False, channel=1)
-        self.arduino.trigger_frequency_generation(False)
-        self.save_data()
-        self.parent.hfw_start_measurement_pushButton.setChecked(False)
-        self.arduino.set_frequency(1000, True)
+    def process_step(self, i, raw):
+        """
+        Smooth the osci data and subtract the calibration (luminance mode) or
+        calculate the magnetic field using the pickup coil. In lock-in mode the
+        ME voltage is the demodulated amplitude.
+        """
+        hf_field, oscilloscope_values, source_values = raw
 
-        # self.parent.oscilloscope_thread.pause = False
+        magnetic_field = None
+        lock_in = None
+        if self.global_parameters["luminance_mode"]:
+            (
+                (self.osci_data[str(hf_field) + "_time"], osci_data_raw),
+                (time_data, self.osci_data[str(hf_field) + "_field"]),
+            ) = oscilloscope_values
+
+            self.osci_data[str(hf_field)] = uniform_filter1d(osci_data_raw, 20)
+
+            if self.lock_in_mode:
+                lock_in = demodulation.subtract(
+                    self.demodulate(
+                        self.osci_data[str(hf_field) + "_time"],
+                        osci_data_raw,
+                        self.osci_data[str(hf_field) + "_field"],
+                    ),
+                    self.calibration[hf_field],
+                )
+                me_voltage = lock_in.amplitude
+            else:
+                me_voltage = np.max(
+                    self.osci_data[str(hf_field)]
+                    - self.osci_data[str(hf_field) + "_cal"]
+                )
+        else:
+            if self.lock_in_mode:
+                lock_in, pickup_lock_in = oscilloscope_values
+                me_voltage, pickup_voltage = lock_in.amplitude, pickup_lock_in.amplitude
+            else:
+                me_voltage, pickup_voltage = oscilloscope_values
+
+            # Magnetic field is only relevant if the pickup coil holder is used
+            # Calculate the magnetic field using a pickup coil
+            # A magnetic field mode should be implemented where the scan is
+            # done over hf fields instead of voltages
+            magnetic_field = (
+                pf.calculate_magnetic_field_from_Vind(
+                    self.global_parameters["pickup_coil_windings"],
+                    self.global_parameters["pickup_coil_radius"] * 1e-3,
+                    pickup_voltage,
+                    self.measurement_parameters["frequency"] * 1e3,
+                )
+                * 1e3
+            )
 
-    def kill(self):
+        return me_voltage, magnetic_field, source_values, lock_in
+
+    def record_step(self, i, values):
         """
-        Kill thread while running
+        Store a step in the dataframe and plot it
         """
-        self.is_killed = True
+        me_voltage, magnetic_field, source_values, lock_in = values
+
+        if magnetic_field is not None:
+            self.df_data.loc[i, "hf_field_pickup"] = magnetic_field
+
+        # Set the variables in the dataframe
+        (
+            self.df_data.loc[i, "hf_field"],
+            self.df_data.loc[i, "current"],
+        ) = source_values
+        self.df_data.loc[i, "me_voltage"] = me_voltage
+        if lock_in is not None:
+            self.df_data.loc[i, "me_phase"] = lock_in.phase
+            self.df_data.loc[i, "me_noise"] = lock_in.noise
+
+        # Update progress bar
+        self.observer.update_progress(int((i + 1) / self.number_of_steps * 100))
+
+        self.observer.update_plot(
+            self.df_data["hf_field"],
+            self.df_data["me_voltage"],
+        )
 
     def save_data(self):
         """
@@ -369,7 +510,11 @@ class HFScan(QtCore.QThread):
         )
         line05 = "### Measurement data ###"
         line06 = "Current\t HF Voltage\t HF Field pickup\t ME Voltage"
-        line07 = "A\t V\t mT\t V\n"
+        line07 = "A\t V\t mT\t V"
+        if self.lock_in_mode:
+            line06 += "\t ME Phase\t ME Noise"
+            line07 += "\t rad\t V"
+        line07 += "\n"
 
         header_lines = [
             line02,
@@ -0,0 +1,278 @@
+"""
+Incremental capacitor calibration. Instead of measuring all combinations
+again, the latest calibration of the store is checked with a few probe
+combinations spread over its frequency range. The same circuit model (with
+the parasitics of the relays) is fitted to the stored and to the measured
+resonances of the probes; the difference between both predicts how far every
+combination drifted. Only the combinations whose predicted drift exceeds the
+tolerance are measured again, and the result is merged into a new version of
+the calibration store that becomes the calibration file of the settings.
+Combinations whose fit still fails keep their stored value and are logged.
+"""
+
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+
+import core_functions as cf
+import settings_service
+from calibration_store import CalibrationStore, read_resonance_file, merge
+from capacitance_measurement import CapacitanceScanEngine
+from circuit_model import CircuitModel, relay_states
+
+
+def probe_set(calibration, number_of_probes):
+    """
+    Indices of calibrated capacitances evenly spread over the frequency range
+    """
+    order = np.argsort(calibration["resonance_frequency"].to_numpy(dtype=float))
+    positions = np.unique(
+        np.round(np.linspace(0, len(order) - 1, number_of_probes)).astype(int)
+    )
+    return calibration.index[order[positions]]
+
+
+class IncrementalCalibrationEngine(CapacitanceScanEngine):
+    """
+    Engine that only measures the capacitor combinations that drifted
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(IncrementalCalibrationEngine, self).__init__(
+            arduino,
+            source,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+
+        # The store is next to the calibration file unless given explicitly
+        directory = measurement_parameters.get("store_directory", "")
+        if directory == "":
+            directory = os.path.join(
+                os.path.dirname(self.global_settings["calibration_file_path"]),
+                "calibration_store",
+            )
+        self.store = CalibrationStore(directory)
+
+        # Results of the finished rounds (probes and re-measurements)
+        self.measured = []
+        self.model = None
+
+    def load_calibration(self):
+        """
+        Latest calibration of the store. An empty store is started with the
+        calibration file of the settings.
+        """
+        calibration = self.store.load()
+        if calibration is None:
+            calibration = read_resonance_file(
+                self.global_settings["calibration_file_path"]
+            )
+            self.store.commit(
+                calibration,
+                note="Imported " + self.global_settings["calibration_file_path"],
+            )
+
+        return calibration.loc[calibration["resonance_frequency"] > 0].reset_index(
+            drop=True
+        )
+
+    def available_caps(self, capacitances):
+        """
+        Rows of all_capacitances_df of the given capacitances
+        """
+        all_caps = self.arduino.all_capacitances_df
+        return all_caps.loc[all_caps["sum"].isin(capacitances)].reset_index(drop=True)
+
+    def relays(self, capacitances):
+        """
+        Relay states (see circuit_model.relay_states) of the capacitances
+        """
+        all_caps = self.arduino.all_capacitances_df.drop_duplicates("sum")
+        pins = all_caps.set_index("sum")["arduino_pins"]
+        return relay_states(
+            pins.loc[np.asarray(capacitances, dtype=float)], self.arduino.arduino_pins
+        )
+
+    def predict_resonance(self, capacitance):
+        """
+        Centre the sweep on the prediction of the fitted model
+        """
+        if self.model is None:
+            return super(IncrementalCalibrationEngine, self).predict_resonance(
+                capacitance
+            )
+        relays = self.relays([capacitance])
+        return np.round(self.model.resonance_frequency([capacitance], relays)[0], 1)
+
+    def measure(self, capacitances):
+        """
+        Measure the resonances of the capacitances. Returns False if the scan
+        was killed.
+        """
+        self.df_resonance_fit = self.df_resonance_fit.iloc[0:0]
+        finished = self.scan_capacitances(self.available_caps(capacitances))
+        self.measured.append(self.df_resonance_fit)
+        self.df_resonance_fit = self.df_resonance_fit.iloc[0:0]
+        return finished
+
+    def failed(self, capacitances):
+        """
+        Capacitances without a successful fit in any of the finished rounds
+        """
+        measured = pd.concat(self.measured, ignore_index=True)
+        fitted = measured.loc[
+            measured["resonance_frequency"].astype(float) > 0, "capacitance"
+        ]
+        return capacitances[~np.isin(capacitances, fitted)]
+
+    def run(self):
+        """
+        Check the calibration with probes and measure the drifted combinations
+        """
+        self.source.set_voltage(self.measurement_parameters["voltage"], channel=2)
+        self.source.set_current(
+            self.measurement_parameters["current_compliance"], channel=2
+        )
+
+        self.calibration = self.load_calibration()
+        capacitances = self.calibration["capacitance"].to_numpy(dtype=float)
+        available = np.isin(capacitances, self.arduino.all_capacitances_df["sum"])
+        if not np.all(available):
+            cf.log_message(
+                str(np.sum(~available))
+                + " stored capacitances are not available with the current"
+                " capacitors and are kept"
+            )
+            capacitances = capacitances[available]
+        stored = self.calibration.drop_duplicates("capacitance").set_index(
+            "capacitance"
+        )["resonance_frequency"]
+
+        # Measure the probes (the failed ones a second time)
+        calibration = self.calibration.loc[
+            self.calibration["capacitance"].isin(capacitances)
+        ]
+        probes = calibration.loc[
+            probe_set(calibration, self.measurement_parameters["probe_points"]),
+            "capacitance",
+        ].to_numpy(dtype=float)
+        if not self.measure(probes):
+            return
+        if len(self.failed(probes)) > 0:
+            cf.log_message(
+                "The fit of the probes "
+                + str(list(self.failed(probes)))
+                + " failed, they are measured again"
+            )
+            if not self.measure(self.failed(probes)):
+                return
+
+        # Fit the same model to the stored and to the measured resonances of
+        # the probes, so that only the drift and not the bias of the fit
+        # differs
+        probe_results = pd.concat(self.measured, ignore_index=True)
+        probe_results = probe_results.loc[
+            probe_results["resonance_frequency"].astype(float) > 0
+        ].drop_duplicates("capacitance", keep="last")
+        probe_caps = probe_results["capacitance"].to_numpy(dtype=float)
+        cf.log_message(
+            "Measured drift of the probes (kHz): "
+            + ", ".join(
+                str(capacitance) + " pF: " + str(round(drift, 3))
+                for capacitance, drift in zip(
+                    probe_caps,
+                    probe_results["resonance_frequency"].to_numpy(dtype=float)
+                    - stored.loc[probe_caps].to_numpy(dtype=float),
+                )
+            )
+        )
+        try:
+            reference_model = CircuitModel.fit(
+                probe_caps, stored.loc[probe_caps], self.relays(probe_caps)
+            )
+            self.model = CircuitModel.fit(
+                probe_caps,
+                probe_results["resonance_frequency"],
+                self.relays(probe_caps),
+            )
+        except ValueError:
+            cf.log_message("Not enough probes could be fitted, all are measured again")
+            drift = np.full(len(capacitances), np.inf)
+        else:
+            cf.log_message("Model of the stored probes: " + repr(reference_model))
+            cf.log_message("Model of the measured probes: " + repr(self.model))
+            relays = self.relays(capacitances)
+            drift = self.model.resonance_frequency(
+                capacitances, relays
+            ) - reference_model.resonance_frequency(capacitances, relays)
+
+        # Only the combinations that drifted too far (and were not probed)
+        drifted = capacitances[
+            (np.abs(drift) > self.measurement_parameters["drift_tolerance"])
+            & ~np.isin(capacitances, probes)
+        ]
+        cf.log_message(
+            str(len(drifted))
+            + " of "
+            + str(len(capacitances))
+            + " capacitances drifted by more than "
+            + str(self.measurement_parameters["drift_tolerance"])
+            + " kHz (maximum predicted drift "
+            + str(round(float(np.max(np.abs(drift))), 3))
+            + " kHz)"
+        )
+        if len(drifted) > 0 and not self.measure(drifted):
+            return
+
+        failed = self.failed(np.concatenate([probes, drifted]))
+        if len(failed) > 0:
+            cf.log_message(
+                "The fit of "
+                + str(list(failed))
+                + " failed, they keep their stored resonance frequency"
+            )
+
+        self.arduino.trigger_frequency_generation(False)
+        self.source.output(False, channel=2)
+        self.log_settling()
+        self.save_resonance_data()
+        self.arduino.set_capacitance(self.arduino.base_capacitance)
+
+        self.observer.scan_finished()
+
+    def save_resonance_data(self):
+        """
+        Merge the measured resonances into a new version of the store
+        """
+        measured = pd.concat(self.measured + [self.df_resonance_fit], ignore_index=True)
+        if len(measured) == 0:
+            return
+
+        version = self.store.commit(
+            merge(self.calibration, measured),
+            note="Incremental calibration",
+            measured=measured["capacitance"],
+        )
+
+        # Measure with the new version from now on (the arduino rebuilds its
+        # capacitor table when the calibration file of the settings changes)
+        data = settings_service.service.read_file()
+        data.setdefault("overwrite", copy.deepcopy(data["default"]))
+        data["overwrite"][0]["calibration_file_path"] = self.store.path(version)
+        settings_service.service.save(data)
+        cf.log_message(
+            "Calibration file of the settings set to " + self.store.path(version)
+        )
@@ -0,0 +1,178 @@
+"""
+Actor-style access to the instruments. Every instrument is owned by a single
+I/O thread that executes the commands of a priority queue one after another
+and returns the results as futures. Callers from any thread can submit
+commands without blocking and pipeline several of them, while instruments
+that are independent of each other run in parallel.
+
+    oscilloscope = InstrumentProxy(RigolOscilloscope(address), "oscilloscope")
+    oscilloscope.measure_vmax(1)  # blocks like a call of the driver
+    future = oscilloscope.worker.submit("measure_vmax", 1)  # does not block
+"""
+
+import concurrent.futures
+import itertools
+import queue
+import threading
+
+import core_functions as cf
+
+# Priorities of the commands (lower values are executed first)
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 1
+LOW_PRIORITY = 2
+
+
+class InstrumentWorker:
+    """
+    Thread that owns an instrument and executes the submitted commands in
+    order of their priority (and in order of submission for equal priority)
+    """
+
+    def __init__(self, driver, name):
+        self.driver = driver
+        self.name = name
+
+        self.queue = queue.PriorityQueue()
+        # Counter that keeps the order of submission for equal priorities
+        self.sequence = itertools.count()
+        self.is_stopped = False
+
+        self.thread = threading.Thread(
+            target=self.run, name=name + " I/O", daemon=True
+        )
+        self.thread.start()
+        workers.append(self)
+
+    def run(self):
+        """
+        Execute the commands until the worker is stopped
+        """
+        while True:
+            priority, sequence, command = self.queue.get()
+            if command is None:
+                break
+
+            function, args, kwargs, future = command
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, method, *args, priority=NORMAL_PRIORITY, **kwargs):
+        """
+        Queue a method of the driver (given by its name) or any callable that
+        takes the driver as first argument. Returns a future with the result.
+        """
+        if isinstance(method, str):
+            function = getattr(self.driver, method)
+        else:
+            function = method
+            args = (self.driver,) + args
+
+        future = concurrent.futures.Future()
+
+        # Commands that are submitted from within a command (e.g. set_voltage
+        # called by adjust_magnetic_field) are executed right away, otherwise
+        # the worker would wait for itself
+        if threading.current_thread() is self.thread:
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        if self.is_stopped:
+            raise RuntimeError("I/O worker of the " + self.name + " was stopped")
+
+        self.queue.put(
+            (priority, next(self.sequence), (function, args, kwargs, future))
+        )
+        return future
+
+    def call(self, method, *args, priority=NORMAL_PRIORITY, **kwargs):
+        """
+        Submit a command and wait for its result
+        """
+        return self.submit(method, *args, priority=priority, **kwargs).result()
+
+    def stop(self, wait=True):
+        """
+        Stop the worker after the commands that are already queued
+        """
+        if self.is_stopped:
+            return
+        self.is_stopped = True
+
+        # Sentinel that is sorted behind all queued commands
+        self.queue.put((float("inf"), next(self.sequence), None))
+        if wait and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+        if self in workers:
+            workers.remove(self)
+
+
+class InstrumentProxy:
+    """
+    Drop-in replacement of a driver that executes all method calls on the
+    I/O worker of the instrument. Attributes are read and set directly.
+    """
+
+    def __init__(self, driver, name):
+        # Set via __dict__ since __setattr__ is forwarded
+        self.__dict__["driver"] = driver
+        self.__dict__["worker"] = InstrumentWorker(driver, name)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.driver, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            return self.worker.call(name, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = attribute.__doc__
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self.driver, name, value)
+
+
+# Workers that are running
+workers = []
+
+
+def stop_all():
+    """
+    Stop the workers of all instruments
+    """
+    for worker in list(workers):
+        try:
+            worker.stop()
+        except Exception as e:
+            cf.log_message("I/O worker of the " + worker.name + " could not be stopped")
+            cf.log_message(e)
+
+
+def submit(instrument, method, *args, priority=NORMAL_PRIORITY, **kwargs):
+    """
+    Submit a command to an instrument. Drivers without worker execute the
+    command right away so that the result is available as future as well.
+    """
+    worker = getattr(instrument, "worker", None)
+    if isinstance(worker, InstrumentWorker):
+        return worker.submit(method, *args, priority=priority, **kwargs)
+
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+    try:
+        future.set_result(getattr(instrument, method)(*args, **kwargs))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
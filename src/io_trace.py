@@ -0,0 +1,326 @@
+"""
+Tracing of the communication with the instruments. The transports of the
+drivers (the pyvisa resource of the oscilloscope and the serial ports of the
+source and the arduino) are wrapped so that every command is recorded with
+its replies, the time spent in I/O, timeouts and retries. The last commands
+are kept in a ring buffer and the latencies are collected in HDR-style
+histograms per command type.
+"""
+
+import collections
+import csv
+import json
+import math
+import re
+import threading
+import time
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram: every power of two is divided into a fixed number of
+    linear sub buckets so that the relative error of the recorded values is
+    bounded (1/32 ~ 3 % by default) over the whole range from microseconds to
+    minutes at constant memory.
+    """
+
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+
+    def bucket(self, value):
+        """
+        Index of the bucket of a value in microseconds
+        """
+        value = max(int(value), 1)
+        magnitude = value.bit_length() - 1
+        shift = max(magnitude - self.sub_bucket_bits, 0)
+        return (magnitude, value >> shift)
+
+    def bucket_value(self, bucket):
+        """
+        Highest value in microseconds that falls into a bucket
+        """
+        magnitude, sub_bucket = bucket
+        shift = max(magnitude - self.sub_bucket_bits, 0)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, latency):
+        """
+        Record a latency in s
+        """
+        self.counts[self.bucket(latency * 1e6)] += 1
+        self.count += 1
+        self.total += latency
+        self.minimum = min(self.minimum, latency)
+        self.maximum = max(self.maximum, latency)
+
+    def percentile(self, percentile):
+        """
+        Latency in s below which the given percentage of values lie
+        """
+        if self.count == 0:
+            return None
+
+        threshold = percentile / 100 * self.count
+        cumulative = 0
+        for bucket in sorted(self.counts):
+            cumulative += self.counts[bucket]
+            if cumulative >= threshold:
+                return min(self.bucket_value(bucket) * 1e-6, self.maximum)
+
+        return self.maximum
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.maximum if self.count else None,
+            "total": self.total,
+        }
+
+
+def command_type(command):
+    """
+    Type of a command that is used to group the latencies, e.g. :MEAS:VMAX?
+    for ":MEAS:VMAX? CHAN1", VSET for "VSET2:5.0" and freq for "freq_145000"
+    """
+    command = command.strip()
+    if command.startswith((":", "*")) or " " in command:
+        return command.split(" ")[0]
+    return re.split(r"[\d_:?]", command, maxsplit=1)[0] + (
+        "?" if command.endswith("?") else ""
+    )
+
+
+class IOTracer:
+    """
+    Collects the traced commands of all instruments
+    """
+
+    def __init__(self, buffer_size=10000):
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=buffer_size)
+        self.histograms = {}
+        self.transports = []
+        self.enabled = True
+
+    def flush(self):
+        """
+        Record the commands that are still waiting for further replies
+        """
+        for transport in self.transports:
+            transport.finish()
+
+    def record(self, event):
+        """
+        Store a finished command
+        """
+        with self.lock:
+            self.events.append(event)
+            key = (event["instrument"], event["type"])
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+            self.histograms[key].record(event["io_time"])
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.histograms = {}
+
+    def statistics(self):
+        """
+        Latency statistics per instrument and command type (slowest first)
+        """
+        with self.lock:
+            statistics = [
+                dict(instrument=instrument, type=command, **histogram.summary())
+                for (instrument, command), histogram in self.histograms.items()
+            ]
+        return sorted(statistics, key=lambda row: row["total"], reverse=True)
+
+    def export(self, file_path):
+        """
+        Write the trace (as JSON lines or as csv if the file ends on .csv)
+        """
+        self.flush()
+        with self.lock:
+            events = list(self.events)
+
+        if file_path.endswith(".csv"):
+            with open(file_path, "w", newline="") as trace_file:
+                writer = csv.DictWriter(trace_file, fieldnames=EVENT_FIELDS)
+                writer.writeheader()
+                writer.writerows(events)
+        else:
+            with open(file_path, "w") as trace_file:
+                for event in events:
+                    trace_file.write(json.dumps(event) + "\n")
+
+
+EVENT_FIELDS = [
+    "time",
+    "instrument",
+    "command",
+    "type",
+    "bytes_written",
+    "bytes_read",
+    "io_time",
+    "elapsed",
+    "timeout",
+    "retries",
+    "error",
+]
+
+# Tracer that is used unless another one is given
+tracer = IOTracer()
+
+
+class TracedTransport:
+    """
+    Wraps a pyvisa resource or serial port. A command starts with a write
+    and includes all reads until the next write. Everything that is not
+    traced is forwarded to the transport.
+    """
+
+    def __init__(self, transport, instrument, io_tracer=None):
+        # Set via __dict__ since __setattr__ is forwarded
+        self.__dict__["transport"] = transport
+        self.__dict__["instrument"] = instrument
+        self.__dict__["tracer"] = io_tracer if io_tracer is not None else tracer
+        self.__dict__["event"] = None
+        self.__dict__["start"] = None
+        self.__dict__["event_lock"] = threading.Lock()
+        self.tracer.transports.append(self)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.transport, name, value)
+
+    def finish(self):
+        """
+        Record the current command
+        """
+        with self.event_lock:
+            event = self.event
+            self.__dict__["event"] = None
+        if event is not None:
+            self.tracer.record(event)
+
+    def write(self, data):
+        if not self.tracer.enabled:
+            return self.transport.write(data)
+
+        command = data.decode(errors="replace") if isinstance(data, bytes) else data
+        command = command.strip()
+
+        # A command that is sent again right after it failed is a retry
+        previous = self.event
+        retries = 0
+        if (
+            previous is not None
+            and previous["command"] == command
+            and (previous["timeout"] or previous["error"])
+        ):
+            retries = previous["retries"] + 1
+        self.finish()
+
+        event = {
+            "time": time.time(),
+            "instrument": self.instrument,
+            "command": command,
+            "type": command_type(command),
+            "bytes_written": len(data),
+            "bytes_read": 0,
+            "io_time": 0.0,
+            "elapsed": 0.0,
+            "timeout": False,
+            "retries": retries,
+            "error": None,
+        }
+        self.__dict__["event"] = event
+
+        start = time.perf_counter()
+        self.__dict__["start"] = start
+        try:
+            return self.transport.write(data)
+        except Exception as e:
+            event["error"] = type(e).__name__
+            raise
+        finally:
+            event["io_time"] += time.perf_counter() - start
+            event["elapsed"] = time.perf_counter() - start
+
+    def traced_read(self, read_function, *args, expected=None, **kwargs):
+        """
+        Time a read and attribute it to the last command
+        """
+        if not self.tracer.enabled or self.event is None:
+            return read_function(*args, **kwargs)
+
+        event = self.event
+        start = time.perf_counter()
+        try:
+            data = read_function(*args, **kwargs)
+        except Exception as e:
+            event["error"] = type(e).__name__
+            if "timeout" in str(e).lower() or "Timeout" in type(e).__name__:
+                event["timeout"] = True
+            raise
+        finally:
+            event["io_time"] += time.perf_counter() - start
+            event["elapsed"] = time.perf_counter() - self.start
+
+        event["bytes_read"] += len(data)
+        # Serial ports return less than expected if the timeout expired
+        if len(data) == 0 or (expected is not None and 0 <= len(data) < expected):
+            event["timeout"] = True
+
+        return data
+
+    def read(self, *args, **kwargs):
+        expected = args[0] if args else kwargs.get("size")
+        return self.traced_read(
+            self.transport.read, *args, expected=expected, **kwargs
+        )
+
+    def readline(self, *args, **kwargs):
+        return self.traced_read(self.transport.readline, *args, **kwargs)
+
+    def readall(self):
+        return self.traced_read(self.transport.readall)
+
+    def read_raw(self, *args, **kwargs):
+        return self.traced_read(self.transport.read_raw, *args, **kwargs)
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+
+def trace_instruments(arduino=None, source=None, oscilloscope=None, io_tracer=None):
+    """
+    Wrap the transports of the given drivers (if not yet done). Drivers
+    without transport (e.g. the mock classes) are ignored.
+    """
+    for driver, attribute, name in [
+        (arduino, "arduino", "arduino"),
+        (source, "source", "source"),
+        (oscilloscope, "osci", "oscilloscope"),
+    ]:
+        if driver is None or not hasattr(driver, attribute):
+            continue
+        transport = getattr(driver, attribute)
+        if isinstance(transport, TracedTransport):
+            continue
+        setattr(driver, attribute, TracedTransport(transport, name, io_tracer))
@@ -6,12 +6,15 @@ import numpy as np
 import pandas as pd
 
 import core_functions as cf
+import demodulation
+import timed_schedule
 import physics_functions as pf
+from scan_engine import ScanEngine, ScanObserver
 
 from scipy.ndimage.filters import uniform_filter1d
 
 
-class LTScan(QtCore.QThread):
+class LTScan(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -33,38 +36,114 @@ class LTScan(QtCore.QThread):
         parent=None,
     ):
         super(LTScan, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.measurement_parameters = measurement_parameters
-        self.setup_parameters = setup_parameters
-
-        self.global_parameters = cf.read_global_settings()
-
         # Connect signal to the updater from the parent class
         self.update_lt_scan_plot.connect(parent.update_lt_plot)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
         self.pause_thread_lt_scan.connect(parent.pause_lt_measurement)
 
-        # Define dataframe to store data in
-        self.df_data = pd.DataFrame(
-            columns=["time", "current", "me_voltage", "hf_field"]
+        # The scan itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = LTScanEngine(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer=self,
+        )
+
+    @property
+    def pause(self):
+        """
+        The pause state is set by the main window but owned by the engine
+        """
+        return self.engine.pause
+
+    @pause.setter
+    def pause(self, status):
+        self.engine.pause = status
+
+    def run(self):
+        """
+        Run the lifetime scan engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, time, me_voltage, hf_field):
+        """
+        Forward the measured data to the main window
+        """
+        self.update_lt_scan_plot.emit(time, me_voltage, hf_field)
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def pause_measurement(self, status):
+        """
+        Ask the user (asynchronously) to insert the OLED
+        """
+        self.pause_thread_lt_scan.emit(status)
+        return None
+
+    def scan_finished(self):
+        """
+        Release the start button once the scan is done
+        """
+        self.parent.ltw_start_measurement_pushButton.setChecked(False)
+
+
+class LTScanEngine(ScanEngine):
+    """
+    Engine that does a lifetime measurement independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(LTScanEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
         )
 
-        self.is_killed = False
+        # Define dataframe to store data in
+        columns = ["time", "current", "me_voltage", "hf_field"]
+        if self.lock_in_mode:
+            # Phase (relative to the pickup coil) and noise of the ME voltage
+            columns += ["me_phase", "me_noise"]
+        self.df_data = pd.DataFrame(columns=columns)
+
         self.last_file_path = ""
 
         self.source.set_current(2, channel=2)
         if measurement_parameters["constant_magnetic_field_mode"]:
-            pid_parameters = np.array(
-                self.global_parameters["pid_parameters"].split(","), dtype=float
-            )
+            pid_parameters = np.array(self.global_parameters.pid_parameters)
             self.source.start_constant_magnetic_field_mode(
                 pid_parameters,
                 self.measurement_parameters["hf_voltage"],
@@ -100,10 +179,6 @@ class LTScan(QtCore.QThread):
         # self.measurement_parameters["maximum_frequency"],
         # self.measurement_parameters["frequency_step"],
         # )
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Init data saving
         self.save_data_init()
 
@@ -126,7 +201,7 @@ class LTScan(QtCore.QThread):
         #     )
 
         # Set frequency
-        self.arduino.set_frequency(
+        self.set_frequency(
             self.measurement_parameters["frequency"],
             self.measurement_parameters["autoset_capacitance"],
         )
@@ -165,11 +240,16 @@ class LTScan(QtCore.QThread):
         #     )
 
         # Counter to iterate over array where data is stored
-        time_step_list = np.arange(
-            0,
-            self.measurement_parameters["total_time"] + 1,
-            self.measurement_parameters["time_step"],
-        )
+        if self.measurement_parameters.get("log_time_steps", False):
+            time_step_list = timed_schedule.log_schedule(
+                self.measurement_parameters["total_time"],
+                self.measurement_parameters["time_step"],
+            )
+        else:
+            time_step_list = timed_schedule.linear_schedule(
+                self.measurement_parameters["total_time"],
+                self.measurement_parameters["time_step"],
+            )
 
         self.osci_data = pd.DataFrame(
             columns=np.concatenate(
@@ -203,129 +283,147 @@ class LTScan(QtCore.QThread):
         # Function to do moving average
 
         self.osci_data["cal"] = uniform_filter1d(osci_data_raw, 20)
+        if self.lock_in_mode:
+            # The ME signal is on channel 2 and the pickup coil on channel 1
+            self.calibration = self.demodulate(
+                time_data, self.osci_data["cal_field"], osci_data_raw
+            )
 
         self.source.output(False, channel=2)
         # After calibration, tell user to insert OLED
-        self.pause = "True"
-        self.pause_thread_lt_scan.emit("on")
-
-        while self.pause == "True":
-            time.sleep(0.1)
-            if self.pause == "break":
-                # Take the time at the beginning to measure the length of the entire
-                # measurement
-                absolute_starting_time = time.time()
-                break
-            elif self.pause == "return":
-                return
+        if not self.wait_for_user("on"):
+            return
+
+        # Take the time at the beginning to measure the length of the entire
+        # measurement
+        absolute_starting_time = time.time()
 
         self.source.output(True, channel=2)
 
-        initial_time = time.time()
-        i = 0
-
-        while (time.time() - initial_time) <= (
-            self.measurement_parameters["total_time"] + 0.1
-        ):
-            if (time.time() - initial_time) >= time_step_list[i]:
-                # Readjust magnetic field to initial value
-                """
-                if self.measurement_parameters["constant_magnetic_field_mode"]:
-                    # Adjust the magnetic field
-                    pid_voltage, elapsed_time = self.source.adjust_magnetic_field(
-                        self.global_parameters["pickup_coil_windings"],
-                        self.global_parameters["pickup_coil_radius"],
-                        self.measurement_parameters["frequency"],
-                        self.oscilloscope,
-                        break_if_too_long=True,
-                        channel=2,
-                    )
-                """
-
-                self.df_data.loc[i, "time"] = time.time() - initial_time
-
-                # Measure the voltage and current (and possibly parameters on the osci)
-                # me_voltage = float(self.oscilloscope.measure_vmax(channel=1))
-                # self.oscilloscope.auto_scale(1)
-                (
-                    self.osci_data[str(time_step_list[i]) + "_time"],
+        # The steps are captured at fixed times after the start, independent
+        # of how long a capture takes
+        scheduler = timed_schedule.TimedScheduler(
+            time_step_list,
+            skip_missed=self.measurement_parameters.get("skip_missed_steps", False),
+        )
+        for i, planned_time in scheduler.steps(should_stop=lambda: self.is_killed):
+            # Readjust magnetic field to initial value
+            """
+            if self.measurement_parameters["constant_magnetic_field_mode"]:
+                # Adjust the magnetic field
+                pid_voltage, elapsed_time = self.source.adjust_magnetic_field(
+                    self.global_parameters["pickup_coil_windings"],
+                    self.global_parameters["pickup_coil_radius"],
+                    self.measurement_parameters["frequency"],
+                    self.oscilloscope,
+                    break_if_too_long=True,
+                    channel=2,
+                )
+            """
+
+            # Actual time of the capture (on the clock of the scheduler)
+            self.df_data.loc[i, "time"] = scheduler.elapsed()
+
+            # Measure the voltage and current (and possibly parameters on the osci)
+            # me_voltage = float(self.oscilloscope.measure_vmax(channel=1))
+            # self.oscilloscope.auto_scale(1)
+            (
+                self.osci_data[str(time_step_list[i]) + "_time"],
+                raw_field,
+            ) = self.oscilloscope.get_data("CHAN1")
+            self.osci_data[str(time_step_list[i]) + "_field"] = (
+                pf.calculate_magnetic_field_from_Vind(
+                    self.global_parameters["pickup_coil_windings"],
+                    self.global_parameters["pickup_coil_radius"] * 1e-3,
                     raw_field,
-                ) = self.oscilloscope.get_data("CHAN1")
-                self.osci_data[str(time_step_list[i]) + "_field"] = (
-                    pf.calculate_magnetic_field_from_Vind(
-                        self.global_parameters["pickup_coil_windings"],
-                        self.global_parameters["pickup_coil_radius"] * 1e-3,
-                        raw_field,
-                        float(self.measurement_parameters["frequency"]) * 1e3,
-                    )
-                    * 1e3
+                    float(self.measurement_parameters["frequency"]) * 1e3,
                 )
-                (
-                    time_data,
-                    osci_data_raw,
-                ) = self.oscilloscope.get_data("CHAN2")
+                * 1e3
+            )
+            (
+                time_data,
+                osci_data_raw,
+            ) = self.oscilloscope.get_data("CHAN2")
 
-                self.osci_data[str(time_step_list[i])] = uniform_filter1d(
-                    osci_data_raw, 20
-                )
+            self.osci_data[str(time_step_list[i])] = uniform_filter1d(
+                osci_data_raw, 20
+            )
 
+            if self.lock_in_mode:
+                lock_in = demodulation.subtract(
+                    self.demodulate(time_data, osci_data_raw, raw_field),
+                    self.calibration,
+                )
+                me_voltage = lock_in.amplitude
+                self.df_data.loc[i, "me_phase"] = lock_in.phase
+                self.df_data.loc[i, "me_noise"] = lock_in.noise
+            else:
                 me_voltage = np.max(
                     self.osci_data[str(time_step_list[i])] - self.osci_data["cal"]
                 )
 
-                # Set the variables in the dataframe
-                (
-                    voltage,
-                    self.df_data.loc[i, "current"],
-                ) = self.source.read_values(channel=2)
+            # Set the variables in the dataframe
+            (
+                voltage,
+                self.df_data.loc[i, "current"],
+            ) = self.read_source(2)
 
-                self.df_data.loc[i, "me_voltage"] = me_voltage
-                self.df_data.loc[i, "hf_field"] = np.max(
-                    self.osci_data[str(time_step_list[i]) + "_field"]
-                )
+            self.df_data.loc[i, "me_voltage"] = me_voltage
+            self.df_data.loc[i, "hf_field"] = np.max(
+                self.osci_data[str(time_step_list[i]) + "_field"]
+            )
 
-                # Update progress bar
-                self.update_progress_bar.emit(
-                    "value", int((i + 1) / len(time_step_list) * 100)
-                )
+            # Update progress bar
+            self.observer.update_progress(int((i + 1) / len(time_step_list) * 100))
 
-                self.update_lt_scan_plot.emit(
-                    self.df_data["time"],
-                    self.df_data["me_voltage"],
-                    self.df_data["hf_field"],
-                )
-                self.save_data_individually()
+            self.observer.update_plot(
+                self.df_data["time"],
+                self.df_data["me_voltage"],
+                self.df_data["hf_field"],
+            )
+            self.save_data_individually()
+
+            cf.log_message(
+                "Step "
+                + str(i)
+                + " planned at "
+                + str(planned_time)
+                + " s captured from "
+                + str(round(scheduler.capture_times[i, 0], 3))
+                + " s to "
+                + str(round(scheduler.elapsed(), 3))
+                + " s"
+            )
 
-                # Increase iterator
-                i += 1
+        if self.is_killed:
+            # Close the connection to the spectrometer
+            self.source.output(False, channel=2)
+            self.source.set_voltage(1, channel=2)
+            self.source.output(False, channel=1)
+            self.arduino.set_frequency(1000, True)
+            self.save_data_osci()
+            # self.parent.oscilloscope_thread.pause = False
+            return
 
-            else:
-                if self.is_killed:
-                    # Close the connection to the spectrometer
-                    self.source.output(False, channel=2)
-                    self.source.set_voltage(1, channel=2)
-                    self.source.output(False, channel=1)
-                    self.arduino.set_frequency(1000, True)
-                    self.save_data_osci()
-                    # self.parent.oscilloscope_thread.pause = False
-                    self.quit()
-                    return
-
-                time.sleep(0.1)
+        cf.log_message(scheduler.summary())
 
         self.source.output(False, channel=2)
         self.source.output(False, channel=1)
         self.save_data_osci()
-        self.parent.ltw_start_measurement_pushButton.setChecked(False)
-        self.arduino.set_frequency(1000, True)
+        self.reset_frequency()
 
         # self.parent.oscilloscope_thread.pause = False
 
-    def kill(self):
+        self.observer.scan_finished()
+
+    def interval_header(self):
         """
-        Kill thread while running
+        Name of the interval in the header (the first interval is given for
+        log-spaced steps)
         """
-        self.is_killed = True
+        if self.measurement_parameters.get("log_time_steps", False):
+            return "First Measurement Interval (log-spaced):   "
+        return "Measurement Interval:   "
 
     def save_data_init(self):
         """
@@ -360,8 +458,10 @@ class LTScan(QtCore.QThread):
             )
 
         line04 = (
-            "Frequency: " + str(self.measurement_parameters["frequency"]) + " kHz \t"
-            "Measurement Interval:   "
+            "Frequency: "
+            + str(self.measurement_parameters["frequency"])
+            + " kHz \t"
+            + self.interval_header()
             + str(self.measurement_parameters["time_step"])
             + " s \t"
             + "Total Measurement Time:   "
@@ -372,7 +472,11 @@ class LTScan(QtCore.QThread):
         line06 = (
             "Time\t Current\t ME Voltage\t HF Field (pickup not necessarily centred)"
         )
-        line07 = "s\t A\t V\t V (a.u.)\n"
+        line07 = "s\t A\t V\t V (a.u.)"
+        if self.lock_in_mode:
+            line06 += "\t ME Phase\t ME Noise"
+            line07 += "\t rad\t V"
+        line07 += "\n"
 
         header_lines = [
             line02,
@@ -429,8 +533,10 @@ class LTScan(QtCore.QThread):
             )
 
         line04 = (
-            "Frequency: " + str(self.measurement_parameters["frequency"]) + " kHz \t"
-            "Measurement Interval:   "
+            "Frequency: "
+            + str(self.measurement_parameters["frequency"])
+            + " kHz \t"
+            + self.interval_header()
             + str(self.measurement_parameters["time_step"])
             + " s \t"
             + "Total Measurement Time:   "
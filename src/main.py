@@ -1,5 +1,6 @@
 from UI_main_window import Ui_MainWindow
 from settings import Settings
+from trace_window import TraceWindow
 from loading_window import LoadingWindow
 
 from frequency_measurement import FrequencyScan
@@ -13,14 +14,19 @@ from setup import SetupThread
 from oscilloscope_measurement import OscilloscopeThread
 from lifetime_measurement import LTScan
 from pid_tuning import PIDScan
-from pulsing_sweep import PulsingSweep
+from pulsing_sweep import PulsingSweep, read_pulsing_file
 
 from hardware import (
+    MEASUREMENT_ITEMS,
     KoradKD3305PSource,
     RigolOscilloscope,
     Arduino,
 )
 
+from io_trace import trace_instruments
+from instrument_worker import InstrumentProxy
+import instrument_worker
+
 import core_functions as cf
 import physics_functions as pf
 
@@ -30,8 +36,6 @@ import time
 import os
 import sys
 import datetime as dt
-import logging
-from logging.handlers import RotatingFileHandler
 
 import numpy as np
 import pandas as pd
@@ -94,6 +98,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
         self.actionOpen_Log.triggered.connect(lambda: self.open_file("./usr/log.out"))
 
+        self.actionIO_Trace.triggered.connect(self.show_trace_window)
+
         # -------------------------------------------------------------------- #
         # --------------------------- Setup Widget --------------------------- #
         # -------------------------------------------------------------------- #
@@ -487,26 +493,39 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
         result = self.settings_window.exec()
 
+    def show_trace_window(self):
+        """
+        Shows the debug panel with the latencies of the instrument commands
+        """
+        self.trace_window = TraceWindow(self)
+        self.trace_window.show()
+
     @QtCore.Slot(RigolOscilloscope)
     def init_oscilloscope(self, oscilloscope_object):
         """
         Inits oscilloscope
         """
-        self.oscilloscope = oscilloscope_object
+        trace_instruments(oscilloscope=oscilloscope_object)
+        # All calls are executed by the I/O thread of the oscilloscope
+        self.oscilloscope = InstrumentProxy(oscilloscope_object, "oscilloscope")
 
     @QtCore.Slot(KoradKD3305PSource)
     def init_source(self, source_object):
         """
         Receives a hf_source object from the init thread
         """
-        self.source = source_object
+        trace_instruments(source=source_object)
+        # All calls are executed by the I/O thread of the source
+        self.source = InstrumentProxy(source_object, "source")
 
     @QtCore.Slot(Arduino)
     def init_arduino(self, arduino_object):
         """
         Receives an arduino object from the init thread
         """
-        self.arduino = arduino_object
+        trace_instruments(arduino=arduino_object)
+        # All calls are executed by the I/O thread of the arduino
+        self.arduino = InstrumentProxy(arduino_object, "arduino")
 
     def open_file(self, path):
         """
@@ -543,6 +562,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             cf.log_message("Arduino connection could not be savely killed")
             cf.log_message(e)
 
+        # Stop the I/O threads of the instruments
+        instrument_worker.stop_all()
+
         # if can_exit:
         event.accept()  # let the window close
         # else:
@@ -597,7 +619,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
                     pf.calculate_magnetic_field_from_Vind(
                         self.initial_global_parameters["pickup_coil_windings"],
                         self.initial_global_parameters["pickup_coil_radius"] * 1e-3,
-                        float(self.oscilloscope.measure_vmax(1)),
+                        float(
+                            self.oscilloscope.measure_vmax(1, self.arduino.frequency)
+                        ),
                         self.arduino.frequency * 1e3,
                     )
                     * 1e3
@@ -856,17 +880,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         """
         Function that translates the pulse code to time vs magnetic field data
         """
-        # Read in data
-        # raw_pulsing_data=pd.read_csv("C:\\Users\\GatherLab-Julian\\Desktop\\pulsing.txt", delimiter="\t")
-        pulsing_data = pd.read_csv(
-            self.pulsew_folder_path_lineEdit.text(), delimiter="\t", skiprows=1
-        )
-
-        # Set the fields to zero in case of off state
-        pulsing_data.loc[pulsing_data["signal"] == "OFF", "hf_field"] = 0
-        pulsing_data.loc[pulsing_data["signal"] == "OFF", "dc_field"] = 0
-        pulsing_data["time"] = np.cumsum(pulsing_data["time"].to_numpy())
-        return pulsing_data
+        return read_pulsing_file(self.pulsew_folder_path_lineEdit.text())
 
     def update_pulse_plot(self, pulsing_data):
         """
@@ -905,6 +919,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         """
         pulsing_sweep_parameters = {
             "constant_mode": self.pulsew_constant_parameter_mode_toggleSwitch.isChecked(),
+            "hardware_timing": self.pulsew_hardware_timing_toggleSwitch.isChecked(),
         }
 
         # Update statusbar
@@ -1110,6 +1125,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             "autoset_capacitance": self.bw_autoset_capacitance_toggleSwitch.isChecked(),
             "constant_magnetic_field_mode": self.bw_constant_magnetic_field_mode_toggleSwitch.isChecked(),
             "reverse_sweep": self.bw_reverse_sweep_toggleSwitch.isChecked(),
+            "search_optimum": self.bw_search_optimum_toggleSwitch.isChecked(),
         }
 
         # Update statusbar
@@ -1340,6 +1356,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             "hf_voltage": self.ltw_hf_magnetic_field_spinBox.value(),
             "total_time": self.ltw_total_time_spinBox.value(),
             "time_step": self.ltw_time_step_spinBox.value(),
+            "log_time_steps": self.ltw_log_time_steps_toggleSwitch.isChecked(),
+            "skip_missed_steps": self.ltw_skip_missed_steps_toggleSwitch.isChecked(),
             "autoset_capacitance": self.ltw_autoset_capacitance_toggleSwitch.isChecked(),
             "constant_magnetic_field_mode": self.ltw_constant_magnetic_field_mode_toggleSwitch.isChecked(),
         }
@@ -1671,21 +1689,35 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         df.time_chan2 = time_data2
         df.voltage_chan2 = data2
 
-        variables = self.oscilloscope.measure()
+        # All measurement items of both channels (one request per channel)
+        measurement_lines = []
+        for channel in [1, 2]:
+            measurement = self.oscilloscope.measure_set(channel=channel)
+            measurement_lines.append(
+                "CHAN"
+                + str(channel)
+                + "\t "
+                + "\t ".join(
+                    MEASUREMENT_ITEMS[item][0]
+                    + ": "
+                    + str(value)
+                    + " "
+                    + MEASUREMENT_ITEMS[item][1]
+                    for item, value in measurement._asdict().items()
+                )
+            )
 
         # Define Header
-        line01 = "VPP:   " + str(variables[0]) + " V \t"
-        line02 = "### Measurement data ###"
-        line03 = (
+        line01 = "### Measurement data ###"
+        line02 = (
             "Time Channel 1\t Voltage Channel 1\t Time Channel 2\t Voltage Channel 2"
         )
-        line04 = "s\t V\t s\t V\n"
+        line03 = "s\t V\t s\t V\n"
 
-        header_lines = [
+        header_lines = measurement_lines + [
             line01,
             line02,
             line03,
-            line04,
         ]
 
         # Write header lines to file
@@ -1814,21 +1846,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
 
 # Logging
-# Prepare file path etc. for logging
-LOG_FILENAME = "./usr/log.out"
-logging.basicConfig(
-    filename=LOG_FILENAME,
-    level=logging.INFO,
-    format=(
-        "%(asctime)s - [%(levelname)s] -"
-        " (%(filename)s).%(funcName)s(%(lineno)d) - %(message)s"
-    ),
-    datefmt="%m/%d/%Y %I:%M:%S %p",
-)
-
-# Activate log_rotate to rotate log files after it reached 1 MB size ()
-handler = RotatingFileHandler(LOG_FILENAME, maxBytes=1000000)
-logging.getLogger("Rotating Log").addHandler(handler)
+cf.setup_entry_point_logging()
 
 
 # ---------------------------------------------------------------------------- #
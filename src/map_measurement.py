@@ -0,0 +1,458 @@
+"""
+Map of the ME response over the frequency and the dc bias field in a single
+scan. The sources are initialised once and the points of the grid are
+traversed in the order that needs the least time: the grid is run through
+row by row along the slow axis with the direction along the fast axis
+alternating between the rows (serpentine), so that no row starts with a jump
+back. Which axis is the slow one is decided by a cost model of the slow
+operations (switching the capacitors, slewing the bias field and settling).
+The capacitors are only switched when the frequency needs a different
+combination. Optionally, points are added halfway around the ridge of maximum
+response after the grid was measured. The ME voltage is saved as one array
+with a row per bias field and a column per frequency.
+"""
+
+import time
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+import core_functions as cf
+import physics_functions as pf
+from pulse_sequence import relay_mask
+from scan_engine import ScanEngine
+from sweep_pipeline import SweepPipeline
+
+# Assumed duration (s) of the slow operations (see the benchmark), used to
+# choose the order in which the grid is traversed
+COSTS = {"frequency": 0.1, "capacitance": 0.35, "bias_field": 0.45}
+
+
+def serpentine(points, outer_axis):
+    """
+    Order points (frequency, bias field) row by row along the outer axis (0:
+    frequency, 1: bias field) and reverse the direction of every second row
+    """
+    inner_axis = 1 - outer_axis
+    rows = {}
+    for point in points:
+        rows.setdefault(point[outer_axis], []).append(point)
+
+    order = []
+    for row_number, outer_value in enumerate(sorted(rows)):
+        row = sorted(rows[outer_value], key=lambda point: point[inner_axis])
+        order.extend(row if row_number % 2 == 0 else row[::-1])
+    return order
+
+
+def traversal_time(
+    points,
+    combination=None,
+    costs=COSTS,
+    frequency_settling_time=0,
+    bias_field_settling_time=0,
+):
+    """
+    Estimated time (s) to set all points in the given order. combination
+    returns the capacitor combination of a frequency (None if the capacitors
+    are not switched).
+    """
+    duration = 0
+    previous_frequency, previous_bias_field = None, None
+    for frequency, bias_field in points:
+        settling_time = 0
+        if frequency != previous_frequency:
+            duration += costs["frequency"]
+            settling_time = frequency_settling_time
+            if combination is not None and (
+                previous_frequency is None
+                or combination(frequency) != combination(previous_frequency)
+            ):
+                duration += costs["capacitance"]
+        if bias_field != previous_bias_field:
+            duration += costs["bias_field"]
+            settling_time = max(settling_time, bias_field_settling_time)
+
+        duration += settling_time
+        previous_frequency, previous_bias_field = frequency, bias_field
+
+    return duration
+
+
+def plan_traversal(points, **kwargs):
+    """
+    Serpentine order of the points with the shorter estimated time (the
+    keyword arguments are passed to traversal_time). Returns the order, the
+    slow axis and the estimated time.
+    """
+    candidates = [
+        (traversal_time(serpentine(points, axis), **kwargs), axis) for axis in [1, 0]
+    ]
+    duration, axis = min(candidates)
+    return serpentine(points, axis), axis, duration
+
+
+def ridge_refinement(grid, frequency_step):
+    """
+    Points halfway between the frequency of maximum response of every bias
+    field (row of the grid) and its neighbours that were not measured yet
+    """
+    frequencies = grid.columns.to_numpy(dtype=float)
+    points = []
+    for bias_field, row in grid.iterrows():
+        if row.isna().all():
+            continue
+
+        frequency = frequencies[np.nanargmax(row.to_numpy(dtype=float))]
+        for candidate in [
+            frequency - frequency_step / 2,
+            frequency + frequency_step / 2,
+        ]:
+            if frequencies.min() < candidate < frequencies.max() and not np.any(
+                np.isclose(frequencies, candidate)
+            ):
+                points.append((candidate, bias_field))
+
+    return points
+
+
+class MapScanEngine(ScanEngine):
+    """
+    Engine that maps the ME voltage over frequency and dc bias field
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(MapScanEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            measurement_parameters,
+            setup_parameters,
+            observer,
+            reuse_hardware,
+        )
+
+        # Define dataframe to store data in (one row per measured point)
+        self.df_data = pd.DataFrame(
+            columns=[
+                "frequency",
+                "bias_field",
+                "dc_field",
+                "current",
+                "me_voltage",
+                "hf_magnetic_field",
+            ]
+        )
+
+    def axis(self, minimum, maximum, step):
+        """
+        Values of an axis from the minimum to the maximum
+        """
+        return np.linspace(
+            self.measurement_parameters[minimum],
+            self.measurement_parameters[maximum],
+            int(
+                np.abs(
+                    self.measurement_parameters[maximum]
+                    - self.measurement_parameters[minimum]
+                )
+                / self.measurement_parameters[step]
+            )
+            + 1,
+        )
+
+    def combination(self, frequency):
+        """
+        Capacitor combination the arduino sets for a frequency
+        """
+        return relay_mask(self.arduino, frequency)
+
+    def plan(self, points):
+        """
+        Order the points to minimise the time needed to set them
+        """
+        points, axis, duration = plan_traversal(
+            points,
+            combination=(
+                self.combination
+                if self.measurement_parameters["autoset_capacitance"]
+                else None
+            ),
+            frequency_settling_time=self.measurement_parameters[
+                "frequency_settling_time"
+            ],
+            bias_field_settling_time=self.measurement_parameters[
+                "bias_field_settling_time"
+            ],
+        )
+        cf.log_message(
+            str(len(points))
+            + " map points ordered with the "
+            + ["frequency", "bias field"][axis]
+            + " as slow axis (estimated "
+            + str(round(duration, 1))
+            + " s without the readout)"
+        )
+        return points
+
+    def run(self):
+        """
+        Measure the ME voltage on all points of the map
+        """
+        start_time = time.time()
+
+        # Set voltage and current (they shall remain constant over the entire map)
+        self.source.set_voltage(20, channel=1)
+        self.source.set_voltage(self.measurement_parameters["voltage"], channel=2)
+        self.source.set_current(
+            self.measurement_parameters["current_compliance"], channel=2
+        )
+
+        frequencies = self.axis(
+            "minimum_frequency", "maximum_frequency", "frequency_step"
+        )
+        bias_fields = self.axis("minimum_dc_field", "maximum_dc_field", "dc_field_step")
+        points = self.plan(
+            [
+                (frequency, bias_field)
+                for bias_field in bias_fields
+                for frequency in frequencies
+            ]
+        )
+
+        # The refinement adds two points per bias field
+        self.number_of_steps = len(points)
+        if self.measurement_parameters["refine_ridge"]:
+            self.number_of_steps += 2 * len(bias_fields)
+
+        self.source.output(True, channel=1)
+        self.source.output(True, channel=2)
+        self.arduino.trigger_frequency_generation(True)
+
+        self.i = 0
+        self.current_point = (None, None)
+        self.current_combination = None
+        with SweepPipeline(self.process_step, self.record_step) as pipeline:
+            if not self.measure_points(points, pipeline):
+                return
+
+        if self.measurement_parameters["refine_ridge"]:
+            # The grid has to be complete (all points recorded) to find the
+            # ridge
+            refinement = ridge_refinement(
+                self.grid(), self.measurement_parameters["frequency_step"]
+            )
+            self.number_of_steps = self.i + len(refinement)
+            with SweepPipeline(self.process_step, self.record_step) as pipeline:
+                if not self.measure_points(self.plan(refinement), pipeline):
+                    return
+
+        self.source.output(False, channel=1)
+        self.source.output(False, channel=2)
+        self.arduino.trigger_frequency_generation(False)
+        self.log_settling()
+        self.save_data()
+        self.reset_frequency()
+
+        cf.log_message(
+            "Map of "
+            + str(self.i)
+            + " points measured in "
+            + str(round(time.time() - start_time, 1))
+            + " s"
+        )
+        self.observer.scan_finished()
+
+    def measure_points(self, points, pipeline):
+        """
+        Measure the points in the given order. Returns False if the scan was
+        killed.
+        """
+        for frequency, bias_field in points:
+            self.set_point(frequency, bias_field)
+
+            (me_voltage, pickup_voltage), source_values = self.read_step(
+                oscilloscope=lambda: self.read_oscilloscope(frequency),
+                source=lambda: self.read_source(1),
+            )
+
+            # The magnetic field is calculated and the data is stored and
+            # plotted by the pipeline while the next point is set
+            pipeline.put(
+                self.i,
+                (frequency, bias_field, me_voltage, pickup_voltage, source_values),
+            )
+            self.i += 1
+
+            if self.is_killed:
+                self.source.output(False, channel=2)
+                self.source.set_voltage(1, channel=2)
+                self.source.output(False, channel=1)
+                self.arduino.set_frequency(1000, True)
+                self.arduino.trigger_frequency_generation(False)
+                return False
+
+        return True
+
+    def set_point(self, frequency, bias_field):
+        """
+        Set frequency and bias field (only what changed) and let them settle
+        """
+        previous_frequency, previous_bias_field = self.current_point
+        settling_time = 0
+        probe = None
+
+        if bias_field != previous_bias_field:
+            self.source.set_magnetic_field(bias_field, channel=1)
+            settling_time = self.measurement_parameters["bias_field_settling_time"]
+            probe = lambda: self.read_source(1)[1]
+
+        if frequency != previous_frequency:
+            # Switching the capacitors is slow, so it is only done if the
+            # frequency needs another combination
+            set_capacitance = False
+            if self.measurement_parameters["autoset_capacitance"]:
+                combination = self.combination(frequency)
+                set_capacitance = combination != self.current_combination
+                self.current_combination = combination
+
+            self.arduino.set_frequency(frequency, set_capacitance)
+            settling_time = max(
+                settling_time, self.measurement_parameters["frequency_settling_time"]
+            )
+            probe = lambda: self.oscilloscope.measure_vmax(1, frequency)
+
+        self.current_point = (frequency, bias_field)
+        self.settle(settling_time, probe=probe)
+
+    def process_step(self, i, raw):
+        """
+        Calculate the magnetic field of a step using the pickup coil
+        """
+        frequency, bias_field, me_voltage, pickup_voltage, source_values = raw
+        magnetic_field = (
+            pf.calculate_magnetic_field_from_Vind(
+                self.global_parameters["pickup_coil_windings"],
+                self.global_parameters["pickup_coil_radius"] * 1e-3,
+                pickup_voltage,
+                frequency * 1e3,
+            )
+            * 1e3
+        )
+
+        return frequency, bias_field, me_voltage, magnetic_field, source_values
+
+    def record_step(self, i, values):
+        """
+        Store a step in the dataframe and plot the map
+        """
+        frequency, bias_field, me_voltage, magnetic_field, source_values = values
+        _, current, dc_field = source_values
+
+        self.df_data.loc[i] = [
+            frequency,
+            bias_field,
+            dc_field,
+            current,
+            me_voltage,
+            magnetic_field,
+        ]
+
+        self.observer.update_progress(
+            min(int((i + 1) / self.number_of_steps * 100), 100)
+        )
+
+        grid = self.grid()
+        self.observer.update_plot(
+            grid.columns.to_numpy(), grid.index.to_numpy(), grid.to_numpy()
+        )
+
+    def grid(self):
+        """
+        ME voltage of the measured points with a row per bias field and a column
+        per frequency (points that were not measured are nan)
+        """
+        grid = self.df_data.pivot_table(
+            index="bias_field", columns="frequency", values="me_voltage"
+        )
+        return grid.sort_index(axis=0).sort_index(axis=1)
+
+    def save_data(self):
+        """
+        Save the map as one array of ME voltages
+        """
+        grid = self.grid()
+        maximum = self.df_data.loc[self.df_data["me_voltage"].astype(float).idxmax()]
+
+        # Define Header
+        line01 = (
+            "Maximum ME Voltage:   "
+            + str(maximum["me_voltage"])
+            + " V\t At a Frequency of:   "
+            + str(maximum["frequency"])
+            + " kHz\t And a Bias Field of:   "
+            + str(maximum["bias_field"])
+            + " mT"
+        )
+        line02 = (
+            "Base Capacitance: "
+            + str(self.global_parameters["base_capacitance"])
+            + " pF\t Coil Inductance: "
+            + str(self.global_parameters["coil_inductance"])
+            + " mH\t Device Size: "
+            + str(self.setup_parameters["device_size"])
+            + " mm"
+        )
+        line03 = (
+            "Maximum Voltage:   "
+            + str(self.measurement_parameters["voltage"])
+            + " V   Constant Current:   "
+            + str(self.measurement_parameters["current_compliance"])
+            + " A\t Mean HF Magnetic Field:   "
+            + "{0:.3f}".format(self.df_data["hf_magnetic_field"].astype(float).mean())
+            + " mT"
+        )
+        line04 = (
+            "Frequency Step:   "
+            + str(self.measurement_parameters["frequency_step"])
+            + " kHz \t"
+            + "Bias Field Step:   "
+            + str(self.measurement_parameters["dc_field_step"])
+            + " mT \t"
+            + "Ridge Refinement:   "
+            + str(self.measurement_parameters["refine_ridge"])
+        )
+        line05 = "### Measurement data ###"
+        line06 = "Bias Field\t ME Voltage at the Frequencies (kHz) of the Header"
+        line07 = "mT\t V\n"
+
+        header_lines = [
+            line01,
+            line02,
+            line03,
+            line04,
+            line05,
+            line06,
+            line07,
+        ]
+
+        file_path = (
+            self.setup_parameters["folder_path"]
+            + dt.date.today().strftime("%Y-%m-%d_")
+            + self.setup_parameters["batch_name"]
+            + "_d"
+            + str(self.setup_parameters["device_number"])
+            + "_map"
+            + ".csv"
+        )
+
+        cf.save_file(grid.reset_index(), file_path, header_lines, save_header=True)
@@ -0,0 +1,176 @@
+"""
+Search for the maximum of a measured response (e.g. the ME voltage over the dc
+bias field) with few measurements. A coarse grid brackets the maximum, which
+is then narrowed down by parabolic interpolation through the best three
+points, with golden-section steps whenever the parabola does not shrink the
+bracket fast enough. The search stops once the maximum is known to the
+requested resolution. It does not do the measurements itself:
+
+    search = OptimumSearch(0, 8, resolution=0.1)
+    while not search.finished:
+        bias_field = search.next_point()
+        search.add(bias_field, measure(bias_field))
+    search.optimum
+"""
+
+import numpy as np
+
+# Number of points of the coarse grid
+COARSE_POINTS = 5
+
+# Fraction of the larger interval a golden-section step goes into it
+GOLDEN_SECTION = (3 - np.sqrt(5)) / 2
+
+
+class OptimumSearch:
+    """
+    Bracketing search for the maximum of a response between two limits
+    """
+
+    def __init__(
+        self, lower, upper, resolution, coarse_points=COARSE_POINTS, max_points=30
+    ):
+        self.lower, self.upper = sorted([float(lower), float(upper)])
+        self.resolution = float(resolution)
+        self.max_points = max_points
+
+        self.coarse_grid = list(np.linspace(self.lower, self.upper, coarse_points))
+
+        # Measured points and the bracket (a, b, c) around the best point b
+        self.points = []
+        self.values = []
+        self.bracket = None
+
+        # Width of the bracket after every refinement step (to detect that the
+        # parabolic steps stall)
+        self.widths = []
+
+    def __len__(self):
+        return len(self.points)
+
+    def expected_points(self):
+        """
+        Number of measurements if every refinement step was a golden-section
+        step (used for the progress)
+        """
+        width = 2 * (self.upper - self.lower) / (len(self.coarse_grid) - 1)
+        refinements = np.log(max(width / (2 * self.resolution), 1)) / np.log(
+            1 / (1 - GOLDEN_SECTION)
+        )
+        return min(len(self.coarse_grid) + int(np.ceil(refinements)), self.max_points)
+
+    def value(self, point):
+        return self.values[self.points.index(point)]
+
+    @property
+    def finished(self):
+        if len(self.points) >= self.max_points:
+            return True
+        if self.bracket is None:
+            return False
+
+        a, _, c = self.bracket
+        return (c - a) / 2 <= self.resolution
+
+    @property
+    def best(self):
+        """
+        Measured point with the highest response
+        """
+        return self.points[int(np.argmax(self.values))]
+
+    @property
+    def optimum(self):
+        """
+        Estimate of the position of the maximum (vertex of the parabola through
+        the bracket if it lies inside, otherwise the best point)
+        """
+        if self.bracket is None:
+            return self.best
+
+        vertex = self.parabola_vertex()
+        a, b, c = self.bracket
+        if vertex is None or not a <= vertex <= c:
+            return b
+        return vertex
+
+    def parabola_vertex(self):
+        """
+        Vertex of the parabola through the bracket (None if it is not a maximum)
+        """
+        a, b, c = self.bracket
+        if a == b or b == c:
+            return None
+
+        fa, fb, fc = self.value(a), self.value(b), self.value(c)
+        numerator = (b - a) ** 2 * (fb - fc) - (b - c) ** 2 * (fb - fa)
+        denominator = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+        if denominator <= 0:
+            return None
+        return b - numerator / (2 * denominator)
+
+    def next_point(self):
+        """
+        Point that should be measured next
+        """
+        if len(self.points) < len(self.coarse_grid):
+            return self.coarse_grid[len(self.points)]
+
+        a, b, c = self.bracket
+
+        # Parabolic step if it lies inside the bracket, is not too close to the
+        # points measured already and the bracket shrank well in the last steps
+        vertex = self.parabola_vertex()
+        tolerance = self.resolution / 2
+        stalled = len(self.widths) >= 3 and self.widths[-1] > 0.5 * self.widths[-3]
+        if (
+            vertex is not None
+            and not stalled
+            and a + tolerance < vertex < c - tolerance
+            and abs(vertex - b) >= tolerance
+        ):
+            return float(vertex)
+
+        # Otherwise a golden-section step into the larger interval
+        if b - a > c - b:
+            return b - GOLDEN_SECTION * (b - a)
+        return b + GOLDEN_SECTION * (c - b)
+
+    def add(self, point, value):
+        """
+        Add a measured point and narrow the bracket
+        """
+        self.points.append(float(point))
+        self.values.append(float(value))
+
+        if len(self.points) < len(self.coarse_grid):
+            return
+
+        if self.bracket is None:
+            # Bracket the best point of the coarse grid by its neighbours
+            index = int(np.argmax(self.values))
+            self.bracket = (
+                self.coarse_grid[max(index - 1, 0)],
+                self.coarse_grid[index],
+                self.coarse_grid[min(index + 1, len(self.coarse_grid) - 1)],
+            )
+        else:
+            a, b, c = self.bracket
+            point = float(point)
+            if value > self.value(b):
+                self.bracket = (a, point, b) if point < b else (b, point, c)
+            else:
+                self.bracket = (point, b, c) if point < b else (a, b, point)
+
+        self.widths.append(self.bracket[2] - self.bracket[0])
+
+    def summary(self):
+        return (
+            "Optimum at "
+            + str(round(self.optimum, 3))
+            + " (best measured point "
+            + str(round(self.best, 3))
+            + ") after "
+            + str(len(self.points))
+            + " measurements"
+        )
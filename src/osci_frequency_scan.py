@@ -58,9 +58,7 @@ class HFScan(QtCore.QThread):
 
         self.source.set_current(2, channel=2)
         if measurement_parameters["constant_magnetic_field_mode"]:
-            pid_parameters = np.array(
-                self.global_parameters["pid_parameters"].split(","), dtype=float
-            )
+            pid_parameters = np.array(self.global_parameters.pid_parameters)
             self.source.start_constant_magnetic_field_mode(
                 pid_parameters,
                 self.measurement_parameters["current_compliance"],
@@ -56,9 +56,7 @@ class PIDScan(QtCore.QThread):
         self.is_killed = False
 
         # If
-        pid_parameters = np.array(
-            self.global_parameters["pid_parameters"].split(","), dtype=float
-        )
+        pid_parameters = np.array(self.global_parameters.pid_parameters)
 
         self.pid = PID(
             pid_parameters[0],
@@ -155,7 +153,11 @@ class PIDScan(QtCore.QThread):
                 pf.calculate_magnetic_field_from_Vind(
                     self.global_parameters["pickup_coil_windings"],
                     self.global_parameters["pickup_coil_radius"] * 1e-3,
-                    float(self.oscilloscope.measure_vmax(1)),
+                    float(
+                        self.oscilloscope.measure_vmax(
+                            1, self.measurement_parameters["frequency"]
+                        )
+                    ),
                     self.measurement_parameters["frequency"] * 1e3,
                 )
                 * 1e3
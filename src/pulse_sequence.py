@@ -0,0 +1,276 @@
+"""
+Compilation of a pulse table (see read_pulsing_file) into the binary schedule
+that the arduino sketch executes on its own. The sketch times the segments
+with micros() instead of the host toggling the frequency generation over the
+serial port, which removes the jitter of the host and the drift of long
+sequences. Every segment is one record of
+
+    flags (uint8)       bit 0: frequency generation on
+    duration (uint32)   in us
+    frequency (uint32)  in Hz, 0 to keep the current frequency
+    relays (uint16)     capacitor states (bit n-1 for cap n), 0xFFFF to keep
+
+in little endian byte order, followed by the 16 bit sum of all bytes as
+checksum. While running, the sketch reports the actual time of every edge.
+The dc and hf field are set on the source and therefore stay with the host.
+
+For the settings done by the host, the pulse table is compiled into a
+PulsePlan that contains the changes of every transition as plain arrays. The
+changes for an ON segment are started in the preceding OFF segment as late as
+possible but early enough to be finished at its edge, based on the latencies
+of the commands measured so far. Transitions that were not ready in time are
+collected and reported in a summary at the end.
+"""
+
+import collections
+import struct
+import time
+
+import numpy as np
+
+import core_functions as cf
+
+RECORD_FORMAT = "<BIIH"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+CHECKSUM_FORMAT = "<H"
+
+# Must match the arduino sketch (memory of the arduino)
+MAX_SEGMENTS = 48
+
+KEEP_FREQUENCY = 0
+KEEP_RELAYS = 0xFFFF
+
+PulseSegment = collections.namedtuple(
+    "PulseSegment", ["on", "duration", "frequency", "relays"]
+)
+
+
+def relay_mask(arduino, frequency):
+    """
+    Capacitor states the arduino would set for a frequency (in kHz)
+    """
+    _, idx = cf.find_nearest(
+        arduino.combinations_df["resonance_frequency"].to_numpy(), frequency
+    )
+    mask = 0
+    for cap_no in arduino.combinations_df["arduino_pins"].iloc[idx]:
+        mask |= 1 << (int(cap_no) - 1)
+    return mask
+
+
+def compile_pulse_schedule(pulsing_data, arduino=None):
+    """
+    Translate the pulse table into segments. The frequency (and the
+    capacitors if the arduino is given) of an ON segment is already set at the
+    start of the preceding OFF segment, so that it is settled at the edge.
+    """
+    signals = pulsing_data["signal"].to_numpy()
+    end_times = pulsing_data["time"].to_numpy(dtype=float)
+    frequencies = pulsing_data["frequency"].to_numpy(dtype=float)
+
+    # Durations in us (the table contains the cumulative end times in s)
+    durations = np.round(np.diff(end_times, prepend=0) * 1e6).astype(np.int64)
+    if np.any(durations < 0) or np.any(durations >= 2**32):
+        raise ValueError("Pulse durations must be between 0 and 71 min")
+
+    segments = []
+    current_frequency = None
+    for index, signal in enumerate(signals):
+        if signal not in ["ON", "OFF"]:
+            raise ValueError(
+                "The signal command in row " + str(index) + " is not a valid command!"
+            )
+
+        # Frequency of the next ON segment
+        upcoming = np.flatnonzero(signals[index:] == "ON")
+        frequency = (
+            frequencies[index + upcoming[0]] if len(upcoming) > 0 else current_frequency
+        )
+
+        if frequency is None or frequency == current_frequency:
+            segment_frequency, relays = KEEP_FREQUENCY, KEEP_RELAYS
+        else:
+            segment_frequency = int(round(frequency * 1e3))
+            relays = KEEP_RELAYS if arduino is None else relay_mask(arduino, frequency)
+            current_frequency = frequency
+
+        segments.append(
+            PulseSegment(
+                signal == "ON", int(durations[index]), segment_frequency, relays
+            )
+        )
+
+    return segments
+
+
+def encode_pulse_schedule(segments):
+    """
+    Binary representation of the segments including the checksum
+    """
+    if len(segments) > MAX_SEGMENTS:
+        raise ValueError(
+            "The arduino can only store " + str(MAX_SEGMENTS) + " pulse segments"
+        )
+
+    payload = b"".join(
+        struct.pack(
+            RECORD_FORMAT,
+            int(segment.on),
+            segment.duration,
+            segment.frequency,
+            segment.relays,
+        )
+        for segment in segments
+    )
+    return payload + struct.pack(CHECKSUM_FORMAT, sum(payload) & 0xFFFF)
+
+
+def decode_pulse_schedule(data):
+    """
+    Segments of a binary schedule (raises a ValueError if it is corrupted)
+    """
+    payload, checksum = data[:-2], struct.unpack(CHECKSUM_FORMAT, data[-2:])[0]
+    if len(payload) % RECORD_SIZE != 0 or sum(payload) & 0xFFFF != checksum:
+        raise ValueError("Corrupted pulse schedule")
+
+    return [
+        PulseSegment(bool(flags & 1), duration, frequency, relays)
+        for flags, duration, frequency, relays in struct.iter_unpack(
+            RECORD_FORMAT, payload
+        )
+    ]
+
+
+def edge_times(segments):
+    """
+    Planned time (s) of the start of every segment
+    """
+    return np.cumsum([0] + [segment.duration for segment in segments[:-1]]) / 1e6
+
+
+# Commands that prepare an ON segment and their assumed latency (s) until
+# they were measured
+PREPARATION_COMMANDS = ["dc_field", "hf_field", "frequency"]
+DEFAULT_LATENCIES = {"dc_field": 0.2, "hf_field": 0.02, "frequency": 0.5}
+
+
+class PulsePlan:
+    """
+    Precomputed transitions of a pulse table. The commands that are done by
+    the host can be restricted (e.g. if the arduino sets the frequency).
+    """
+
+    def __init__(
+        self, pulsing_data, commands=PREPARATION_COMMANDS, margin=0.05, history=10
+    ):
+        self.preparation_commands = list(commands)
+        self.on = pulsing_data["signal"].to_numpy() == "ON"
+        self.end_times = pulsing_data["time"].to_numpy(dtype=float)
+        self.start_times = np.concatenate(([0], self.end_times[:-1]))
+        self.values = {
+            command: pulsing_data[command].to_numpy(dtype=float)
+            for command in self.preparation_commands
+        }
+
+        # Safety margin (s) that a preparation should be finished before the
+        # edge and number of measurements the latency estimate is based on
+        self.margin = margin
+        self.latencies = {
+            command: collections.deque(maxlen=history)
+            for command in self.preparation_commands
+        }
+
+        # Every OFF segment that is followed by an ON segment prepares the
+        # values of that segment. They only have to be set if they differ
+        # from the previous ON segment (the first one is always set).
+        self.prepares = np.zeros(len(self.on), dtype=bool)
+        self.prepares[:-1] = ~self.on[:-1] & self.on[1:]
+        self.changes = {}
+        for command, values in self.values.items():
+            previous = np.full(len(values), np.nan)
+            on_indices = np.flatnonzero(self.on)
+            previous[on_indices[1:]] = values[on_indices[:-1]]
+            changed = np.zeros(len(values), dtype=bool)
+            changed[:-1] = self.prepares[:-1] & (values[1:] != previous[1:])
+            self.changes[command] = changed
+
+        # (segment index, overrun in s) of the preparations that were not
+        # finished at the edge of the following ON segment
+        self.violations = []
+        self.number_of_preparations = 0
+
+    def __len__(self):
+        return len(self.on)
+
+    def commands(self, index):
+        """
+        Commands (and their values) needed at the end of segment index
+        """
+        return [
+            (command, self.values[command][index + 1])
+            for command in self.preparation_commands
+            if self.changes[command][index]
+        ]
+
+    def latency(self, command):
+        """
+        Conservative estimate of the latency of a command (the maximum of
+        the recent measurements)
+        """
+        if len(self.latencies[command]) == 0:
+            return DEFAULT_LATENCIES[command]
+        return max(self.latencies[command])
+
+    def preparation_time(self, index):
+        """
+        Time at which the preparation in segment index has to start (inf if
+        nothing is to be prepared). It is never earlier than the start of the
+        OFF segment.
+        """
+        commands = self.commands(index)
+        if len(commands) == 0:
+            return np.inf
+
+        duration = sum(self.latency(command) for command, _ in commands)
+        return max(
+            self.end_times[index] - duration - self.margin, self.start_times[index]
+        )
+
+    def prepare(self, index, execute, elapsed_time):
+        """
+        Execute the commands of segment index with execute(command, value),
+        measure their latencies and check that they are finished before the
+        edge. elapsed_time() returns the time since the start of the plan.
+        """
+        self.number_of_preparations += 1
+        for command, value in self.commands(index):
+            start_time = time.time()
+            execute(command, value)
+            self.latencies[command].append(time.time() - start_time)
+
+        overrun = elapsed_time() - self.end_times[index]
+        if overrun > 0:
+            self.violations.append((index, overrun))
+
+    def summary(self):
+        """
+        Summary of the timing violations
+        """
+        if len(self.violations) == 0:
+            return (
+                "All "
+                + str(self.number_of_preparations)
+                + " pulse transitions were prepared in time"
+            )
+
+        worst_index, worst_overrun = max(self.violations, key=lambda v: v[1])
+        return (
+            str(len(self.violations))
+            + " of "
+            + str(self.number_of_preparations)
+            + " pulse transitions were not prepared in time (worst: "
+            + str(round(worst_overrun * 1e3, 1))
+            + " ms late in segment "
+            + str(worst_index)
+            + ")"
+        )
@@ -2,10 +2,28 @@ from PySide6 import QtCore
 
 import time
 
+import numpy as np
+import pandas as pd
+
 import core_functions as cf
+import pulse_sequence
+from scan_engine import ScanEngine, ScanObserver
 
 
-class PulsingSweep(QtCore.QThread):
+def read_pulsing_file(file_path):
+    """
+    Function that translates the pulse code to time vs magnetic field data
+    """
+    pulsing_data = pd.read_csv(file_path, delimiter="\t", skiprows=1)
+
+    # Set the fields to zero in case of off state
+    pulsing_data.loc[pulsing_data["signal"] == "OFF", "hf_field"] = 0
+    pulsing_data.loc[pulsing_data["signal"] == "OFF", "dc_field"] = 0
+    pulsing_data["time"] = np.cumsum(pulsing_data["time"].to_numpy())
+    return pulsing_data
+
+
+class PulsingSweep(QtCore.QThread, ScanObserver):
     """
     Class thread that handles the spectrum measurement
     """
@@ -26,27 +44,86 @@ class PulsingSweep(QtCore.QThread):
         parent=None,
     ):
         super(PulsingSweep, self).__init__()
-        # Variable to kill thread
-
-        # Assign hardware and reset
-        self.arduino = arduino
-        self.arduino.init_serial_connection()
-        self.source = source
-        self.oscilloscope = oscilloscope
         self.parent = parent
 
-        self.pulsing_data = pulsing_data
-        # make sure indexes pair with number of rows
-        self.pulsing_data = self.pulsing_data.reset_index()
-        self.pulsing_sweep_parameters = pulsing_sweep_parameters
-
-        self.global_parameters = cf.read_global_settings()
-
         # Connect signal to the updater from the parent class
         self.update_time_position_signal.connect(parent.update_time_position)
         self.update_progress_bar.connect(parent.progressBar.setProperty)
 
-        self.is_killed = False
+        # The sweep itself is done by the engine, this thread only forwards
+        # its progress to the main window
+        self.engine = PulsingSweepEngine(
+            arduino,
+            source,
+            oscilloscope,
+            pulsing_data,
+            pulsing_sweep_parameters,
+            observer=self,
+        )
+
+    def run(self):
+        """
+        Run the pulsing engine in this thread
+        """
+        import pydevd
+
+        pydevd.settrace(suspend=False)
+
+        self.engine.run()
+
+    def kill(self):
+        """
+        Kill thread while running
+        """
+        self.engine.kill()
+
+    def update_plot(self, current_time):
+        """
+        Forward the current position in time to the main window
+        """
+        self.update_time_position_signal.emit(current_time)
+
+    def update_progress(self, progress):
+        """
+        Forward the progress to the progress bar
+        """
+        self.update_progress_bar.emit("value", progress)
+
+    def scan_finished(self):
+        """
+        Release the start button once the sweep is done
+        """
+        self.parent.pulsew_start_measurement_pushButton.setChecked(False)
+
+
+class PulsingSweepEngine(ScanEngine):
+    """
+    Engine that plays back a pulse sequence independent of any GUI
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        pulsing_data,
+        pulsing_sweep_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        super(PulsingSweepEngine, self).__init__(
+            arduino,
+            source,
+            oscilloscope,
+            pulsing_sweep_parameters,
+            {},
+            observer,
+            reuse_hardware,
+        )
+
+        # make sure indexes pair with number of rows
+        self.pulsing_data = pulsing_data.reset_index()
+        self.pulsing_sweep_parameters = pulsing_sweep_parameters
 
     def run(self):
         """
@@ -61,10 +138,6 @@ class PulsingSweep(QtCore.QThread):
         # self.measurement_parameters["maximum_frequency"],
         # self.measurement_parameters["frequency_step"],
         # )
-        import pydevd
-
-        pydevd.settrace(suspend=False)
-
         # Measure time elapsed
         if not self.pulsing_sweep_parameters["constant_mode"]:
             self.source.set_current(2, channel=2)
@@ -93,132 +166,142 @@ class PulsingSweep(QtCore.QThread):
         #         True,
         #     )
 
+        # Let the arduino time the segments (if its sketch supports it)
+        if self.pulsing_sweep_parameters.get("hardware_timing", False):
+            if self.run_hardware_timed():
+                return
+            cf.log_message(
+                "Pulse schedule could not be uploaded, the pulses are timed by "
+                "the computer instead"
+            )
+
+        # The changes for the next ON segment are started at the latest
+        # possible moment of the OFF segment before it
+        plan = pulse_sequence.PulsePlan(self.pulsing_data)
+
         start_time = time.time()
+        elapsed_time = lambda: time.time() - start_time
         time_step = 0.01
-        for index, row in self.pulsing_data.iterrows():
-            if row["signal"] == "ON":
-                # Takes about 5ms
-                self.arduino.trigger_frequency_generation(1)
-                i = 0
-
-                while (time.time() - start_time) < float(row["time"]):
-                    if self.is_killed:
-                        # Close the connection to the spectrometer
-                        self.source.output(False, channel=2)
-                        self.source.output(False, channel=2)
-                        # self.arduino.set_frequency(1000, True)
-                        # self.parent.oscilloscope_thread.pause = False
-                        self.quit()
-                        return
-
-                    time.sleep(time_step)
-
-                    # Update graph with current position in time
-                    if i % 5 == 0:
-                        self.update_time_position_signal.emit(time.time() - start_time)
-                    # print(str(time.time() - start_time) + " ON")
-                    i += 1
-
-            elif row["signal"] == "OFF":
-                self.arduino.trigger_frequency_generation(0)
-                set_bool = True
-
-                i = 0
-                while (time.time() - start_time) < float(row["time"]):
-                    # Make sure the adjustment of the sources is preparing
-                    # already the next on cycle
-                    ref = time.time()
-                    if not self.pulsing_sweep_parameters["constant_mode"]:
-                        if (time.time() - start_time) > (
-                            float(row["time"]) - 1
-                        ) and set_bool:
-                            try:
-                                # Takes about 0.2 s
-                                if (
-                                    self.pulsing_data.iloc[index - 1]["dc_field"]
-                                    != self.pulsing_data.iloc[index + 1]["dc_field"]
-                                ):
-                                    self.source.set_magnetic_field(
-                                        float(
-                                            self.pulsing_data.iloc[index + 1][
-                                                "dc_field"
-                                            ]
-                                        ),
-                                        channel=2,
-                                    )
-
-                                # Takes about 20 ms
-                                if (
-                                    self.pulsing_data.iloc[index - 1]["hf_field"]
-                                    != self.pulsing_data.iloc[index + 1]["hf_field"]
-                                ):
-                                    self.source.set_voltage(
-                                        float(
-                                            self.pulsing_data.iloc[index + 1][
-                                                "hf_field"
-                                            ]
-                                        ),
-                                        channel=2,
-                                    )
-
-                                # Takes about 0.5s
-                                if (
-                                    self.pulsing_data.iloc[index - 1]["frequency"]
-                                    != self.pulsing_data.iloc[index + 1]["frequency"]
-                                ):
-                                    self.arduino.set_frequency(
-                                        float(
-                                            self.pulsing_data.iloc[index + 1][
-                                                "frequency"
-                                            ]
-                                        ),
-                                        True,
-                                    )
-
-                                set_bool = False
-                            except:
-                                cf.log_message("Last off cycle reached")
-
-                            set_bool = False
-                            cf.log_message(
-                                "Setting dc and hf field source and frequency took "
-                                + str(time.time() - ref)
-                                + " s"
-                            )
-
-                    if self.is_killed:
-                        # Close the connection to the spectrometer
-                        self.source.output(False, channel=2)
-                        self.source.output(False, channel=1)
-                        # self.arduino.set_frequency(1000, True)
-                        # self.parent.oscilloscope_thread.pause = False
-                        self.quit()
-                        return
-
-                    time.sleep(time_step)
-
-                    if i % 5 == 0:
-                        self.update_time_position_signal.emit(time.time() - start_time)
-                    # print(str(time.time() - start_time) + " ON")
-                    i += 1
-            else:
-                cf.log_message(
-                    "The signal command in row "
-                    + str(index)
-                    + " is not a valid command!"
-                )
-            print(time.time() - start_time)
+        for index in range(len(plan)):
+            # Takes about 5ms
+            self.arduino.trigger_frequency_generation(int(plan.on[index]))
+            prepared = self.pulsing_sweep_parameters["constant_mode"]
+
+            i = 0
+            while elapsed_time() < plan.end_times[index]:
+                if self.is_killed:
+                    # Close the connection to the spectrometer
+                    self.source.output(False, channel=2)
+                    self.source.output(False, channel=1)
+                    # self.arduino.set_frequency(1000, True)
+                    # self.parent.oscilloscope_thread.pause = False
+                    return
+
+                if not prepared and elapsed_time() >= plan.preparation_time(index):
+                    plan.prepare(index, self.set_segment_value, elapsed_time)
+                    prepared = True
+
+                time.sleep(time_step)
+
+                # Update graph with current position in time
+                if i % 5 == 0:
+                    self.observer.update_plot(elapsed_time())
+                i += 1
+
+            # If the segment was already over (e.g. the previous preparation
+            # was late), the next ON segment is prepared anyway
+            if not prepared and np.isfinite(plan.preparation_time(index)):
+                plan.prepare(index, self.set_segment_value, elapsed_time)
+
+        cf.log_message(plan.summary())
 
         self.source.output(False, channel=2)
         self.source.output(False, channel=1)
         # self.arduino.set_frequency(1000, True)
 
-        self.parent.pulsew_start_measurement_pushButton.setChecked(False)
-
         # self.parent.oscilloscope_thread.pause = False
 
-    def kill(self):
+        self.observer.scan_finished()
+
+    def set_segment_value(self, command, value):
         """
-        Kill thread while running
+        Set a value of the next ON segment (see pulse_sequence.PulsePlan)
+        """
+        if command == "dc_field":
+            # Takes about 0.2 s
+            self.source.set_magnetic_field(float(value), channel=2)
+        elif command == "hf_field":
+            # Takes about 20 ms
+            self.source.set_voltage(float(value), channel=2)
+        elif command == "frequency":
+            # Takes about 0.5s
+            self.arduino.set_frequency(float(value), True)
+
+    def run_hardware_timed(self):
+        """
+        Upload the pulse table as schedule to the arduino which times the
+        segments and switches frequency and capacitors itself. The computer
+        only sets the source during the OFF segments, following the edges the
+        arduino reports. Returns False if the schedule could not be uploaded.
         """
-        self.is_killed = True
+        try:
+            segments = pulse_sequence.compile_pulse_schedule(
+                self.pulsing_data, self.arduino
+            )
+            schedule = pulse_sequence.encode_pulse_schedule(segments)
+        except ValueError as e:
+            cf.log_message(e)
+            return False
+
+        if not self.arduino.upload_pulse_schedule(schedule):
+            return False
+
+        # The frequency is switched by the arduino itself
+        plan = pulse_sequence.PulsePlan(
+            self.pulsing_data, commands=["dc_field", "hf_field"]
+        )
+
+        # Actual time of the edges as reported by the arduino
+        self.edge_times = np.full(len(segments), np.nan)
+
+        self.arduino.start_pulse_schedule()
+        start_time = time.time()
+        elapsed_time = lambda: time.time() - start_time
+        finished = False
+        i = 0
+        while not finished:
+            if self.is_killed:
+                self.arduino.stop_pulse_schedule()
+                self.source.output(False, channel=2)
+                self.source.output(False, channel=1)
+                return True
+
+            edges, finished = self.arduino.read_pulse_edges()
+            for index, edge_time in edges:
+                self.edge_times[index] = edge_time
+
+                # The source is changed as soon as the frequency generation
+                # is off
+                if (
+                    not self.pulsing_sweep_parameters["constant_mode"]
+                    and plan.prepares[index]
+                ):
+                    plan.prepare(index, self.set_segment_value, elapsed_time)
+
+            # Update graph with current position in time
+            if i % 5 == 0:
+                self.observer.update_plot(elapsed_time())
+            i += 1
+
+        deviation = self.edge_times - pulse_sequence.edge_times(segments)
+        cf.log_message(
+            "Pulse schedule finished, maximum edge deviation "
+            + str(round(np.nanmax(np.abs(deviation)) * 1e3, 3))
+            + " ms"
+        )
+        cf.log_message(plan.summary())
+
+        self.source.output(False, channel=2)
+        self.source.output(False, channel=1)
+        self.observer.scan_finished()
+        return True
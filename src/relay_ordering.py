@@ -0,0 +1,120 @@
+"""
+Order in which capacitor combinations are set to switch as few relays as
+possible. The arduino only switches the relays that differ from their current
+state, so the number of switching commands (and the wear of the relays)
+between two combinations is the Hamming distance of their relay masks (bit
+n-1 for the capacitor on pin n). Finding the shortest order is a travelling
+salesman problem over the masks. A complete table of combinations (every
+subset of the relays that are used) is set in the order of the reflected
+Gray code, which switches a single relay per step. Other tables are ordered
+approximately by a nearest neighbour walk starting from the current relay
+states that is improved by 2-opt moves.
+"""
+
+import numpy as np
+
+
+def pin_mask(arduino_pins):
+    """
+    Relay mask of the pins of a capacitor combination
+    """
+    mask = 0
+    for pin in np.atleast_1d(arduino_pins):
+        mask |= 1 << (int(pin) - 1)
+    return mask
+
+
+def state_mask(arduino_pins, cap_states):
+    """
+    Relay mask of the current capacitor states (as read by the arduino)
+    """
+    return pin_mask(np.asarray(arduino_pins)[np.asarray(cap_states, dtype=bool)])
+
+
+def hamming_distance(mask_a, mask_b):
+    return bin(mask_a ^ mask_b).count("1")
+
+
+def switching_count(masks, order, start=0):
+    """
+    Number of relays switched if the masks are set in the given order
+    """
+    count = 0
+    previous = start
+    for index in order:
+        count += hamming_distance(previous, masks[index])
+        previous = masks[index]
+    return count
+
+
+def gray_code_order(masks, start=0):
+    """
+    Order of a complete table of masks (all subsets of the used relays) that
+    switches a single relay per step, starting with the state start. Returns
+    None if the table is not complete.
+    """
+    used = 0
+    for mask in masks:
+        used |= mask
+    bits = [bit for bit in range(used.bit_length()) if used >> bit & 1]
+    if len(set(masks)) != len(masks) or len(masks) != 2 ** len(bits):
+        return None
+
+    # Reflected Gray code over the used relays, shifted by the start state so
+    # that the first combination needs no switch of a used relay
+    indices = {mask: index for index, mask in enumerate(masks)}
+    order = []
+    for i in range(len(masks)):
+        code = i ^ (i >> 1)
+        mask = start & used
+        for position, bit in enumerate(bits):
+            if code >> position & 1:
+                mask ^= 1 << bit
+        order.append(indices[mask])
+    return order
+
+
+def order_combinations(masks, start=0):
+    """
+    Order of the masks (indices) that switches as few relays as possible when
+    starting from the relay state start
+    """
+    masks = [int(mask) for mask in masks]
+    if len(masks) <= 1:
+        return list(range(len(masks)))
+
+    order = gray_code_order(masks, start)
+    if order is not None:
+        return order
+
+    # Pairwise distances, the start is the last row
+    points = np.array(masks + [start], dtype=np.int64)
+    distances = np.vectorize(hamming_distance)(points[:, None], points[None, :])
+
+    # Nearest neighbour walk
+    order = []
+    remaining = set(range(len(masks)))
+    previous = len(masks)
+    while remaining:
+        previous = min(remaining, key=lambda index: (distances[previous, index], index))
+        order.append(previous)
+        remaining.remove(previous)
+
+    # 2-opt: reverse segments of the walk as long as that shortens it (the
+    # walk is open at its end)
+    path = [len(masks)] + order
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                after = distances[path[i - 1], path[j]]
+                before = distances[path[i - 1], path[i]]
+                if j + 1 < len(path):
+                    after += distances[path[i], path[j + 1]]
+                    before += distances[path[j], path[j + 1]]
+                if after < before:
+                    path[i : j + 1] = path[i : j + 1][::-1]
+                    improved = True
+
+    return path[1:]
@@ -0,0 +1,271 @@
+import time
+
+import numpy as np
+
+import core_functions as cf
+import demodulation
+import settling
+import step_executor
+import telemetry
+
+
+class ScanObserver:
+    """
+    Interface through which the scan engines report their progress. The
+    engines never talk to the GUI directly but only to an observer so that
+    they can be run from the Qt main window (where the scan threads act as
+    observers and turn the calls into signals) as well as headless from the
+    command line. All methods do nothing by default.
+    """
+
+    def update_plot(self, *data):
+        """
+        Called after every measurement step with the data measured so far
+        """
+
+    def update_progress(self, progress):
+        """
+        Called with the progress of the scan in percent
+        """
+
+    def pause_measurement(self, status):
+        """
+        Called when the scan has to wait for the user (e.g. to insert the
+        OLED). Return "break" to continue, "return" to abort or None if the
+        decision is made asynchronously by setting the pause attribute of the
+        engine.
+        """
+        return "break"
+
+    def scan_finished(self):
+        """
+        Called when the scan ended regularly (not when it was killed)
+        """
+
+
+class ScanEngine:
+    """
+    Base class of all scan engines that contains the logic shared between
+    them. The engines are plain python objects that do the actual
+    measurement in their run function (blocking) and are completely
+    independent of Qt.
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        measurement_parameters,
+        setup_parameters,
+        observer=None,
+        reuse_hardware=False,
+    ):
+        # If the hardware is reused from a previous scan (e.g. by the
+        # scheduler) it is neither re-initialised nor reset at the end
+        self.reuse_hardware = reuse_hardware
+
+        # Assign hardware and reset
+        self.arduino = arduino
+        if not (reuse_hardware and getattr(arduino, "serial_connection_open", False)):
+            self.arduino.init_serial_connection()
+        self.source = source
+        self.oscilloscope = oscilloscope
+
+        # Readings of the source go through its telemetry broker so that the
+        # display is served from the values measured by the scan
+        self.telemetry = telemetry.broker(source)
+
+        self.measurement_parameters = measurement_parameters
+        self.setup_parameters = setup_parameters
+
+        self.global_parameters = cf.read_global_settings()
+
+        # Demodulate the oscilloscope traces at the drive frequency (software
+        # lock-in) instead of taking their maximum
+        self.lock_in_mode = bool(self.global_parameters.get("lock_in_mode", False))
+
+        # Wait until the response of the setup is stable instead of the full
+        # settling time (see settling) and the resulting settling times
+        self.adaptive_settling = bool(
+            self.global_parameters.get("adaptive_settling", False)
+        )
+        self.settling_times = []
+
+        if observer is None:
+            observer = ScanObserver()
+        self.observer = observer
+
+        # Variables to kill and pause the scan
+        self.is_killed = False
+        self.pause = False
+
+        # Start and end time of the reads of the last step
+        self.readout_timestamps = {}
+
+    def run(self):
+        """
+        Does the actual measurement (has to be implemented by the engines)
+        """
+        raise NotImplementedError
+
+    def kill(self):
+        """
+        Kill scan while running
+        """
+        self.is_killed = True
+
+    def settle(self, settling_time, probe=None):
+        """
+        Wait for the setup to settle after a change. In the adaptive settling
+        mode, the wait ends as soon as the response measured by probe() is
+        stable (the settling time is the upper bound).
+        """
+        if not (self.adaptive_settling and probe is not None):
+            time.sleep(settling_time)
+            return
+
+        settled, elapsed_time = settling.wait_until_settled(
+            probe, settling_time, should_stop=lambda: self.is_killed
+        )
+        self.settling_times.append(elapsed_time)
+        if not settled and not self.is_killed:
+            cf.log_message(
+                "Setup did not settle within "
+                + str(settling_time)
+                + " s, consider a longer settling time"
+            )
+
+    def log_settling(self):
+        """
+        Log how long the setup took to settle in the adaptive settling mode
+        """
+        if len(self.settling_times) == 0:
+            return
+
+        cf.log_message(
+            "Settling took "
+            + str(round(float(np.mean(self.settling_times)), 2))
+            + " s on average (maximum "
+            + str(round(float(np.max(self.settling_times)), 2))
+            + " s) in "
+            + str(len(self.settling_times))
+            + " steps"
+        )
+
+    def read_source(self, channel):
+        """
+        Fresh reading of a channel of the source (see read_values)
+        """
+        return self.telemetry.read(channel)
+
+    def read_step(self, **tasks):
+        """
+        Read from independent instruments concurrently (one task per
+        instrument) and return the results in the order of the tasks
+        """
+        results, self.readout_timestamps = step_executor.read_concurrently(tasks)
+        return [results[name] for name in tasks]
+
+    def demodulate(self, time_data, me_trace, pickup_trace, frequency=None):
+        """
+        Lock-in amplitude, phase and noise of the ME trace at the drive
+        frequency (in kHz, by default the one set on the arduino). The phase
+        is relative to the pickup coil trace.
+        """
+        if frequency is None:
+            frequency = self.arduino.frequency
+
+        return demodulation.demodulate(
+            time_data, me_trace, float(frequency) * 1e3, reference=pickup_trace
+        )
+
+    def read_lock_in(self, frequency=None):
+        """
+        Fetch the traces of the ME voltage (channel 2) and the pickup coil
+        (channel 1) and demodulate them. Returns the lock-in results of both.
+        """
+        if frequency is None:
+            frequency = self.arduino.frequency
+
+        # The cached scales keep the traces on screen without clipping
+        self.oscilloscope.auto_scale(2, frequency)
+        self.oscilloscope.auto_scale(1, frequency)
+        time_data, me_trace = self.oscilloscope.get_data("CHAN2")
+        _, pickup_trace = self.oscilloscope.get_data("CHAN1")
+
+        return (
+            self.demodulate(time_data, me_trace, pickup_trace, frequency),
+            demodulation.demodulate(time_data, pickup_trace, float(frequency) * 1e3),
+        )
+
+    def read_oscilloscope(self, frequency):
+        """
+        ME voltage (channel 2) and pickup coil voltage (channel 1), either
+        demodulated (lock-in mode) or as maxima measured by the oscilloscope
+        """
+        if self.lock_in_mode:
+            me_result, pickup_result = self.read_lock_in(frequency)
+            return me_result.amplitude, pickup_result.amplitude
+
+        return (
+            float(self.oscilloscope.measure_vmax(2, frequency)),
+            float(self.oscilloscope.measure_vmax(1, frequency)),
+        )
+
+    def set_frequency(self, frequency, set_capacitance):
+        """
+        Set the frequency on the arduino. This is skipped if the hardware is
+        reused and the previous scan left the frequency generation on at the
+        same frequency (and capacitor combination if it is set as well).
+        """
+        if (
+            self.reuse_hardware
+            and self.arduino.frequency == frequency
+            and getattr(self.arduino, "frequency_on", False)
+            and (not set_capacitance or self.capacitance_set(frequency))
+        ):
+            cf.log_message(
+                "Frequency of " + str(frequency) + " kHz already set, skipped"
+            )
+            return
+
+        self.arduino.set_frequency(frequency, set_capacitance)
+
+    def capacitance_set(self, frequency):
+        """
+        Check if the capacitor combination that the arduino selects for a
+        frequency is already set
+        """
+        combinations = self.arduino.combinations_df
+        _, idx = cf.find_nearest(
+            combinations["resonance_frequency"].to_numpy(), frequency
+        )
+        return getattr(self.arduino, "real_capacitance", None) == combinations.at[
+            idx, "sum"
+        ]
+
+    def reset_frequency(self):
+        """
+        Set the arduino back to its default frequency after the scan (unless
+        the hardware is reused by the next scan)
+        """
+        if not self.reuse_hardware:
+            self.arduino.set_frequency(1000, True)
+
+    def wait_for_user(self, status):
+        """
+        Pause the scan until the observer decides to continue. Returns False
+        if the user aborted the scan.
+        """
+        self.pause = "True"
+        answer = self.observer.pause_measurement(status)
+        if answer is not None:
+            self.pause = answer
+
+        while self.pause == "True":
+            time.sleep(0.1)
+            if self.is_killed:
+                return False
+
+        return self.pause == "break"
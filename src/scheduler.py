@@ -0,0 +1,250 @@
+import itertools
+import time
+
+import core_functions as cf
+
+
+class MeasurementJob:
+    """
+    A single scan of a device that is queued in the scheduler
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        scan_type,
+        measurement_parameters,
+        setup_parameters,
+        priority=0,
+        depends_on=None,
+        name=None,
+    ):
+        self.job_id = next(self._ids)
+        self.name = name if name is not None else scan_type + "_" + str(self.job_id)
+        self.scan_type = scan_type
+        self.measurement_parameters = measurement_parameters
+        self.setup_parameters = setup_parameters
+        self.priority = priority
+        self.depends_on = list(depends_on) if depends_on is not None else []
+
+        # Possible states are queued, running, done, failed, killed and skipped
+        self.state = "queued"
+        self.start_time = None
+        self.end_time = None
+        self.engine = None
+
+    @property
+    def device(self):
+        """
+        Identifier of the device (batch and device number)
+        """
+        return (
+            self.setup_parameters["batch_name"],
+            self.setup_parameters["device_number"],
+        )
+
+    @property
+    def operating_point(self):
+        """
+        Frequency and bias field the hardware is set to during the scan (None
+        if the scan sweeps over it)
+        """
+        return (
+            self.measurement_parameters.get("frequency"),
+            self.measurement_parameters.get("dc_magnetic_field"),
+        )
+
+
+class JobScheduler:
+    """
+    Queue of measurement jobs that runs them one after another on the same
+    hardware. The next job is chosen among all jobs whose dependencies are
+    done by (in this order) its priority, whether it is on the device that is
+    currently connected and whether it shares the frequency or bias field of
+    the last job, so that device changes and instrument reconfigurations are
+    minimised. Between jobs the hardware is not re-initialised and not reset.
+    """
+
+    def __init__(
+        self,
+        arduino,
+        source,
+        oscilloscope,
+        engine_factory,
+        observer_factory=None,
+        change_device=None,
+    ):
+        self.arduino = arduino
+        self.source = source
+        self.oscilloscope = oscilloscope
+
+        # Function that returns the engine for a job (engine_factory(job,
+        # arduino, source, oscilloscope, observer, reuse_hardware)), a
+        # function that returns the observer for a job and a function that
+        # is called whenever another device has to be connected
+        self.engine_factory = engine_factory
+        self.observer_factory = observer_factory
+        self.change_device = change_device
+
+        self.jobs = []
+        self.current_job = None
+        self.current_device = None
+        self.is_killed = False
+
+    def add_job(self, job):
+        """
+        Add a job to the queue and return it
+        """
+        job_names = [queued_job.name for queued_job in self.jobs]
+        for dependency in job.depends_on:
+            if dependency not in job_names:
+                raise ValueError(
+                    "Job " + job.name + " depends on unknown job " + str(dependency)
+                )
+        self.jobs.append(job)
+
+        return job
+
+    def get_job(self, name):
+        """
+        Return the job with the given name
+        """
+        return next(job for job in self.jobs if job.name == name)
+
+    def next_job(self, last_job=None):
+        """
+        Select the next job that can run. Jobs whose dependencies failed are
+        skipped.
+        """
+        states = {job.name: job.state for job in self.jobs}
+
+        ready_jobs = []
+        for job in self.jobs:
+            if job.state != "queued":
+                continue
+
+            dependency_states = [states[name] for name in job.depends_on]
+            if any(
+                state in ["failed", "killed", "skipped"] for state in dependency_states
+            ):
+                job.state = "skipped"
+                cf.log_message(
+                    "Job "
+                    + job.name
+                    + " skipped because one of its dependencies did not finish"
+                )
+                # Skipping can make other jobs skippable, so start over
+                return self.next_job(last_job)
+            if all(state == "done" for state in dependency_states):
+                ready_jobs.append(job)
+
+        if not ready_jobs:
+            return None
+
+        def sort_key(job):
+            same_device = job.device == self.current_device
+            if last_job is None:
+                shared_point = 0
+            else:
+                shared_point = sum(
+                    value is not None and value == last_value
+                    for value, last_value in zip(
+                        job.operating_point, last_job.operating_point
+                    )
+                )
+            return (-job.priority, not same_device, -shared_point)
+
+        # sorted is stable, so jobs with equal keys keep their queue order
+        return sorted(ready_jobs, key=sort_key)[0]
+
+    def run(self):
+        """
+        Run all queued jobs (blocking)
+        """
+        self.is_killed = False
+        last_job = None
+
+        try:
+            while not self.is_killed:
+                job = self.next_job(last_job)
+                if job is None:
+                    break
+
+                if job.device != self.current_device:
+                    if self.change_device is not None:
+                        self.change_device(job.setup_parameters)
+                    self.current_device = job.device
+
+                observer = None
+                if self.observer_factory is not None:
+                    observer = self.observer_factory(job)
+
+                cf.log_message("Starting job " + job.name)
+                job.state = "running"
+                job.start_time = time.time()
+                self.current_job = job
+                try:
+                    # The first job initialises the hardware, all later ones
+                    # reuse it as long as the job before finished regularly
+                    job.engine = self.engine_factory(
+                        job,
+                        self.arduino,
+                        self.source,
+                        self.oscilloscope,
+                        observer,
+                        last_job is not None and last_job.state == "done",
+                    )
+                    job.engine.run()
+                    job.state = "killed" if job.engine.is_killed else "done"
+                except KeyboardInterrupt:
+                    job.state = "killed"
+                    self.kill()
+                    raise
+                except Exception as e:
+                    job.state = "failed"
+                    cf.log_message("Job " + job.name + " failed")
+                    cf.log_message(e)
+                finally:
+                    job.end_time = time.time()
+                    self.current_job = None
+
+                cf.log_message(
+                    "Job "
+                    + job.name
+                    + " "
+                    + job.state
+                    + " after "
+                    + str(round(job.end_time - job.start_time, 1))
+                    + " s"
+                )
+                last_job = job
+        finally:
+            # Reset the hardware once at the very end
+            self.source.output(False, channel=1)
+            self.source.output(False, channel=2)
+            self.arduino.set_frequency(1000, True)
+            self.arduino.trigger_frequency_generation(False)
+
+    def kill(self):
+        """
+        Kill the running job and do not start any further ones
+        """
+        self.is_killed = True
+        if self.current_job is not None and self.current_job.engine is not None:
+            self.current_job.engine.kill()
+
+    def summary(self):
+        """
+        Return the state of all jobs
+        """
+        return [
+            {
+                "name": job.name,
+                "scan_type": job.scan_type,
+                "device_number": job.setup_parameters["device_number"],
+                "priority": job.priority,
+                "state": job.state,
+            }
+            for job in self.jobs
+        ]
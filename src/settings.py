@@ -1,9 +1,8 @@
 from PySide6 import QtWidgets
 
 import json
-import os
 import core_functions as cf
-from pathlib import Path
+import settings_service
 
 from loading_window import LoadingWindow
 from UI_settings_window import Ui_Settings
@@ -35,6 +34,12 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
         self.luminance_mode_toggleSwitch.setChecked(
             bool(default_settings["luminance_mode"])
         )
+        self.lock_in_mode_toggleSwitch.setChecked(
+            bool(default_settings.get("lock_in_mode", False))
+        )
+        self.adaptive_settling_toggleSwitch.setChecked(
+            bool(default_settings.get("adaptive_settling", False))
+        )
         # isChecked()
         self.base_capacitance_lineEdit.setText(
             str(default_settings["base_capacitance"])
@@ -110,6 +115,8 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
                 "default_saving_path": self.default_saving_path_lineEdit.text(),
                 "pid_parameters": self.pid_parameters_lineEdit.text(),
                 "luminance_mode": self.luminance_mode_toggleSwitch.isChecked(),
+                "lock_in_mode": self.lock_in_mode_toggleSwitch.isChecked(),
+                "adaptive_settling": self.adaptive_settling_toggleSwitch.isChecked(),
                 "base_capacitance": self.base_capacitance_lineEdit.text(),
                 "coil_inductance": self.coil_inductance_lineEdit.text(),
                 "coil_windings": self.coil_windings_lineEdit.text(),
@@ -125,21 +132,29 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
         )
 
         # Load the default parameter settings
-        with open(
-            os.path.join(Path(__file__).parent.parent, "usr", "global_settings.json")
-        ) as json_file:
-            data = json.load(json_file)
+        data = settings_service.service.read_file()
 
         # Add the default parameters to the new settings json
         settings_data["default"] = []
         settings_data["default"] = data["default"]
 
-        # Save the entire thing again to the settings.json file
-        with open(
-            os.path.join(Path(__file__).parent.parent, "usr", "global_settings.json"),
-            "w",
-        ) as json_file:
-            json.dump(settings_data, json_file, indent=4)
+        # Save the entire thing again to the settings.json file (the cached
+        # settings are updated and e.g. the arduino rebuilds its capacitor
+        # table if necessary)
+        try:
+            settings_service.service.save(settings_data)
+        except ValueError as error:
+            msgBox = QtWidgets.QMessageBox()
+            msgBox.setText("Invalid settings: " + str(error))
+            msgBox.setStandardButtons(QtWidgets.QMessageBox.Ok)
+            msgBox.setStyleSheet(
+                "background-color: rgb(44, 49, 60);\n"
+                "color: rgb(255, 255, 255);\n"
+                'font: 63 bold 10pt "Segoe UI";\n'
+                ""
+            )
+            msgBox.exec()
+            return
 
         cf.log_message("Settings saved")
 
@@ -167,19 +182,9 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
 
             # Execute loading dialog
             loading_window.exec()
-        elif any(
-            key in reload_window_comparison.keys()
-            for key in [
-                "coil_inductance",
-                "dc_field_conversion_factor",
-                "capacitances",
-                "base_capacitance",
-                "arduino_pins",
-                "calibration_file_path",
-            ]
-        ):
-            # Only reinit caps and dc field conversion factor
-            self.parent.arduino.init_caps()
+        elif "dc_field_conversion_factor" in reload_window_comparison.keys():
+            # The arduino subscribed to the capacitor settings itself, only
+            # the dc field conversion factor has to be set
             self.parent.source.dc_field_conversion_factor = float(
                 settings_data["overwrite"][0]["dc_field_conversion_factor"]
             )
@@ -189,10 +194,7 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
         Load default settings (in case the user messed up the own settings)
         """
 
-        with open(
-            os.path.join(Path(__file__).parent.parent, "usr", "global_settings.json")
-        ) as json_file:
-            data = json.load(json_file)
+        data = settings_service.service.read_file()
 
         default_settings = data["default"][0]
         self.source_address_lineEdit.setText(default_settings["source_address"])
@@ -208,6 +210,12 @@ class Settings(QtWidgets.QDialog, Ui_Settings):
         self.luminance_mode_toggleSwitch.setChecked(
             bool(default_settings["luminance_mode"])
         )
+        self.lock_in_mode_toggleSwitch.setChecked(
+            bool(default_settings.get("lock_in_mode", False))
+        )
+        self.adaptive_settling_toggleSwitch.setChecked(
+            bool(default_settings.get("adaptive_settling", False))
+        )
         # isChecked()
         self.base_capacitance_lineEdit.setText(
             str(default_settings["base_capacitance"])
@@ -0,0 +1,210 @@
+"""
+Process wide cache of the global settings. The settings file is only parsed
+again if its modification time changed or if the settings window saved new
+settings, instead of every time a scan or the arduino needs them. The
+comma separated lists (capacitances, arduino pins and PID parameters) are
+parsed once and validated, so that a broken file is reported when it is read
+and not in the middle of a scan. Objects that depend on the settings can
+subscribe to be notified with the keys that changed:
+
+    settings = settings_service.service.settings()
+    settings["coil_inductance"], settings.capacitances, settings.arduino_pins
+    settings_service.service.subscribe(arduino.settings_changed)
+
+The file is written to a temporary file that replaces the old one in a single
+step, so that readers never see half written settings.
+"""
+
+import json
+import os
+import threading
+import types
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+import core_functions as cf
+
+SETTINGS_PATH = os.path.join(
+    Path(__file__).parent.parent, "usr", "global_settings.json"
+)
+
+
+def parse_list(value, dtype=float):
+    """
+    Read-only array of a comma separated list
+    """
+    array = np.array(
+        [element for element in str(value).split(",") if element.strip() != ""],
+        dtype=dtype,
+    )
+    array.setflags(write=False)
+    return array
+
+
+class GlobalSettings(dict):
+    """
+    Values of the settings file (numbers as float and everything else as str,
+    like the file was always read) with the parsed lists as attributes
+    """
+
+    def __init__(self, values):
+        super(GlobalSettings, self).__init__()
+        for key, value in values.items():
+            try:
+                self[key] = float(value)
+            except (TypeError, ValueError):
+                self[key] = str(value)
+
+        self.pid_parameters = parse_list(self["pid_parameters"], float)
+        self.capacitances = parse_list(self["capacitances"], float)
+        self.arduino_pins = parse_list(self["arduino_pins"], int)
+
+        if len(self.pid_parameters) != 3:
+            raise ValueError("Three PID parameters are needed (P, I, D)")
+        if len(self.capacitances) != len(self.arduino_pins):
+            raise ValueError(
+                "Every capacitance needs an arduino pin ("
+                + str(len(self.capacitances))
+                + " capacitances, "
+                + str(len(self.arduino_pins))
+                + " pins)"
+            )
+        if len(np.unique(self.arduino_pins)) != len(self.arduino_pins):
+            raise ValueError("The arduino pins have to be unique")
+
+    def __copy__(self):
+        # The parsed lists are read-only and can be shared
+        settings = GlobalSettings.__new__(GlobalSettings)
+        dict.update(settings, self)
+        settings.__dict__.update(self.__dict__)
+        return settings
+
+    def copy(self):
+        return self.__copy__()
+
+
+class SettingsService:
+    """
+    Cached settings of a settings file with change notification
+    """
+
+    def __init__(self, file_path=SETTINGS_PATH):
+        self.file_path = file_path
+        self.lock = threading.RLock()
+        self.modification_time = None
+        self.cached = None
+        self.subscribers = []
+
+    def read_file(self):
+        """
+        Complete content of the settings file (overwrite and default entries)
+        """
+        with open(self.file_path) as json_file:
+            return json.load(json_file)
+
+    def settings(self):
+        """
+        Current settings, the file is only parsed again if it changed
+        """
+        with self.lock:
+            changed_keys = []
+            modification_time = os.stat(self.file_path).st_mtime_ns
+            if self.cached is None or modification_time != self.modification_time:
+                changed_keys = self.reload(modification_time)
+            settings = self.cached
+
+        self.notify(changed_keys)
+        return settings
+
+    def reload(self, modification_time):
+        """
+        Parse the settings file and return the keys that changed. If a changed
+        file can not be parsed, the previous settings are kept.
+        """
+        try:
+            data = self.read_file()
+            try:
+                values = data["overwrite"][0]
+                message = "Global Settings Read from File"
+            except (KeyError, IndexError):
+                values = data["default"][0]
+                message = "Default device parameters taken"
+            settings = GlobalSettings(values)
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            if self.cached is None:
+                raise
+            cf.log_message(
+                "Settings file could not be read ("
+                + str(error)
+                + "), the previous settings are kept"
+            )
+            self.modification_time = modification_time
+            return []
+
+        cf.log_message(message)
+        previous = self.cached
+        self.cached = settings
+        self.modification_time = modification_time
+
+        if previous is None:
+            return []
+        return [
+            key
+            for key in set(previous) | set(settings)
+            if previous.get(key) != settings.get(key)
+        ]
+
+    def save(self, data):
+        """
+        Write the complete content of the settings file and notify the
+        subscribers of the changed settings
+        """
+        with self.lock:
+            # Validate before anything is written
+            GlobalSettings(data["overwrite"][0])
+
+            temporary_path = self.file_path + ".tmp"
+            with open(temporary_path, "w") as json_file:
+                json.dump(data, json_file, indent=4)
+            os.replace(temporary_path, self.file_path)
+
+            changed_keys = self.reload(os.stat(self.file_path).st_mtime_ns)
+
+        self.notify(changed_keys)
+
+    def subscribe(self, callback):
+        """
+        Call callback(changed_keys, settings) whenever the settings changed.
+        Bound methods are only weakly referenced so that subscribing does not
+        keep e.g. an old arduino alive.
+        """
+        with self.lock:
+            if isinstance(callback, types.MethodType):
+                self.subscribers.append(weakref.WeakMethod(callback))
+            else:
+                self.subscribers.append(lambda: callback)
+
+    def notify(self, changed_keys):
+        """
+        Call the subscribers (outside of the lock, so that they can use locks
+        of their own without risking a deadlock)
+        """
+        if len(changed_keys) == 0:
+            return
+
+        with self.lock:
+            self.subscribers = [
+                reference for reference in self.subscribers if reference() is not None
+            ]
+            references = list(self.subscribers)
+            settings = self.cached
+
+        for reference in references:
+            callback = reference()
+            if callback is not None:
+                callback(changed_keys, settings)
+
+
+service = SettingsService()
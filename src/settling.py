@@ -0,0 +1,76 @@
+"""
+Detection of the settling of the setup after a change (of the bias field, hf
+field or frequency). Instead of always waiting the worst case settling time,
+a response of the setup (e.g. the source current or the pickup coil voltage)
+is sampled at a short interval. The setup is settled as soon as the samples
+of a rolling window neither drift (slope of a linear fit) nor scatter
+(standard deviation) by more than a tolerance relative to their mean. The
+settling time chosen by the user remains the upper bound:
+
+    settled, elapsed = wait_until_settled(
+        lambda: source.read_values(2)[1], maximum_time=2
+    )
+"""
+
+import time
+
+import numpy as np
+
+# Sampling interval (s) and number of samples of the rolling window
+SAMPLING_INTERVAL = 0.05
+WINDOW = 4
+
+# Maximum drift over the window and standard deviation relative to the mean
+TOLERANCE = 0.02
+
+# Absolute tolerance for responses that are close to zero
+ABSOLUTE_TOLERANCE = 1e-4
+
+
+def is_settled(times, values, tolerance=TOLERANCE, absolute_tolerance=None):
+    """
+    Check if the samples neither drift nor scatter by more than the tolerance
+    """
+    if absolute_tolerance is None:
+        absolute_tolerance = ABSOLUTE_TOLERANCE
+
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    threshold = max(tolerance * np.abs(np.mean(values)), absolute_tolerance)
+
+    slope = np.polyfit(times - times[0], values, 1)[0]
+    drift = np.abs(slope) * (times[-1] - times[0])
+
+    return drift <= threshold and np.std(values) <= threshold
+
+
+def wait_until_settled(
+    probe,
+    maximum_time,
+    interval=SAMPLING_INTERVAL,
+    window=WINDOW,
+    tolerance=TOLERANCE,
+    absolute_tolerance=None,
+    should_stop=lambda: False,
+):
+    """
+    Sample probe() until the last samples settled or the maximum time passed.
+    Returns if it settled and the time (s) it took.
+    """
+    start_time = time.monotonic()
+    times = []
+    values = []
+    while True:
+        times.append(time.monotonic() - start_time)
+        values.append(float(probe()))
+
+        if len(values) >= window and is_settled(
+            times[-window:], values[-window:], tolerance, absolute_tolerance
+        ):
+            return True, time.monotonic() - start_time
+
+        # Do not sample beyond the maximum time
+        remaining = maximum_time - (time.monotonic() - start_time)
+        if remaining <= 0 or should_stop():
+            return False, time.monotonic() - start_time
+        time.sleep(min(interval, remaining))
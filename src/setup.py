@@ -2,6 +2,8 @@ from PySide6 import QtCore
 
 import time
 
+import telemetry
+
 
 class SetupThread(QtCore.QThread):
     """
@@ -23,6 +25,7 @@ class SetupThread(QtCore.QThread):
         self.arduino = arduino
         self.arduino.init_serial_connection()
         self.source = source
+        self.telemetry = telemetry.broker(source)
         # self.oscilloscope = oscilloscope
 
         # Connect signal to the updater from the parent class
@@ -38,22 +41,20 @@ class SetupThread(QtCore.QThread):
         pydevd.settrace(suspend=False)
 
         while True:
-            reference_time = time.time()
-            # Measure
-            voltage, current = self.source.read_values(channel=2)
-            dc_voltage, dc_current, dc_magnetic_field = self.source.read_values(
-                channel=1
-            )
-            # frequency = self.arduino.read_frequency()
-
-            self.update_display.emit(voltage, current, dc_current, dc_magnetic_field)
-            print("elapsed time: " + str(time.time() - reference_time))
-
-            # The sleep time here is very important because if it is chosen too
-            # short, the program may crash. Currently 1 s seems to be save (one
-            # can at least go down to 0.5s). The reason is the latency of the
-            # hf_source.
-            time.sleep(1)
+            # Values are taken from the telemetry broker which only reads the
+            # source if the cached values are too old (e.g. not read by a
+            # running scan). Since the source serialises access to its port,
+            # the polling no longer collides with the scans.
+            readings = self.telemetry.poll(channels=(2, 1))
+            if readings[2] is not None and readings[1] is not None:
+                voltage, current = readings[2]
+                dc_voltage, dc_current, dc_magnetic_field = readings[1]
+                self.update_display.emit(
+                    voltage, current, dc_current, dc_magnetic_field
+                )
+
+            # Poll less often while a scan is reading the source
+            time.sleep(self.telemetry.current_poll_interval)
 
             if self.pause:
                 while True:
@@ -0,0 +1,952 @@
+"""
+Simulated hardware that allows to run (and profile) the measurements without
+the lab setup. The physics of the setup is modelled in SimulatedSetup:
+
+    - the Korad source channel 2 drives the class-D amplifier and therefore
+      the series RLC circuit of the AC coil (coil inductance, circuit
+      resistance and the capacitors switched by the arduino)
+    - the Korad source channel 1 drives the DC bias coil
+    - the pickup coil (oscilloscope channel 1) sees the voltage induced by
+      the AC field
+    - the ME device (oscilloscope channel 2) responds to the AC field with a
+      coefficient that peaks at a certain bias field
+    - the oscilloscope quantises everything with its 8 bit ADC and saturates
+      if the signal does not fit on the screen
+
+The simulated devices speak the same command protocols as the real ones
+(SCPI for the oscilloscope, the KORAD serial protocol and the commands of the
+arduino sketch) with configurable command latencies. They can be used as
+drop-in replacements (SimulatedRigolOscilloscope, SimulatedKoradKD3305PSource,
+SimulatedArduino) that run the code of the real drivers on virtual transports
+or be served as virtual instruments over TCP (serve_virtual_instruments).
+"""
+
+import socketserver
+import threading
+import time
+
+import numpy as np
+import pyvisa
+import serial
+from PySide6 import QtCore
+
+import core_functions as cf
+import physics_functions as pf
+import pulse_sequence
+import settings_service
+from hardware import RigolOscilloscope, KoradKD3305PSource, Arduino
+
+
+class SimulatedSetup:
+    """
+    Physical model of the setup that is shared by all simulated devices
+    """
+
+    def __init__(
+        self,
+        me_coefficient=0.05,
+        me_bias_peak=1.5,
+        me_remanence=0.05,
+        me_resonance_frequency=None,
+        me_quality_factor=50,
+        bias_coil_resistance=2.0,
+        settling_time_constant=0.05,
+        noise=0.005,
+        seed=None,
+    ):
+        global_settings = cf.read_global_settings()
+
+        # Coil parameters in SI units
+        self.coil_inductance = global_settings["coil_inductance"] * 1e-3
+        self.coil_windings = global_settings["coil_windings"]
+        self.coil_radius = global_settings["coil_radius"] * 1e-3
+        self.circuit_resistance = global_settings["circuit_resistance"]
+        self.pickup_coil_windings = global_settings["pickup_coil_windings"]
+        self.pickup_coil_radius = global_settings["pickup_coil_radius"] * 1e-3
+        self.dc_field_conversion_factor = global_settings["dc_field_conversion_factor"]
+        self.bias_coil_resistance = bias_coil_resistance
+
+        # Capacitors in pF, the cap numbers of the arduino sketch are the pins
+        self.base_capacitance = float(global_settings["base_capacitance"])
+        capacitances = global_settings.capacitances
+        arduino_pins = global_settings.arduino_pins
+        self.cap_values = dict(zip(arduino_pins, capacitances))
+
+        # ME device: coefficient in V/mT at the bias field peak (in mT)
+        self.me_coefficient = me_coefficient
+        self.me_bias_peak = me_bias_peak
+        self.me_remanence = me_remanence
+        self.me_resonance_frequency = me_resonance_frequency
+        self.me_quality_factor = me_quality_factor
+
+        # Time constant in s with which the coil current follows changes and
+        # relative noise of all analog signals
+        self.settling_time_constant = settling_time_constant
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.lock = threading.RLock()
+
+        # State of the arduino (frequency in Hz) and the capacitor relays
+        self.frequency = 100000.0
+        self.frequency_on = True
+        self.cap_states = {cap_no: False for cap_no in range(1, 11)}
+        self.resistance = 2000
+
+        # State of the two source channels
+        self.set_voltages = {1: 0.0, 2: 0.0}
+        self.set_currents = {1: 0.0, 2: 0.0}
+        self.outputs = {1: False, 2: False}
+
+        # Coil current amplitude to model the settling after changes
+        self.last_coil_current = 0.0
+        self.last_change = time.time()
+
+    def changed(self):
+        """
+        Has to be called before the state changes to model the settling of
+        the coil current
+        """
+        with self.lock:
+            self.last_coil_current = self.coil_current()
+            self.last_change = time.time()
+
+    def capacitance(self):
+        """
+        Capacitance of the RLC circuit in pF
+        """
+        return self.base_capacitance + sum(
+            value
+            for cap_no, value in self.cap_values.items()
+            if self.cap_states.get(cap_no, False)
+        )
+
+    def impedance(self):
+        """
+        Absolute impedance of the series RLC circuit in Ohm
+        """
+        omega = 2 * np.pi * self.frequency
+        reactance = omega * self.coil_inductance - 1 / (
+            omega * self.capacitance() * 1e-12
+        )
+        return np.sqrt(self.circuit_resistance**2 + reactance**2)
+
+    def drive_voltage(self):
+        """
+        Amplitude of the amplifier output. If the source limits the current,
+        the voltage drops accordingly.
+        """
+        if not (self.outputs[2] and self.frequency_on):
+            return 0.0
+
+        voltage = self.set_voltages[2]
+        if voltage <= 0:
+            return 0.0
+
+        # The (ideal) amplifier draws the power dissipated in the circuit
+        impedance = self.impedance()
+        supply_current = voltage * self.circuit_resistance / (2 * impedance**2)
+        if supply_current > self.set_currents[2]:
+            voltage = np.sqrt(
+                self.set_currents[2]
+                * voltage
+                * 2
+                * impedance**2
+                / self.circuit_resistance
+            )
+
+        return voltage
+
+    def coil_current(self):
+        """
+        Amplitude of the steady state coil current in A
+        """
+        return self.drive_voltage() / self.impedance()
+
+    def settled_coil_current(self):
+        """
+        Coil current amplitude including the exponential settling after the
+        last change
+        """
+        target = self.coil_current()
+        if self.settling_time_constant <= 0:
+            return target
+
+        decay = np.exp(-(time.time() - self.last_change) / self.settling_time_constant)
+        return target + (self.last_coil_current - target) * decay
+
+    def ac_field(self):
+        """
+        Amplitude of the AC magnetic field in T
+        """
+        return pf.calculate_magnetic_field(
+            self.settled_coil_current(),
+            self.coil_inductance,
+            self.coil_windings,
+            self.coil_radius,
+        )
+
+    def dc_current(self):
+        """
+        Current through the bias coil in A
+        """
+        if not self.outputs[1]:
+            return 0.0
+        return min(
+            self.set_currents[1], self.set_voltages[1] / self.bias_coil_resistance
+        )
+
+    def dc_field(self):
+        """
+        DC bias field in mT
+        """
+        return self.dc_current() * self.dc_field_conversion_factor
+
+    def pickup_voltage(self):
+        """
+        Amplitude of the voltage induced in the pickup coil (inverse of
+        calculate_magnetic_field_from_Vind)
+        """
+        return (
+            self.ac_field()
+            * self.pickup_coil_windings
+            * np.pi
+            * self.pickup_coil_radius**2
+            * 2
+            * np.pi
+            * self.frequency
+        )
+
+    def me_voltage(self):
+        """
+        Amplitude of the ME voltage that peaks at the bias field me_bias_peak
+        and optionally at the mechanical resonance of the device
+        """
+        bias = abs(self.dc_field()) / self.me_bias_peak
+        coefficient = self.me_coefficient * (
+            self.me_remanence + (1 - self.me_remanence) * bias * np.exp(1 - bias)
+        )
+
+        if self.me_resonance_frequency is not None:
+            ratio = self.frequency / self.me_resonance_frequency
+            coefficient /= np.sqrt(
+                1 + self.me_quality_factor**2 * (ratio - 1 / ratio) ** 2
+            )
+
+        return coefficient * self.ac_field() * 1e3
+
+    def signal_amplitude(self, channel):
+        """
+        Amplitude of the signal at one of the oscilloscope channels
+        """
+        with self.lock:
+            if channel == 1:
+                amplitude = self.pickup_voltage()
+            else:
+                amplitude = self.me_voltage()
+
+        return amplitude * (1 + self.noise * self.rng.standard_normal())
+
+
+class VirtualInstrument:
+    """
+    Base class of the virtual devices. It parses the commands, waits for the
+    command latency and buffers the replies.
+    """
+
+    # Device side latencies in s
+    latencies = {"command": 0.0}
+
+    def __init__(self, setup, latencies=None, time_scale=1.0):
+        self.setup = setup
+        self.latencies = dict(self.latencies)
+        if latencies is not None:
+            self.latencies.update(latencies)
+        self.time_scale = time_scale
+
+        self.buffer = b""
+        self.buffer_lock = threading.Lock()
+
+    def wait(self, key):
+        """
+        Wait for the latency of a command
+        """
+        latency = self.latencies.get(key, self.latencies["command"]) * self.time_scale
+        if latency > 0:
+            time.sleep(latency)
+
+    def handle_command(self, command):
+        """
+        Execute a command and return the reply (or None)
+        """
+        raise NotImplementedError
+
+    def write(self, data):
+        """
+        Write one or several newline terminated commands
+        """
+        if isinstance(data, bytes):
+            data = data.decode()
+
+        for command in data.replace("\r", "\n").split("\n"):
+            command = command.strip()
+            if command == "":
+                continue
+            reply = self.handle_command(command)
+            if reply is not None:
+                if isinstance(reply, str):
+                    reply = reply.encode()
+                with self.buffer_lock:
+                    self.buffer += reply
+
+        return len(data)
+
+    def pop(self, size=None, until=None):
+        """
+        Return (and remove) size bytes or everything up to the byte string
+        until from the reply buffer
+        """
+        with self.buffer_lock:
+            if until is not None and until in self.buffer:
+                end = self.buffer.index(until) + len(until)
+                if size is not None:
+                    end = min(end, size)
+            elif size is not None:
+                end = size
+            else:
+                end = len(self.buffer)
+
+            data = self.buffer[:end]
+            self.buffer = self.buffer[end:]
+
+        return data
+
+
+class VirtualRigolResource(VirtualInstrument):
+    """
+    Virtual pyvisa resource that understands the SCPI commands the
+    RigolOscilloscope class uses
+    """
+
+    latencies = {"command": 0.002, "query": 0.015, "waveform": 0.04}
+
+    # The screen has 8 vertical divisions with 25 ADC counts each
+    counts_per_division = 25
+    number_of_points = 1200
+
+    def __init__(self, setup, latencies=None, time_scale=1.0):
+        super(VirtualRigolResource, self).__init__(setup, latencies, time_scale)
+
+        self.timeout = 25000
+        self.scales = {1: 2.0, 2: 2.0}
+        self.offsets = {1: 0.0, 2: 0.0}
+        self.timescale = 5e-6
+        self.waveform_source = 1
+        self.running = True
+
+    def channel_number(self, argument):
+        """
+        Translate CHAN1 or CHANnel2 to the channel number
+        """
+        return int(argument.strip()[-1])
+
+    def quantise(self, voltage, channel):
+        """
+        Return the ADC counts of a voltage (128 is the centre of the screen)
+        """
+        counts = np.round(
+            (voltage + self.offsets[channel])
+            / self.scales[channel]
+            * self.counts_per_division
+            + 128
+        )
+        return np.clip(counts, 0, 255)
+
+    def waveform(self, channel):
+        """
+        Voltages of the waveform on the screen as the ADC sees them
+        """
+        amplitude = self.setup.signal_amplitude(channel)
+        time_data = np.linspace(
+            -6 * self.timescale, 6 * self.timescale, self.number_of_points
+        )
+        voltage = amplitude * np.sin(2 * np.pi * self.setup.frequency * time_data)
+        voltage += (
+            self.setup.noise
+            * self.scales[channel]
+            * self.setup.rng.standard_normal(self.number_of_points)
+        )
+        return self.quantise(voltage, channel)
+
+    def measure(self, quantity, channel):
+        """
+        Measure a quantity the way the oscilloscope does it on the quantised
+        waveform. 9.9E37 is returned if the signal is clipped.
+        """
+        counts = self.waveform(channel)
+        if np.max(counts) >= 4.9 * self.counts_per_division + 128 or np.min(
+            counts
+        ) <= 128 - 4.9 * self.counts_per_division:
+            return 9.9e37
+
+        voltage = (counts - 128) / self.counts_per_division * self.scales[
+            channel
+        ] - self.offsets[channel]
+
+        if quantity == "VMAX":
+            return np.max(voltage)
+        elif quantity == "VMIN":
+            return np.min(voltage)
+        elif quantity == "VPP":
+            return np.max(voltage) - np.min(voltage)
+        elif quantity in ["VAMP", "VAMPLITUDE"]:
+            return np.percentile(voltage, 95) - np.percentile(voltage, 5)
+        elif quantity == "VTOP":
+            return np.percentile(voltage, 95)
+        elif quantity in ["VBAS", "VBASE"]:
+            return np.percentile(voltage, 5)
+        elif quantity == "VRMS":
+            return np.sqrt(np.mean(voltage**2))
+        elif quantity in ["VAV", "VAVG", "VAVERAGE"]:
+            return np.mean(voltage)
+        elif quantity in ["FREQ", "FREQUENCY"]:
+            # No frequency can be determined for a flat line
+            if np.max(counts) - np.min(counts) < 3:
+                return 9.9e37
+            return self.setup.frequency
+        elif quantity in ["PER", "PERIOD"]:
+            return 1 / self.setup.frequency
+
+        return 9.9e37
+
+    def handle_command(self, command):
+        header, _, argument = command.partition(" ")
+        header = header.upper()
+
+        if header.endswith("?"):
+            self.wait("query")
+        else:
+            self.wait("command")
+
+        if header in ["RUN", ":RUN"]:
+            self.running = True
+        elif header in ["STOP", ":STOP"]:
+            self.running = False
+        elif header.startswith(":KEY"):
+            return None
+        elif header in [":TIM:SCAL", ":TIMEBASE:SCALE"]:
+            self.timescale = float(argument)
+        elif header in [":TIM:SCAL?", ":TIMEBASE:SCALE?"]:
+            return "{0:e}\n".format(self.timescale)
+        elif header in [":TIM:OFFS?", ":TIMEBASE:OFFSET?"]:
+            return "0.000000e+00\n"
+        elif header.startswith(":CHAN"):
+            channel = int(header.split(":")[1][-1])
+            if header.endswith(("SCAL?", "SCALE?")):
+                return "{0:e}\n".format(self.scales[channel])
+            elif header.endswith(("OFFS?", "OFFSET?")):
+                return "{0:e}\n".format(self.offsets[channel])
+            elif header.endswith(("SCAL", "SCALE")):
+                self.scales[channel] = float(argument)
+            elif header.endswith(("OFFS", "OFFSET")):
+                self.offsets[channel] = float(argument)
+        elif header.startswith((":MEAS:", ":MEASURE:")) and header.endswith("?"):
+            quantity = header.split(":")[-1][:-1]
+            return "{0:e}\n".format(
+                self.measure(quantity, self.channel_number(argument))
+            )
+        elif header in ["WAV:SOUR", ":WAV:SOUR", ":WAVEFORM:SOURCE"]:
+            self.waveform_source = self.channel_number(argument)
+        elif header in [":WAV:POIN:MODE", ":WAV:MODE"]:
+            return None
+        elif header in [":WAV:DATA?", ":WAVEFORM:DATA?"]:
+            self.wait("waveform")
+            data = self.waveform(self.waveform_source).astype(np.uint8).tobytes()
+            return b"#9" + "{0:09d}".format(len(data)).encode() + data + b"\n"
+        elif header == "*IDN?":
+            return "RIGOL TECHNOLOGIES,DS1202Z-E,SIMULATED,00.06.02\n"
+        else:
+            cf.log_message("Simulated oscilloscope received unknown command " + command)
+
+        return None
+
+    def write(self, data):
+        """
+        Several commands can be sent in one line separated by semicolons. The
+        replies of the queries are then returned separated by semicolons as
+        well.
+        """
+        if isinstance(data, bytes):
+            data = data.decode()
+
+        for line in data.replace("\r", "\n").split("\n"):
+            replies = []
+            for command in line.split(";"):
+                command = command.strip()
+                if command == "":
+                    continue
+                reply = self.handle_command(command)
+                if reply is not None:
+                    replies.append(reply)
+
+            if len(replies) == 1:
+                reply = replies[0]
+            elif len(replies) > 1:
+                reply = ";".join(reply.rstrip("\n") for reply in replies) + "\n"
+            else:
+                continue
+
+            if isinstance(reply, str):
+                reply = reply.encode()
+            with self.buffer_lock:
+                self.buffer += reply
+
+        return len(data)
+
+    def read(self):
+        """
+        Read a reply (like pyvisa the termination character is removed)
+        """
+        data = self.pop(until=b"\n")
+        if data == b"":
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+        return data.decode().rstrip("\n")
+
+    def read_raw(self):
+        data = self.pop()
+        if data == b"":
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+        return data
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def clear(self):
+        """
+        Discard the unread replies (device clear)
+        """
+        with self.buffer_lock:
+            self.buffer = b""
+
+    def close(self):
+        return None
+
+
+class VirtualKoradSerial(VirtualInstrument):
+    """
+    Virtual serial port that understands the KORAD protocol
+    """
+
+    latencies = {"command": 0.015, "query": 0.025}
+
+    def __init__(self, setup, latencies=None, time_scale=1.0, timeout=1):
+        super(VirtualKoradSerial, self).__init__(setup, latencies, time_scale)
+        self.timeout = timeout
+        self.is_open = True
+
+    def handle_command(self, command):
+        command = command.upper()
+
+        if command.endswith("?"):
+            self.wait("query")
+        else:
+            self.wait("command")
+
+        with self.setup.lock:
+            if command.startswith(("VSET", "ISET", "OUT")):
+                self.setup.changed()
+
+            if command.startswith("VSET"):
+                channel, value = command[4:].split(":")
+                self.setup.set_voltages[int(channel)] = float(value)
+            elif command.startswith("ISET"):
+                channel, value = command[4:].split(":")
+                self.setup.set_currents[int(channel)] = float(value)
+            elif command.startswith("OUT"):
+                channel, value = command[3:].split(":")
+                self.setup.outputs[int(channel)] = bool(int(value))
+            elif command.startswith("VOUT"):
+                channel = int(command[4])
+                if channel == 1:
+                    voltage = self.setup.dc_current() * self.setup.bias_coil_resistance
+                else:
+                    voltage = self.setup.set_voltages[2] if self.setup.outputs[2] else 0
+                return "{0:05.2f}\n".format(voltage)
+            elif command.startswith("IOUT"):
+                channel = int(command[4])
+                if channel == 1:
+                    current = self.setup.dc_current()
+                elif self.setup.set_voltages[2] > 0:
+                    # Power drawn by the RLC circuit
+                    current = (
+                        (self.setup.settled_coil_current() ** 2)
+                        * self.setup.circuit_resistance
+                        / 2
+                        / self.setup.set_voltages[2]
+                    )
+                else:
+                    current = 0
+                current *= 1 + self.setup.noise * self.setup.rng.standard_normal()
+                return "{0:06.4f}\n".format(max(current, 0))
+            elif command.startswith("*IDN?"):
+                return "KORAD KD3305P SIMULATED\n"
+            else:
+                cf.log_message("Simulated source received unknown command " + command)
+
+        return None
+
+    def read(self, size=1):
+        data = self.pop(size=size)
+        # The real port waits for the timeout if not enough bytes arrived
+        if len(data) < size:
+            time.sleep(self.timeout * self.time_scale)
+        return data
+
+    def readline(self, size=-1):
+        data = self.pop(size=None if size < 0 else size, until=b"\n")
+        if not data.endswith(b"\n") and (size < 0 or len(data) < size):
+            time.sleep(self.timeout * self.time_scale)
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+class VirtualArduinoSerial(VirtualInstrument):
+    """
+    Virtual serial port that understands the commands of the arduino sketch
+    """
+
+    latencies = {"command": 0.01, "freq": 0.02, "cap": 0.005}
+
+    def __init__(self, setup, latencies=None, time_scale=1.0, timeout=0.01):
+        super(VirtualArduinoSerial, self).__init__(setup, latencies, time_scale)
+        self.timeout = timeout
+        self.is_open = True
+
+        # The sketch greets after the reset
+        self.buffer = b"ready\r\n"
+
+        # Uploaded pulse schedule and the thread that executes it
+        self.segments = []
+        self.sequence_thread = None
+        self.abort_sequence = threading.Event()
+
+    def write(self, data):
+        """
+        Commands are text, except for the records that follow a schedule
+        """
+        if isinstance(data, str):
+            data = data.encode()
+
+        if data.startswith(b"seq_"):
+            header, _, payload = data.partition(b"\n")
+            self.wait("seq")
+            try:
+                segments = pulse_sequence.decode_pulse_schedule(payload)
+                if not 1 <= len(segments) == int(header[4:]) <= (
+                    pulse_sequence.MAX_SEGMENTS
+                ):
+                    raise ValueError("Wrong number of segments")
+            except ValueError:
+                self.segments = []
+                reply = b"Sequence invalid\r\n"
+            else:
+                self.segments = segments
+                reply = b"Sequence loaded: " + str(len(segments)).encode() + b"\r\n"
+
+            with self.buffer_lock:
+                self.buffer += reply
+            return len(data)
+
+        return super(VirtualArduinoSerial, self).write(data)
+
+    def run_sequence(self):
+        """
+        Execute the pulse schedule like the sketch does and stream the edges
+        """
+        start_time = time.perf_counter()
+        edge = start_time
+        for index, segment in enumerate(self.segments):
+            if self.abort_sequence.wait(max(edge - time.perf_counter(), 0)):
+                break
+
+            with self.setup.lock:
+                self.setup.changed()
+                if segment.frequency != pulse_sequence.KEEP_FREQUENCY:
+                    self.setup.frequency = float(segment.frequency)
+                if segment.relays != pulse_sequence.KEEP_RELAYS:
+                    for cap_no in self.setup.cap_states:
+                        self.setup.cap_states[cap_no] = bool(
+                            segment.relays & 1 << (cap_no - 1)
+                        )
+                self.setup.frequency_on = segment.on
+
+            edge_time = int((time.perf_counter() - start_time) * 1e6)
+            with self.buffer_lock:
+                self.buffer += (
+                    "edge_" + str(index) + "_" + str(edge_time) + "\r\n"
+                ).encode()
+            edge += segment.duration / 1e6
+        else:
+            self.abort_sequence.wait(max(edge - time.perf_counter(), 0))
+
+        with self.setup.lock:
+            self.setup.changed()
+            self.setup.frequency_on = False
+            frequency = int(self.setup.frequency)
+        with self.buffer_lock:
+            self.buffer += ("done_" + str(frequency) + "\r\n").encode()
+
+    def handle_command(self, command):
+        name, _, value = command.partition("_")
+        self.wait(name)
+
+        try:
+            value = int(float(value))
+        except ValueError:
+            value = -1
+
+        with self.setup.lock:
+            if name == "cap":
+                if value == -1:
+                    return (
+                        "".join(
+                            str(int(self.setup.cap_states[cap_no]))
+                            for cap_no in range(1, 11)
+                        )
+                        + "\n"
+                    )
+                elif 1 <= value <= 10:
+                    self.setup.changed()
+                    self.setup.cap_states[value] = not self.setup.cap_states[value]
+                    state = "on" if self.setup.cap_states[value] else "off"
+                    return "Cap " + str(value) + " " + state + "\n\r\n"
+                return "Please enter a valid capacitor number\r\n"
+            elif name == "freq":
+                if value == -1:
+                    return str(int(self.setup.frequency)) + "\r\n"
+                elif 2000 <= value <= 150000000:
+                    self.setup.changed()
+                    self.setup.frequency = float(value)
+                    return "Frequency set to: " + str(value) + " Hz\r\n"
+                return "Frequency out of range\r\n"
+            elif name == "res":
+                if value == -1:
+                    return str(self.setup.resistance) + "\r\n"
+                elif 69 <= value <= 2640:
+                    self.setup.resistance = value
+                    return "Resistance changed to: " + str(value) + " Ohm\n\r\n"
+                return "Please enter a valid resistance between 0 and 2500 Ohm\r\n"
+            elif name == "reson":
+                return "res_on"
+            elif name == "trig":
+                self.setup.changed()
+                self.setup.frequency_on = bool(value)
+                return None
+            elif name == "run":
+                if value == 1 and self.segments:
+                    self.abort_sequence.clear()
+                    self.sequence_thread = threading.Thread(
+                        target=self.run_sequence, name="arduino sequence", daemon=True
+                    )
+                    self.sequence_thread.start()
+                    return "start\r\n"
+                elif value == 0:
+                    self.abort_sequence.set()
+                return None
+
+        return (
+            name
+            + "\r\nInput not a valid command please choose command_number as a"
+            + " format.\r\n"
+        )
+
+    def open(self):
+        if self.is_open:
+            raise serial.SerialException("Port is already open.")
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def read(self, size=1):
+        data = self.pop(size=size)
+        if len(data) < size:
+            time.sleep(self.timeout)
+        return data
+
+    def readall(self):
+        # The real port reads until the timeout expired
+        time.sleep(self.timeout)
+        return self.pop()
+
+
+# One setup is shared by all simulated devices unless given explicitly
+_default_setup = None
+
+
+def default_setup():
+    """
+    Return the simulated setup that is shared by default
+    """
+    global _default_setup
+    if _default_setup is None:
+        _default_setup = SimulatedSetup()
+    return _default_setup
+
+
+class SimulatedRigolOscilloscope(RigolOscilloscope):
+    """
+    RigolOscilloscope that talks to a virtual oscilloscope
+    """
+
+    def __init__(
+        self, rigol_source_address="SIM", setup=None, combine_queries=True, **kwargs
+    ):
+        self.mutex = QtCore.QRecursiveMutex()
+        self.combine_queries = combine_queries
+        self.osci = VirtualRigolResource(
+            setup if setup is not None else default_setup(), **kwargs
+        )
+
+        self.available_scales = np.array(
+            [10, 5, 2, 1, 0.5, 0.2, 0.1, 0.05, 0.02, 0.01, 0.005, 0.002, 0.001]
+        )
+        self.scales = np.repeat(2.0, 2)
+        self.scale_cache = {}
+
+        self.osci.write(":CHAN1:OFFSET 0")
+        self.osci.write(":CHAN2:OFFSET 0")
+
+
+class SimulatedKoradKD3305PSource(KoradKD3305PSource):
+    """
+    KoradKD3305PSource that talks to a virtual source
+    """
+
+    def __init__(
+        self,
+        source_address="SIM",
+        dc_field_conversion_factor=None,
+        setup=None,
+        **kwargs
+    ):
+        self.mutex = QtCore.QRecursiveMutex()
+
+        if setup is None:
+            setup = default_setup()
+        self.source = VirtualKoradSerial(setup, **kwargs)
+
+        self.dc_output_state = False
+        self.hf_output_state = False
+
+        if dc_field_conversion_factor is None:
+            dc_field_conversion_factor = setup.dc_field_conversion_factor
+        self.dc_field_conversion_factor = dc_field_conversion_factor
+
+        self.maximum_voltage = 30
+        self.maximum_current = 5
+
+        self.output(False, channel=1)
+        self.set_voltage(20, channel=1)
+        self.output(False, channel=2)
+
+        cf.log_message("Simulated Korad Source successfully initialised")
+
+
+class SimulatedArduino(Arduino):
+    """
+    Arduino that talks to a virtual arduino
+    """
+
+    def __init__(self, com_address="SIM", setup=None, **kwargs):
+        self.mutex = QtCore.QRecursiveMutex()
+
+        # The port is opened by init_serial_connection
+        self.arduino = VirtualArduinoSerial(
+            setup if setup is not None else default_setup(), **kwargs
+        )
+        self.arduino.is_open = False
+
+        self.frequency = 1000
+        self.frequency_on = True
+
+        self.resistor_on = False
+
+        # Unread part of the edges streamed by a pulse schedule
+        self.pulse_stream = b""
+
+        self.init_caps()
+        settings_service.service.subscribe(self.settings_changed)
+        self.init_serial_connection()
+
+
+def simulated_hardware(setup=None, **kwargs):
+    """
+    Return arduino, source and oscilloscope that share one simulated setup.
+    The keyword arguments (latencies, time_scale) are passed to all devices.
+    """
+    if setup is None:
+        setup = SimulatedSetup()
+
+    arduino = SimulatedArduino(setup=setup, **kwargs)
+    source = SimulatedKoradKD3305PSource(setup=setup, **kwargs)
+    oscilloscope = SimulatedRigolOscilloscope(setup=setup, **kwargs)
+
+    return arduino, source, oscilloscope
+
+
+class VirtualInstrumentHandler(socketserver.StreamRequestHandler):
+    """
+    Forwards the commands received over TCP to a virtual instrument and sends
+    back its replies
+    """
+
+    def handle(self):
+        instrument = self.server.instrument
+        for line in self.rfile:
+            instrument.write(line)
+            reply = instrument.pop()
+            if reply:
+                self.wfile.write(reply)
+
+
+class VirtualInstrumentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, instrument):
+        self.instrument = instrument
+        super(VirtualInstrumentServer, self).__init__(
+            address, VirtualInstrumentHandler
+        )
+
+
+def serve_virtual_instruments(setup=None, host="localhost", port=5025, **kwargs):
+    """
+    Serve the virtual oscilloscope, source and arduino on three consecutive
+    TCP ports (e.g. TCPIP::localhost::5025::SOCKET for pyvisa or
+    socket://localhost:5026 for pyserial). Returns the servers that run in
+    daemon threads.
+    """
+    if setup is None:
+        setup = default_setup()
+
+    instruments = [
+        VirtualRigolResource(setup, **kwargs),
+        VirtualKoradSerial(setup, **kwargs),
+        VirtualArduinoSerial(setup, **kwargs),
+    ]
+
+    servers = []
+    for i, instrument in enumerate(instruments):
+        server = VirtualInstrumentServer((host, port + i), instrument)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cf.log_message(
+            type(instrument).__name__ + " served on " + host + ":" + str(port + i)
+        )
+        servers.append(server)
+
+    return servers
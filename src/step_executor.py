@@ -0,0 +1,42 @@
+"""
+Concurrent readout of the instruments within a measurement step. The source
+(serial) and the oscilloscope (USB-TMC) are on different buses, so their
+reads can overlap instead of running one after another. All reads that go to
+the same instrument belong into one task to keep their order.
+"""
+
+import concurrent.futures
+import time
+
+# Shared pool for the readouts of all scans (only one scan runs at a time and
+# a step rarely reads from more than three instruments)
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="step readout"
+)
+
+
+def timed_call(task):
+    """
+    Execute a task and return its result with start and end time
+    """
+    start_time = time.time()
+    result = task()
+    return result, (start_time, time.time())
+
+
+def read_concurrently(tasks):
+    """
+    Execute a dict of readout tasks (callables without arguments)
+    concurrently. Returns a dict with the results and a dict with the start
+    and end time of every task. The first exception is raised once all tasks
+    are finished.
+    """
+    futures = {name: executor.submit(timed_call, task) for name, task in tasks.items()}
+    concurrent.futures.wait(futures.values())
+
+    results = {}
+    timestamps = {}
+    for name, future in futures.items():
+        results[name], timestamps[name] = future.result()
+
+    return results, timestamps
@@ -0,0 +1,117 @@
+"""
+Pipeline for the steps of a sweep. The scan thread only sets the hardware,
+waits for it to settle and acquires the raw values of a point. Everything
+else is done by two worker threads, so that while the hardware settles on
+point N+1, the derived quantities of point N are computed (e.g. the magnetic
+field from the pickup voltage, calibration subtraction, smoothing) and point
+N-1 is stored, plotted and saved:
+
+    with SweepPipeline(self.process_step, self.record_step) as pipeline:
+        for i, point in enumerate(points):
+            ...
+            pipeline.put(i, raw_values)
+
+The steps are processed and recorded in the order they were put. Leaving the
+with block waits until all steps are recorded.
+"""
+
+import queue
+import threading
+
+import core_functions as cf
+
+
+class SweepPipeline:
+    """
+    Acquisition -> processing -> recording of the steps of a sweep
+    """
+
+    def __init__(self, process, record, depth=2):
+        # process(step, raw) returns the result that is passed to
+        # record(step, result)
+        self.process = process
+        self.record = record
+
+        # Bounded queues so that the acquisition is never more than a few
+        # steps ahead of the recording
+        self.process_queue = queue.Queue(maxsize=depth)
+        self.record_queue = queue.Queue(maxsize=depth)
+        self.error = None
+
+        self.threads = [
+            threading.Thread(
+                target=self.work,
+                args=(self.process_queue, self.process, self.record_queue),
+                name="sweep processing",
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self.work,
+                args=(self.record_queue, self.record, None),
+                name="sweep recording",
+                daemon=True,
+            ),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self, input_queue, function, output_queue):
+        """
+        Apply a stage to the steps of its queue until the end is reached
+        """
+        while True:
+            item = input_queue.get()
+            if item is None:
+                if output_queue is not None:
+                    output_queue.put(None)
+                break
+
+            # After an error the remaining steps are only consumed so that the
+            # acquisition does not block
+            if self.error is not None:
+                continue
+
+            step, data = item
+            try:
+                result = function(step, data)
+            except Exception as e:
+                cf.log_message("Step " + str(step) + " of the sweep failed")
+                cf.log_message(e)
+                self.error = e
+                continue
+
+            if output_queue is not None:
+                output_queue.put((step, result))
+
+    def put(self, step, raw):
+        """
+        Hand the raw values of a step to the pipeline (blocks if the
+        processing is too far behind)
+        """
+        if self.error is not None:
+            raise self.error
+        self.process_queue.put((step, raw))
+
+    def join(self):
+        """
+        Wait until all steps are recorded
+        """
+        self.process_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Record what was acquired so far even if the scan failed or was
+        # killed (only raise errors of the pipeline if the scan did not fail)
+        try:
+            self.join()
+        except Exception:
+            if exc_type is None:
+                raise
+        return False
@@ -0,0 +1,121 @@
+"""
+Telemetry broker that owns the readback of the source. Every reading is
+cached with a timestamp so that the display can be served without touching
+the serial port, while the scans get fresh readings on demand (which update
+the cache as well). As long as a scan is reading the source, the display
+polling backs off and falls back to the values of the scan.
+"""
+
+import threading
+import time
+
+import core_functions as cf
+import instrument_worker
+
+
+class TelemetryBroker:
+    """
+    Cached and timestamped readings of the channels of a source
+    """
+
+    def __init__(self, source, poll_interval=0.5, busy_poll_interval=5):
+        self.source = source
+
+        # Interval of the display polling when idle and while a scan runs (s)
+        self.poll_interval = poll_interval
+        self.busy_poll_interval = busy_poll_interval
+
+        self.lock = threading.Lock()
+        # Channel: (timestamp, values)
+        self.readings = {}
+        self.last_demand = -float("inf")
+
+    @property
+    def busy(self):
+        """
+        True if a scan requested a reading recently
+        """
+        return time.monotonic() - self.last_demand < self.busy_poll_interval
+
+    @property
+    def current_poll_interval(self):
+        return self.busy_poll_interval if self.busy else self.poll_interval
+
+    def read(self, channel, demand=True):
+        """
+        Read fresh values from the source and cache them. Reads on demand (by
+        the scans) make the display polling back off.
+        """
+        if demand:
+            self.last_demand = time.monotonic()
+
+        # The source serialises the access to the port itself. If it is run
+        # by an I/O worker, the display polling has lowest priority.
+        values = instrument_worker.submit(
+            self.source,
+            "read_values",
+            channel=channel,
+            priority=(
+                instrument_worker.NORMAL_PRIORITY
+                if demand
+                else instrument_worker.LOW_PRIORITY
+            ),
+        ).result()
+        with self.lock:
+            self.readings[channel] = (time.monotonic(), values)
+
+        return values
+
+    def cached(self, channel):
+        """
+        Last reading of a channel and its age in s (None if never read)
+        """
+        with self.lock:
+            if channel not in self.readings:
+                return None, None
+            timestamp, values = self.readings[channel]
+
+        return values, time.monotonic() - timestamp
+
+    def latest(self, channel, max_age):
+        """
+        Cached values if they are not older than max_age, otherwise a fresh
+        reading
+        """
+        values, age = self.cached(channel)
+        if values is not None and age <= max_age:
+            return values
+
+        return self.read(channel, demand=False)
+
+    def poll(self, channels=(2, 1)):
+        """
+        Readings for the display. The source is only read if the cached values
+        are older than the current poll interval.
+        """
+        max_age = self.current_poll_interval
+        readings = {}
+        for channel in channels:
+            try:
+                readings[channel] = self.latest(channel, max_age)
+            except Exception as e:
+                cf.log_message("Telemetry of channel " + str(channel) + " failed")
+                cf.log_message(e)
+                readings[channel], _ = self.cached(channel)
+
+        return readings
+
+
+# One broker per source
+brokers = {}
+brokers_lock = threading.Lock()
+
+
+def broker(source):
+    """
+    Return the broker of a source (created on first use)
+    """
+    with brokers_lock:
+        if id(source) not in brokers or brokers[id(source)].source is not source:
+            brokers[id(source)] = TelemetryBroker(source)
+        return brokers[id(source)]
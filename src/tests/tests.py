@@ -17,7 +17,7 @@ class MockRigoOscilloscope:
     def measure(self):
         return 1, 2, 3, 4
 
-    def measure_vmax(self, channel):
+    def measure_vmax(self, channel, frequency=None):
         return 1
 
 
@@ -0,0 +1,150 @@
+"""
+Scheduler for measurements at given times (e.g. the lifetime scan). The
+deadlines are relative to the start on the monotonic clock, so the time a
+step takes does not shift the following ones (no drift) and changes of the
+system clock do not matter. If a step overran the deadlines of the next
+steps, these are either caught up immediately (default) or skipped. The
+actual start and end time of every capture is recorded:
+
+    scheduler = TimedScheduler(log_schedule(3600, 1))
+    for i, planned_time in scheduler.steps(should_stop=lambda: self.is_killed):
+        ...
+    cf.log_message(scheduler.summary())
+"""
+
+import time
+
+import numpy as np
+
+# Density of the log-spaced schedules
+LOG_POINTS_PER_DECADE = 10
+
+
+def linear_schedule(total_time, time_step):
+    """
+    Times (s) with a constant step from zero to the total time
+    """
+    return np.arange(0, total_time + 1, time_step)
+
+
+def log_schedule(total_time, first_step, points_per_decade=LOG_POINTS_PER_DECADE):
+    """
+    Times (s) with log-spaced steps, starting with zero and the first step.
+    Early changes are captured densely without oversampling long runs. A
+    first step beyond the total time only leaves zero and the total time.
+    """
+    if total_time <= 0:
+        raise ValueError("The total time of a log-spaced schedule has to be positive")
+    if first_step <= 0:
+        raise ValueError("The first step of a log-spaced schedule has to be positive")
+
+    first_step = min(first_step, total_time)
+    number_of_points = max(
+        int(np.ceil(np.log10(total_time / first_step) * points_per_decade)) + 1, 2
+    )
+    times = np.geomspace(first_step, total_time, number_of_points)
+
+    # Round to ms so that the times can be used as column names
+    return np.unique(np.round(np.clip(np.concatenate(([0], times)), 0, total_time), 3))
+
+
+class TimedScheduler:
+    """
+    Deadlines of the steps of a timed measurement
+    """
+
+    def __init__(self, times, skip_missed=False, poll_interval=0.1):
+        self.times = np.asarray(times, dtype=float)
+        self.skip_missed = skip_missed
+
+        # Maximum sleep while waiting for a deadline (to be able to stop)
+        self.poll_interval = poll_interval
+
+        self.start_time = None
+
+        # Start and end of every capture relative to the start (nan if the
+        # step was not captured) and the indices of the skipped steps
+        self.capture_times = np.full((len(self.times), 2), np.nan)
+        self.skipped = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def start(self):
+        self.start_time = time.monotonic()
+
+    def elapsed(self):
+        """
+        Time since the start (s)
+        """
+        return time.monotonic() - self.start_time
+
+    def wait(self, deadline, should_stop):
+        """
+        Sleep until the deadline. Returns False if should_stop() became True.
+        """
+        while True:
+            if should_stop():
+                return False
+
+            remaining = deadline - self.elapsed()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, self.poll_interval))
+
+    def steps(self, should_stop=lambda: False):
+        """
+        Yield the index and planned time of every step once it is due
+        """
+        if self.start_time is None:
+            self.start()
+
+        i = 0
+        while i < len(self.times):
+            if not self.wait(self.times[i], should_stop):
+                return
+
+            # If the deadlines of the following steps passed as well, only
+            # the latest of them is captured
+            if self.skip_missed:
+                missed = np.flatnonzero(self.times[i + 1 :] <= self.elapsed())
+                if len(missed) > 0:
+                    self.skipped.extend(range(i, i + missed[-1] + 1))
+                    i += missed[-1] + 1
+
+            self.capture_times[i, 0] = self.elapsed()
+            yield i, self.times[i]
+            self.capture_times[i, 1] = self.elapsed()
+            i += 1
+
+    @property
+    def lateness(self):
+        """
+        Delay of the start of every capture with respect to its deadline (s)
+        """
+        return self.capture_times[:, 0] - self.times
+
+    def summary(self):
+        """
+        Summary of the timing of the captured steps
+        """
+        captured = ~np.isnan(self.capture_times[:, 1])
+        if not np.any(captured):
+            return "No step was captured"
+
+        lateness = self.lateness[captured]
+        durations = np.diff(self.capture_times[captured], axis=1)
+        return (
+            str(np.count_nonzero(captured))
+            + " of "
+            + str(len(self.times))
+            + " steps captured ("
+            + str(len(self.skipped))
+            + " skipped), mean delay "
+            + str(round(np.mean(lateness) * 1e3, 1))
+            + " ms, maximum delay "
+            + str(round(np.max(lateness) * 1e3, 1))
+            + " ms, mean capture time "
+            + str(round(np.mean(durations), 3))
+            + " s"
+        )
@@ -0,0 +1,119 @@
+from PySide6 import QtCore, QtWidgets
+
+import io_trace
+import core_functions as cf
+
+
+class TraceWindow(QtWidgets.QDialog):
+    """
+    Debug panel that shows the latency statistics of the instrument commands
+    """
+
+    columns = ["instrument", "type", "count", "mean", "p50", "p90", "p99", "max"]
+
+    def __init__(self, parent=None):
+        QtWidgets.QDialog.__init__(self)
+        self.parent = parent
+
+        self.setWindowTitle("I/O Trace")
+        self.resize(760, 480)
+        self.setStyleSheet(
+            "QWidget {\n"
+            "            background-color: rgb(44, 49, 60);\n"
+            "            color: rgb(255, 255, 255);\n"
+            '            font: 63 10pt "Segoe UI";\n'
+            "}\n"
+            "QHeaderView::section {\n"
+            "            background-color: rgb(52, 59, 72);\n"
+            "}\n"
+            "QPushButton {\n"
+            "            border: 2px solid rgb(52, 59, 72);\n"
+            "            border-radius: 5px;\n"
+            "            background-color: rgb(52, 59, 72);\n"
+            "            min-height: 25px;\n"
+            "}\n"
+            "QPushButton:hover {\n"
+            "            background-color: rgb(57, 65, 80);\n"
+            "            border: 2px solid rgb(61, 70, 86);\n"
+            "}\n"
+            "QPushButton:pressed {\n"
+            "            background-color: rgb(35, 40, 49);\n"
+            "            border: 2px solid rgb(43, 50, 61);\n"
+            "}"
+        )
+
+        self.layout = QtWidgets.QVBoxLayout(self)
+
+        # Table with one row per instrument and command type (latencies in ms)
+        self.table = QtWidgets.QTableWidget(0, len(self.columns), self)
+        self.table.setHorizontalHeaderLabels(
+            self.columns[:3] + [column + " (ms)" for column in self.columns[3:]]
+        )
+        self.table.horizontalHeader().setSectionResizeMode(
+            QtWidgets.QHeaderView.Stretch
+        )
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.layout.addWidget(self.table)
+
+        self.button_layout = QtWidgets.QHBoxLayout()
+        self.enable_checkBox = QtWidgets.QCheckBox("Tracing enabled", self)
+        self.enable_checkBox.setChecked(io_trace.tracer.enabled)
+        self.enable_checkBox.toggled.connect(self.toggle_tracing)
+        self.button_layout.addWidget(self.enable_checkBox)
+        self.clear_pushButton = QtWidgets.QPushButton("Clear", self)
+        self.clear_pushButton.clicked.connect(self.clear_trace)
+        self.button_layout.addWidget(self.clear_pushButton)
+        self.export_pushButton = QtWidgets.QPushButton("Export Trace", self)
+        self.export_pushButton.clicked.connect(self.export_trace)
+        self.button_layout.addWidget(self.export_pushButton)
+        self.layout.addLayout(self.button_layout)
+
+        # Refresh the statistics every second
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.update_table)
+        self.timer.start(1000)
+
+        self.update_table()
+
+    def update_table(self):
+        """
+        Fill the table with the current statistics (the last command of every
+        instrument is only recorded when it is flushed or the next one starts)
+        """
+        io_trace.tracer.flush()
+        statistics = io_trace.tracer.statistics()
+        self.table.setRowCount(len(statistics))
+
+        for row, entry in enumerate(statistics):
+            for column, key in enumerate(self.columns):
+                value = entry[key]
+                if column >= 3:
+                    value = "{0:.1f}".format(value * 1e3)
+                self.table.setItem(row, column, QtWidgets.QTableWidgetItem(str(value)))
+
+    def toggle_tracing(self, state):
+        io_trace.tracer.enabled = state
+
+    def clear_trace(self):
+        io_trace.tracer.clear()
+        self.update_table()
+
+    def export_trace(self):
+        """
+        Save the trace as JSON lines or csv file
+        """
+        file_path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self,
+            "Export Trace",
+            cf.read_global_settings()["default_saving_path"],
+            "JSON Lines (*.jsonl);;CSV (*.csv)",
+        )
+        if file_path == "":
+            return
+
+        io_trace.tracer.export(file_path)
+        cf.log_message("I/O trace exported to " + file_path)
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        event.accept()